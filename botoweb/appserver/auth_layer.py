@@ -32,6 +32,46 @@ log = logging.getLogger("botoweb.auth_layer")
 
 import re
 
+def get_auth_config(env, path, method=None):
+	"""
+	Get the auth rule for this path (and method)
+	"""
+	log.debug("Get Auth Config: %s" % (path))
+	match = None
+	if not env.config.has_key('botoweb'):
+		return None
+	for rule in env.config.get("botoweb", "auth", []):
+		if rule.has_key("url"):
+			if not re.match(rule['url'], path):
+				continue
+		if rule.has_key("method") and method:
+			if rule['method'].lower().strip() != method.lower().strip():
+				continue
+		match = rule
+		break
+	return match
+
+def authorize(env, req):
+	"""
+	Check that the user making this request is allowed
+	to get to its path, raising Unauthorized or Forbidden if not
+	"""
+	auth = get_auth_config(env, req.path, req.method)
+	if auth and not auth.get("disable", False):
+		log.debug("Checking auth: %s" % auth)
+		if not req.user:
+			raise Unauthorized()
+		elif auth.has_key("group"):
+			groups = auth['group']
+			authed = False
+			if not isinstance(groups, list):
+				groups = [groups]
+			for group in groups:
+				if req.user.has_auth_group(group):
+					authed = True
+			if not authed:
+				raise Forbidden()
+
 from botoweb.appserver.wsgi_layer import WSGILayer
 class AuthLayer(WSGILayer):
 	"""
@@ -43,44 +83,15 @@ class AuthLayer(WSGILayer):
 	"""
 
 	def handle(self, req, response):
-		auth = self.get_auth_config(req.path)
-		if auth and not auth.get("disable", False):
-			log.debug("Checking auth: %s" % auth)
-			if not req.user:
-				raise Unauthorized()
-			elif auth.has_key("group"):
-				groups = auth['group']
-				authed = False
-				if not isinstance(groups, list):
-					groups = [groups]
-				for group in groups:
-					if req.user.has_auth_group(group):
-						authed = True
-				if not authed:
-					raise Forbidden()
+		authorize(self.env, req)
 		if req.user != None and req.user.auth_token != None:
 			response.set_cookie('BW_AUTH_TOKEN', req.user.auth_token)
 		if self.app:
 			response = self.app.handle(req, response)
 		return response
 
-	def get_auth_config(self, path):
+	def get_auth_config(self, path, method=None):
 		"""
 		Get the auth config for this path
 		"""
-		log.debug("Get Auth Config: %s" % (path))
-		match = None
-		if not self.env.config.has_key('botoweb'):
-			return None
-		for rule in self.env.config.get("botoweb", "auth", []):
-			if rule.has_key("url"):
-				if not re.match(rule['url'], path):
-					continue
-			if rule.has_key("method"):
-				if rule['method'].lower().strip() != method.lower().strip():
-					continue
-			match = rule
-			break
-		return match
-
-
+		return get_auth_config(self.env, path, method)
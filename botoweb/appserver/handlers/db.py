@@ -1,5 +1,5 @@
 # Author: Chris Moyer
-from botoweb.exceptions import NotFound, Forbidden, BadRequest, Conflict, Gone
+from botoweb.exceptions import HTTPException, NotFound, Forbidden, BadRequest, Conflict, Gone
 from boto.exception import SDBPersistenceError, SDBResponseError
 from botoweb.appserver.handlers import RequestHandler
 from botoweb.db.dynamo import BatchItemFetcher
@@ -35,6 +35,10 @@ class DBHandler(RequestHandler):
 
 	You may also pass in the follwoing custom fields:
 	* db_class: Required, the class to use for this interface
+	* write_behind: Optional, if true updates to a single property are
+	  written in the background instead of before responding
+	* count: Optional, how to get the X-Result-Count header for lists,
+	  one of sync (the default), off, cache or parallel
 	"""
 	db_class = None
 	page_size = 50
@@ -46,6 +50,11 @@ class DBHandler(RequestHandler):
 			self.db_class = find_class(db_class_name)
 		xmlize.register(self.db_class)
 
+	@property
+	def archived(self):
+		"""True if deleted objects of our db_class are moved to its archive domain"""
+		return bool(getattr(self.db_class, "__archive__", False)) and DynamoModel not in self.db_class.mro()
+
 	def __call__(self, *params, **keywords):
 		"""Override to replace the SDBResponseError 
 		with a BadRequest error"""
@@ -57,6 +66,8 @@ class DBHandler(RequestHandler):
 	def _get(self, request, response, id=None ):
 		"""Get an object, or search for a list of objects"""
 		response.content_type = "text/xml"
+		if id == "_batch" or (not id and "ids" in request.GET):
+			return self._get_multi(request, response)
 		if id:
 			vals = id.split("/",1)
 			property = None
@@ -75,16 +86,17 @@ class DBHandler(RequestHandler):
 		else:
 			params = request.GET.mixed()
 			objs = self.search(params=params, user=request.user)
-			# Add the count to the header
-			try:
-				response.headers['X-Result-Count'] = str(objs.count())
-			except:
-				raise BadRequest('Invalid Query')
+			is_json = request.file_extension == "json" or request.accept.best_match(['application/xml', 'application/json']) == "application/json"
+			page = False
+			if not is_json and request.file_extension != "csv" and objs.limit == None:
+				objs.limit = self.page_size
+				page = True
+			self.set_result_count(response, objs)
 			if params.has_key("next_token"):
 				del(params['next_token'])
 			base_url = '%s%s%s' % (request.real_host_url, request.base_url, request.script_name)
 			#objs.limit = self.page_size
-			if request.file_extension == "json" or request.accept.best_match(['application/xml', 'application/json']) == "application/json":
+			if is_json:
 				response.content_type = "application/json"
 				response.app_iter = JSONWrapper(objs, request.user, "%s.json" % base_url, params)
 			elif request.file_extension == "csv":
@@ -92,13 +104,10 @@ class DBHandler(RequestHandler):
 				response.headers['Content-Disposition'] = 'attachment;filename=%s.csv' % self.db_class.__name__
 				response.app_iter = CSVWrapper(objs, request.user, self.db_class)
 			else:
-				page = False
-				if(objs.limit == None):
-					objs.limit = self.page_size
-					page = True
 				response.write("<%sList>" % self.db_class.__name__)
-				for obj in objs:
-					dataStr = xmlize.dumps(obj)
+				# Carry on from any result already fetched by set_result_count
+				for obj in iter(objs.next, None):
+					dataStr = xmlize.dumps(obj, fields=getattr(objs, "fields", None))
 					if '\x80' in dataStr or '\x1d' in dataStr:
 						dataStr.replace('\x80','').replace('\x1d','')
 					response.write(dataStr)
@@ -113,6 +122,35 @@ class DBHandler(RequestHandler):
 				response.write("</%sList>" % self.db_class.__name__)
 		return response
 
+	def _get_multi(self, request, response):
+		"""Get several objects by ID at once, either from
+		GET /collection?ids=a,b,c or GET /collection/_batch?ids=a,b,c.
+		IDs may also be given as repeated "ids" parameters. Objects that
+		don't exist (or can't be read) are left out of the results."""
+		ids = []
+		for val in request.GET.getall("ids"):
+			ids.extend([i.strip() for i in val.split(",") if i.strip()])
+		if not ids:
+			raise BadRequest("No ids specified")
+		max_ids = int(self.config.get("max_ids", 100))
+		if len(ids) > max_ids:
+			raise BadRequest("Too many ids", description="At most %s ids may be requested at once" % max_ids)
+		objs = self.read_multi(ids, request.user)
+		response.headers['X-Result-Count'] = str(len(objs))
+		if request.file_extension == "json" or request.accept.best_match(['application/xml', 'application/json']) == "application/json":
+			response.content_type = "application/json"
+			response.app_iter = JSONWrapper(iter(objs), request.user)
+		elif request.file_extension == "csv":
+			response.content_type = "text/csv"
+			response.headers['Content-Disposition'] = 'attachment;filename=%s.csv' % self.db_class.__name__
+			response.app_iter = CSVWrapper(iter(objs), request.user, self.db_class)
+		else:
+			response.write("<%sList>" % self.db_class.__name__)
+			for obj in objs:
+				response.write(xmlize.dumps(obj))
+			response.write("</%sList>" % self.db_class.__name__)
+		return response
+
 	def _head(self, request, response, id=None):
 		"""Get the headers for this response, realisticaly this
 		just means they want to know the count of how many results would be
@@ -123,11 +161,48 @@ class DBHandler(RequestHandler):
 		total records that could be counted in 5 seconds
 		"""
 		objs = self.search(params=request.GET.mixed(), user=request.user)
+		self.set_result_count(response, objs, prefetch=False)
+		return response
+
+	def set_result_count(self, response, objs, prefetch=True):
+		"""
+		Add the X-Result-Count header for this query. How it's counted
+		is set by the "count" option for this handler:
+
+		* sync: Count before fetching any results (the default)
+		* off: Don't send the header at all
+		* cache: Use a count cached for up to "count_ttl" seconds
+		  (60 by default), writes to the class invalidate it
+		* parallel: Count while the first page is being fetched
+		"""
+		mode = self.config.get("count", "sync")
+		if mode == "off":
+			return
 		try:
-			response.headers['X-Result-Count'] = str(objs.count())
-		except:
+			if mode == "cache":
+				from botoweb.db import count_cache
+				count = count_cache.cached_count(objs, int(self.config.get("count_ttl", 60)))
+			elif mode == "parallel" and prefetch and hasattr(objs, "peek"):
+				from threading import Thread
+				from botoweb.db.parallel import in_context
+				result = []
+				# Counted as consistently as the page, after a write
+				t = Thread(target=in_context(lambda: result.append(objs.count())))
+				t.start()
+				try:
+					objs.peek()
+				finally:
+					t.join()
+				if not result:
+					raise BadRequest("Invalid Query")
+				count = result[0]
+			else:
+				count = objs.count()
+		except HTTPException:
+			raise
+		except Exception:
 			raise BadRequest("Invalid Query")
-		return response
+		response.headers['X-Result-Count'] = str(count)
 
 
 	def _post(self, request, response, id=None):
@@ -229,6 +304,7 @@ class DBHandler(RequestHandler):
 		query_str = params.get("query", None)
 		sort_by = params.get("sort_by", None)
 		next_token = params.get("next_token", None)
+		fields = params.get("fields", None)
 		simple_query = params.get('q', None)
 		properties = [p.name for p in query.model_class.properties(hidden=False)]
 		if query_str:
@@ -286,7 +362,7 @@ class DBHandler(RequestHandler):
 				query.filter('name like', '%%%s%%' % simple_query)
 		else:
 			for filter in set(params.keys()):
-				if filter in ["sort_by", "next_token"]:
+				if filter in ["sort_by", "next_token", "fields"]:
 					continue
 				filter_value = params[filter]
 				filter_args = filter.split(".")
@@ -299,11 +375,20 @@ class DBHandler(RequestHandler):
 					filter_value = filter_value[0]
 				if filter_value:
 					query.filter("%s %s " % (filter, filter_cmp), filter_value)
+		if fields:
+			if isinstance(fields, list):
+				fields = ",".join(fields)
+			fields = [f.strip() for f in fields.split(",") if f.strip()]
+			for name in fields:
+				if name not in properties:
+					raise BadRequest("Unknown field", description="%s has no property %s" % (query.model_class.__name__, name))
+			query.select_fields(fields)
 		if sort_by:
 			query.order(sort_by)
 		if next_token:
 			query.next_token = urllib.unquote(next_token.strip()).replace(" ", "+")
-		if not show_deleted and "deleted" in properties:
+		# Archived classes don't keep deleted objects in the live domain
+		if not show_deleted and "deleted" in properties and not self.archived:
 			query.filter("deleted =", [False, None]) # Allow deleted to be either not set or set to false
 		return query
 
@@ -399,6 +484,8 @@ class DBHandler(RequestHandler):
 		except:
 			raise NotFound()
 		if not obj:
+			if self.archived and self.db_class._get_by_id(id, manager=self.db_class._manager.archive):
+				raise Gone("Object has been deleted", "The object %s no longer exists" % id)
 			raise NotFound()
 		# Insurance to make sure this is actually an instance of
 		# what they're allowed to request from this handler
@@ -415,6 +502,19 @@ class DBHandler(RequestHandler):
 			raise Gone("Object has been deleted", "The object %s no longer exists" % obj.id)
 		return obj
 
+	def read_multi(self, ids, user):
+		"""
+		Get all the objects these IDs point to with one batched read,
+		applying the same checks as read(). Objects that don't exist,
+		aren't an instance of our db_class, or were marked as deleted
+		are left out.
+		"""
+		if DynamoModel in self.db_class.mro():
+			objs = [self.db_class.lookup(id) for id in ids]
+		else:
+			objs = self.db_class.get_by_id(list(ids))
+		return [obj for obj in objs if obj and isinstance(obj, self.db_class) and not getattr(obj, "deleted", False)]
+
 	def update(self, obj, props, user, request):
 		"""
 		Update our object
@@ -498,7 +598,10 @@ class DBHandler(RequestHandler):
 				obj.deleted = True
 				obj.deleted_at = datetime.utcnow()
 				obj.deleted_by = user
-				obj.put()
+				if self.archived:
+					obj.archive()
+				else:
+					obj.put()
 			else:
 				obj.delete()
 		return obj
@@ -601,7 +704,10 @@ class DBHandler(RequestHandler):
 
 		obj.modified_by = request.user
 		obj.modified_at = datetime.utcnow()
-		obj.put()
+		if self.config.get('write_behind'):
+			obj.put_later()
+		else:
+			obj.put()
 		self.log.info("Updated %s<%s>.%s" % (obj.__class__.__name__, obj.id, property))
 		# 204 is the proper status code but it does not allow the onload event
 		# to fire in the browser, which expects a 200. Without the onload event
@@ -613,10 +719,14 @@ NO_SEND_PROPS = [ "CalculatedProperty" ]
 class JSONWrapper(object):
 	"""JSON Wrapper"""
 
-	def __init__(self, objs, user, base_url=None, params=None):
-		"""Create this JSON wrapper"""
+	def __init__(self, objs, user, base_url=None, params=None, fields=None):
+		"""Create this JSON wrapper, only including the properties
+		named in fields (or selected by the query) if given"""
 		self.objs = objs
 		self.user = user
+		if fields is None:
+			fields = getattr(objs, "fields", None)
+		self.fields = fields
 		self.start_time = time()
 		self.next_token = None
 		self.base_url = base_url
@@ -642,6 +752,8 @@ class JSONWrapper(object):
 				"__id__": obj.id
 			}
 			for prop in obj.properties():
+				if self.fields is not None and prop.name not in self.fields:
+					continue
 				# Check for user authorizations before saving it to the array
 				if prop.name and not prop.name.startswith("_")  and not prop.__class__.__name__ in NO_SEND_PROPS and (not self.user or self.user.has_auth("GET", cls_name, prop.name)):
 					s[prop.name] = self.encode(getattr(obj, prop.name), prop)
@@ -666,11 +778,15 @@ class JSONWrapper(object):
 class CSVWrapper(object):
 	"""CSV Wrapper"""
 
-	def __init__(self, objs, user, db_class):
-		"""Create this JSON wrapper"""
+	def __init__(self, objs, user, db_class, fields=None):
+		"""Create this CSV wrapper, only including the properties
+		named in fields (or selected by the query) if given"""
 		self.objs = objs
 		self.user = user
 		self.db_class = db_class
+		if fields is None:
+			fields = getattr(objs, "fields", None)
+		self.fields = fields
 		self.start_time = time()
 		self.headers = None
 		self.props = {}
@@ -691,6 +807,8 @@ class CSVWrapper(object):
 			if self.headers == None:
 				self.headers = {"__class__": "Model", "id": "ID"}
 				for prop in self.db_class.properties():
+					if self.fields is not None and prop.name not in self.fields:
+						continue
 					# Check for user authorizations before saving it to the array
 					if prop.name and not prop.name.startswith("_")  and not prop.__class__.__name__ in NO_SEND_PROPS and self.user.has_auth("GET", cls_name, prop.name):
 						self.headers[prop.name] = prop.verbose_name
@@ -20,7 +20,8 @@
 # IN THE SOFTWARE.
 
 from botoweb.appserver.handlers.db import DBHandler
-from botoweb.exceptions import Unauthorized
+from botoweb.db.query import Query
+from botoweb.exceptions import Unauthorized, NotFound
 
 class TrashHandler(DBHandler):
 	"""Handler for the "deleted" files"""
@@ -35,6 +36,24 @@ class TrashHandler(DBHandler):
 		obj.delete()
 		return obj
 
+	def read(self, id, user):
+		"""Get a deleted object, from the archive domain
+		if our db_class has one"""
+		if not self.archived:
+			return DBHandler.read(self, id, user)
+		obj = self.db_class._get_by_id(id, manager=self.db_class._manager.archive)
+		if not obj or not isinstance(obj, self.db_class):
+			raise NotFound()
+		return obj
+
+	def update(self, obj, props, user, request):
+		"""Update a deleted object. An archived object which is
+		no longer marked as deleted is moved back out of the archive"""
+		obj = DBHandler.update(self, obj, props, user, request)
+		if self.archived and not obj.deleted:
+			obj.restore()
+		return obj
+
 	def search(self, params, user):
 		"""Search through the trash (Wash your hands!)
 		@param params: The Terms to search for
@@ -43,7 +62,11 @@ class TrashHandler(DBHandler):
 		@param user: the user that is searching
 		@type user: User
 		"""
-		query = self.db_class.find()
-		query.filter("deleted =", True)
+		if self.archived:
+			# Everything in the archive was deleted
+			query = Query(self.db_class, manager=self.db_class._manager.archive)
+		else:
+			query = self.db_class.find()
+			query.filter("deleted =", True)
 		return self.build_query(params, query=query, user=user, show_deleted=True)
 
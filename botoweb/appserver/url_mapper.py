@@ -18,6 +18,11 @@ from botoweb.response import Response
 from botoweb import status
 from botoweb.exceptions import *
 
+try:
+	import simplejson as json
+except:
+	import json
+
 log = logging.getLogger("botoweb.url_mapper")
 
 from botoweb.appserver.wsgi_layer import WSGILayer
@@ -56,12 +61,107 @@ class URLMapper(WSGILayer):
 			log.info("[%s] %s: %s" % (req.user.username, req.method, req.path_info))
 		else:
 			log.info("%s: %s" % (req.method, req.path_info))
+		batch_url = self.env.config.get("app", "batch_url")
+		if batch_url and req.path == batch_url:
+			return self.handle_batch(req, response)
 		(handler, obj_id) = self.parse_path(req)
 		if not handler:
 			raise NotFound(url=req.path)
 		return handler(req, response, obj_id)
 
 
+	def handle_batch(self, req, response):
+		"""
+		Run several requests at once. The body must be a JSON array of
+		sub-requests like::
+
+			{"method": "GET", "path": "/blog/123", "params": {...}, "body": ...}
+
+		Each one is dispatched straight to its handler as the user who
+		made this request, so it only goes through authentication and
+		routing once. Sub-requests always get JSON responses. Reads between
+		two writes don't depend on each other, so they are run at the same
+		time, up to the "batch_workers" option in the [app] section.
+
+		The response is a JSON array of {"status", "headers", "body"}
+		results, in the same order as the sub-requests.
+		"""
+		from botoweb.db.parallel import parallel_map, in_context
+		if req.method != "POST":
+			raise BadRequest(description="Batch requests must be POSTed")
+		try:
+			ops = json.loads(req.body)
+		except ValueError:
+			raise BadRequest(description="Batch requests must be a JSON array")
+		if not isinstance(ops, list):
+			raise BadRequest(description="Batch requests must be a JSON array")
+		max_ops = int(self.env.config.get("app", "batch_max", 50))
+		if len(ops) > max_ops:
+			raise BadRequest(description="At most %s requests may be batched" % max_ops)
+		workers = int(self.env.config.get("app", "batch_workers", 4))
+
+		results = [None] * len(ops)
+		def run_reads(reads):
+			# Reads see the writes made earlier in the batch, and the objects it loaded
+			dispatch = in_context(lambda x: self._dispatch(req, ops[x]))
+			for x, result in zip(reads, parallel_map(dispatch, reads, workers)):
+				results[x] = result
+
+		reads = []
+		for x, op in enumerate(ops):
+			if isinstance(op, dict) and str(op.get("method", "GET")).upper() in ("GET", "HEAD"):
+				reads.append(x)
+				continue
+			# Writes may depend on earlier reads, and later reads on them
+			run_reads(reads)
+			reads = []
+			results[x] = self._dispatch(req, op)
+		run_reads(reads)
+
+		response.content_type = "application/json"
+		response.body = json.dumps(results)
+		return response
+
+	def _dispatch(self, req, op):
+		"""Run one batched sub-request, returning its result as a dict"""
+		from botoweb.appserver.auth_layer import authorize
+		try:
+			if not isinstance(op, dict) or not str(op.get("path", "")).startswith("/"):
+				raise BadRequest(description="Each request needs an absolute path")
+			path = str(op["path"])
+			if op.get("params"):
+				path = "%s?%s" % (path, urllib.urlencode(op["params"], True))
+			sub = Request.blank(path, environ={
+				"REQUEST_METHOD": str(op.get("method", "GET")).upper(),
+				"HTTP_ACCEPT": "application/json",
+				"HTTP_HOST": req.host,
+				"wsgi.url_scheme": req.scheme,
+			})
+			body = op.get("body")
+			if body is not None:
+				if not isinstance(body, basestring):
+					body = json.dumps(body)
+				sub.content_type = "application/json"
+				sub.body = body
+			# Already authenticated
+			sub._user = req.user or False
+			authorize(self.env, sub)
+			(handler, obj_id) = self.parse_path(sub)
+			if not handler:
+				raise NotFound(url=sub.path)
+			sub.file_extension = "json"
+			resp = handler(sub, Response(), obj_id)
+			headers = {"Content-Type": resp.content_type}
+			if "X-Result-Count" in resp.headers:
+				headers["X-Result-Count"] = resp.headers["X-Result-Count"]
+			return {"status": resp.status_int, "headers": headers, "body": resp.body}
+		except HTTPException, e:
+			return {"status": e.code, "headers": {"Content-Type": "application/json"}, "body": e.to_json()}
+		except Exception, e:
+			log.exception("Error in batched request: %s" % op)
+			e = InternalServerError(message=str(e))
+			return {"status": e.code, "headers": {"Content-Type": "application/json"}, "body": e.to_json()}
+
 	def parse_path(self, req):
 		"""
 		Get the handler and object id (if given) for this
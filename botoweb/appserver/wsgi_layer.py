@@ -26,6 +26,8 @@ from botoweb.resources.user import User
 from botoweb.request import Request
 from botoweb.response import Response
 from botoweb.exceptions import *
+from botoweb.db.identity import identity_map
+from botoweb.db.consistency import WriteTracker, COOKIE_NAME, window
 
 try:
 	import simplejson as json
@@ -76,7 +78,12 @@ class WSGILayer(object):
 			if self.maxthreads and self.threadpool:
 				if len(self.threadpool.working) > self.maxthreads:
 					raise ServiceUnavailable("Service Temporarily Overloaded")
-			resp = self.handle(req, resp)
+			if self.env.config.get("app", "identity_map", False):
+				# Share loaded objects across this request
+				with identity_map():
+					resp = self.handle_tracked(req, resp)
+			else:
+				resp = self.handle_tracked(req, resp)
 		except AssertionError, e:
 			resp.set_status(400)
 			resp.content_type = "text/plain"
@@ -170,6 +177,24 @@ class WSGILayer(object):
 		"""
 		self.env = env
 
+	def handle_tracked(self, req, resp):
+		"""
+		Handle the request, and if "read_your_writes" is set in [app],
+		read back whatever this user wrote in the last few seconds with
+		consistent reads. The writes are kept in a cookie, which is set
+		even if the handler raises (e.g. redirecting after a POST).
+		"""
+		if not self.env.config.get("app", "read_your_writes", False):
+			return self.handle(req, resp)
+		tracker = WriteTracker.from_cookie(req.cookies.get(COOKIE_NAME))
+		with tracker:
+			try:
+				resp = self.handle(req, resp)
+			finally:
+				if tracker.changed:
+					resp.set_cookie(COOKIE_NAME, tracker.to_cookie(), max_age=window() + 1, httponly=True)
+		return resp
+
 	def handle(self, req, response):
 		"""
 		This is the function that is called when chainging WSGI layers
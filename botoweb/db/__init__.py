@@ -4,6 +4,7 @@
 # botoweb DB module overrides, this provides one simple
 # location for users to pull in the DB modules from
 # and adds a few new features on top of botoweb.db
+from botoweb.db.batch import batch, put_multi, delete_multi
 
 def index_string(s):
 	"""Generates an index of this string,
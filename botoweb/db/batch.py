@@ -0,0 +1,165 @@
+# Copyright (c) 2014 Chris Moyer http://coredumped.org/
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+# Author: Chris Moyer http://coredumped.org/
+# Description: Batched writes. Objects are grouped by the domain
+# they are stored in and handed to the manager's save_objects or
+# delete_objects, which can write many of them in a single request.
+#
+#	with batch():
+#		for obj in objs:
+#			obj.put()
+#
+# Everything put or deleted inside the block is written when it exits.
+
+import threading
+
+from boto.exception import SDBPersistenceError
+
+import logging
+log = logging.getLogger('botoweb.db.batch')
+
+
+class BatchWriteError(SDBPersistenceError):
+	"""Raised when some of the requests in a batch write failed
+	even after retrying. Everything else in the batch was written.
+
+	:ivar failed: The objects which were not written
+	:ivar errors: The exceptions raised by the failed requests
+	"""
+
+	def __init__(self, failed, errors):
+		self.failed = list(failed)
+		self.errors = list(errors)
+		SDBPersistenceError.__init__(self, "Error: %s objects could not be written: %s" % (len(self.failed), self.errors[0]))
+
+
+def _group(objs):
+	"""Group objects by the domain they are stored in, keeping the
+	first manager seen for each domain"""
+	groups = []
+	index = {}
+	for obj in objs:
+		manager = obj._manager
+		key = (manager.__class__, manager.db_host, manager.db_name)
+		if key not in index:
+			index[key] = len(groups)
+			groups.append((manager, []))
+		groups[index[key]][1].append(obj)
+	return groups
+
+
+def put_multi(objs, max_workers=None):
+	"""Save all of these objects, using batch writes where the
+	manager supports them.
+
+	:param objs: Objects to save, of any Model class
+	:type objs: list
+
+	:param max_workers: Maximum number of requests to run at once
+		per domain, by default the [DB] "max_parallel" option
+	:type max_workers: int
+	"""
+	objs = list(objs)
+	for manager, group in _group(objs):
+		manager.save_objects(group, max_workers)
+	return objs
+
+
+def delete_multi(objs, max_workers=None):
+	"""Delete all of these objects, using batch deletes where the
+	manager supports them.
+
+	:param objs: Objects to delete, of any Model class
+	:type objs: list
+
+	:param max_workers: Maximum number of requests to run at once
+		per domain, by default the [DB] "max_parallel" option
+	:type max_workers: int
+	"""
+	objs = list(objs)
+	for manager, group in _group(objs):
+		manager.delete_objects(group, max_workers)
+	return objs
+
+
+_local = threading.local()
+
+def current_batch():
+	"""The innermost batch active in this thread, or None"""
+	stack = getattr(_local, 'stack', None)
+	if stack:
+		return stack[-1]
+	return None
+
+
+class batch(object):
+	"""Context manager which collects every put() and delete() made
+	in this thread, and writes them all in batches when the block exits.
+	Nothing is written if the block raises an exception.
+
+	Conditional puts (with an expected_value) can't be batched, so those
+	are still written right away.
+	"""
+
+	def __init__(self, max_workers=None):
+		self.max_workers = max_workers
+		self.puts = []
+		self.deletes = []
+		self._seen = set()
+
+	def put(self, obj):
+		# Objects need an ID right away so they can be referenced
+		# before the batch is flushed
+		if not obj.id:
+			obj.id = obj._manager.new_id(obj)
+		if ('put', id(obj)) not in self._seen:
+			self._seen.add(('put', id(obj)))
+			self.puts.append(obj)
+
+	def delete(self, obj):
+		if ('delete', id(obj)) not in self._seen:
+			self._seen.add(('delete', id(obj)))
+			self.deletes.append(obj)
+
+	def flush(self):
+		"""Write everything collected so far"""
+		puts, deletes = self.puts, self.deletes
+		self.puts, self.deletes, self._seen = [], [], set()
+		# An object deleted in the same batch doesn't need saving
+		deleted = set(id(obj) for obj in deletes)
+		puts = [obj for obj in puts if id(obj) not in deleted]
+		if puts:
+			put_multi(puts, self.max_workers)
+		if deletes:
+			delete_multi(deletes, self.max_workers)
+
+	def __enter__(self):
+		if getattr(_local, 'stack', None) is None:
+			_local.stack = []
+		_local.stack.append(self)
+		return self
+
+	def __exit__(self, exc_type, exc_value, tb):
+		_local.stack.remove(self)
+		if exc_type is None:
+			self.flush()
+		return False
@@ -0,0 +1,172 @@
+# Copyright (c) 2014 Chris Moyer http://coredumped.org/
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+#
+# Author: Chris Moyer http://coredumped.org/
+# Description: Session-scoped read-your-writes. While a WriteTracker is
+# active in a thread, every object written through an SDBManager is
+# recorded, and for a few seconds after that, reads of that object (and
+# queries on its class) in the same session use consistent reads.
+# Everything else stays eventually consistent. The tracker can be saved
+# in a cookie, so a user's writes are followed across requests:
+#
+#	tracker = WriteTracker.from_cookie(req.cookies.get(COOKIE_NAME))
+#	with tracker:
+#		obj.put()
+#		Model.get_by_id(obj.id)    # consistent read
+#	resp.set_cookie(COOKIE_NAME, tracker.to_cookie())
+#
+# The window is "read_your_writes_window" in the [DB] section, in seconds.
+
+import time
+import json
+import base64
+import threading
+
+import boto
+
+import logging
+log = logging.getLogger('botoweb.db.consistency')
+
+_local = threading.local()
+
+COOKIE_NAME = 'bw_writes'
+
+# Most items to remember, so the cookie stays small. Queries on the
+# class of any item that's dropped are still consistent.
+MAX_ITEMS = 20
+
+# Most classes to remember, the cookie comes from the client so it
+# can't make every query consistent
+MAX_CLASSES = 10
+
+def current_tracker():
+	"""The WriteTracker active in this thread, or None"""
+	stack = getattr(_local, 'stack', None)
+	if stack:
+		return stack[-1]
+	return None
+
+def window():
+	"""Seconds to read back writes consistently, "read_your_writes_window" in [DB]"""
+	return boto.config.getint('DB', 'read_your_writes_window', 10)
+
+
+class WriteTracker(object):
+	"""
+	Classes and items written in one session, and until when they
+	should be read consistently
+
+	:param writes: Dict of class name, or "class name/ID", to the time
+		the window for it ends
+	:type writes: dict
+	"""
+
+	def __init__(self, writes=None):
+		self.writes = dict(writes or {})
+		self.changed = False
+
+	def record(self, cls, ids):
+		"""Record writes to items of a class, by the name of the
+		class the manager stores"""
+		until = int(time.time() + window()) + 1
+		self.writes[cls.__name__] = until
+		for id in ids:
+			if id:
+				self.writes['%s/%s' % (cls.__name__, id)] = until
+		self.changed = True
+		self._expire()
+
+	def is_recent(self, cls, id=None):
+		"""
+		Check if this session wrote the item (or, without an ID,
+		anything of the class) within the window
+		"""
+		key = cls.__name__
+		if id is not None:
+			key = '%s/%s' % (key, id)
+		return self.writes.get(key, 0) > time.time()
+
+	def _expire(self):
+		now = time.time()
+		for key, until in self.writes.items():
+			if until <= now:
+				del self.writes[key]
+		items = sorted([(until, key) for key, until in self.writes.items() if '/' in key])
+		for until, key in items[:max(0, len(items) - MAX_ITEMS)]:
+			del self.writes[key]
+		classes = sorted([(until, key) for key, until in self.writes.items() if '/' not in key])
+		for until, key in classes[:max(0, len(classes) - MAX_CLASSES)]:
+			del self.writes[key]
+
+	def __len__(self):
+		return len(self.writes)
+
+	def to_cookie(self):
+		"""The writes still in their window, as a cookie value"""
+		self._expire()
+		if not self.writes:
+			return ''
+		return base64.urlsafe_b64encode(json.dumps(self.writes, separators=(',', ':')))
+
+	@classmethod
+	def from_cookie(cls, value):
+		"""
+		Tracker with the writes saved in a cookie. A cookie we can't
+		read just starts an empty tracker, the worst it can do is make
+		a few reads consistent. The cookie isn't signed, so no window
+		is kept longer than one started now, and anything that isn't
+		the name of a Model class is dropped.
+		"""
+		from botoweb.db.coremodel import Model
+		writes = {}
+		if value:
+			try:
+				writes = json.loads(base64.urlsafe_b64decode(str(value)))
+				writes = dict([(unicode(k), int(v)) for k, v in writes.items()])
+			except Exception:
+				log.warn('Ignoring unreadable %s cookie' % COOKIE_NAME)
+				writes = {}
+		latest = int(time.time() + window()) + 1
+		known = {}
+		for key in writes.keys():
+			name = key.split('/', 1)[0]
+			if name not in known:
+				known[name] = Model.find_subclass(name) is not None
+			if known[name]:
+				writes[key] = min(writes[key], latest)
+			else:
+				del writes[key]
+		tracker = cls(writes)
+		tracker._expire()
+		return tracker
+
+	def __enter__(self):
+		if getattr(_local, 'stack', None) is None:
+			_local.stack = []
+		_local.stack.append(self)
+		return self
+
+	def __exit__(self, exc_type, exc_value, tb):
+		_local.stack.remove(self)
+		return False
+
+read_your_writes = WriteTracker
@@ -30,6 +30,19 @@ import logging
 log = logging.getLogger('botoweb.db.model')
 
 
+def _set_type_queries(cls):
+	'''Build the clauses which match objects of this class or any of
+	its subclasses, one on __type__ and one on __lineage__'''
+	cls._type_query = "(%s)" % " or ".join(["`__type__` = '%s'" % c.__name__ for c in cls._type_classes])
+	lineage = cls.get_lineage()
+	parts = ["`__lineage__` = '%s'" % lineage, "`__lineage__` like '%s.%%'" % lineage]
+	# With multiple inheritance a subclass's lineage may not start with ours
+	for c in cls._type_classes:
+		if c is not cls and not c.get_lineage().startswith(lineage + "."):
+			parts.append("`__type__` = '%s'" % c.__name__)
+	cls._lineage_query = "(%s)" % " or ".join(parts)
+
+
 class ModelMeta(type):
 	'''Metaclass for all Models'''
 
@@ -37,6 +50,14 @@ class ModelMeta(type):
 		super(ModelMeta, cls).__init__(name, bases, dict)
 		# Make sure this is a subclass of Model - mainly copied from django ModelBase (thanks!)
 		cls.__sub_classes__ = []
+		# This class and all its subclasses, so queries don't
+		# have to walk the class tree every time
+		cls._type_classes = [cls]
+		for base in cls.__mro__[1:]:
+			if '_type_classes' in base.__dict__:
+				base._type_classes.append(cls)
+				_set_type_queries(base)
+		_set_type_queries(cls)
 		try:
 			if filter(lambda b: issubclass(b, Model), bases):
 				for base in bases:
@@ -62,7 +83,13 @@ class ModelMeta(type):
 class Model(object):
 	__metaclass__ = ModelMeta
 	__consistent__ = False  # Consistent is set off by default
+	__write_behind__ = False  # Queue puts to be written in the background
+	__archive__ = False  # Move soft-deleted objects to an archive domain (or the domain named here)
+	__cache_ttl__ = None  # Seconds to keep objects in the object cache, None to not cache them
 	_raw_item = None  # Allows us to cache the raw items
+	_dirty = None  # Names of properties changed since the last load or save
+	_stored_attrs = None  # Raw attributes as last read from or written to the datastore
+	_partial = None  # Names of the only properties loaded, if not all of them were
 	id = None
 
 	@classmethod
@@ -79,7 +106,42 @@ class Model(object):
 	def _get_by_id(cls, id, manager=None):
 		if not manager:
 			manager = cls._manager
-		return manager.get_object(cls, id)
+		from botoweb.db.identity import current_map
+		# The identity map only holds objects from our own manager
+		idmap = None
+		if manager is cls._manager:
+			idmap = current_map()
+		if idmap is None:
+			return manager.get_object(cls, id)
+		obj = idmap.get(id)
+		if obj is None:
+			obj = idmap.add(manager.get_object(cls, id))
+		return obj
+
+	@classmethod
+	def _get_by_ids(cls, ids, manager=None):
+		if not manager:
+			manager = cls._manager
+		from botoweb.db.identity import current_map
+		idmap = None
+		if manager is cls._manager:
+			idmap = current_map()
+		found = {}
+		if idmap is not None:
+			for id in ids:
+				obj = idmap.get(id)
+				if obj is not None:
+					found[id] = obj
+		missing = []
+		for id in ids:
+			if id and id not in found and id not in missing:
+				missing.append(id)
+		if missing:
+			for id, obj in zip(missing, manager.get_objects(cls, missing)):
+				found[id] = obj
+				if idmap is not None:
+					idmap.add(obj)
+		return [found.get(id) for id in ids]
 
 	@classmethod
 	def lookup(cls, *args, **kwargs):
@@ -91,8 +153,7 @@ class Model(object):
 	@classmethod
 	def get_by_id(cls, ids=None, parent=None):
 		if isinstance(ids, list):
-			objs = [cls._get_by_id(id) for id in ids]
-			return objs
+			return cls._get_by_ids(ids)
 		else:
 			return cls._get_by_id(ids)
 
@@ -180,6 +241,8 @@ class Model(object):
 	def __init__(self, id=None, **kw):
 		self._loaded = False
 		self._validate = False
+		self._dirty = None
+		self._stored_attrs = None
 		# first try to initialize all properties to their default values
 		for prop in self.properties(hidden=False):
 			try:
@@ -222,6 +285,30 @@ class Model(object):
 			self._loaded = False
 			self._manager.load_object(self)
 
+	def _mark_clean(self, attrs):
+		'''
+		Record the raw attributes currently stored for this object and
+		start tracking changes from here. Until this is called (for
+		example on a brand new object), every save is a full write.
+
+		:param attrs: Raw attributes as stored in the datastore
+		:type attrs: dict
+		'''
+		self._stored_attrs = dict(attrs)
+		self._dirty = set()
+
+	def is_dirty(self, prop_name=None):
+		'''
+		Check if this object (or just one property of it) has been
+		changed since it was loaded. Objects which were never loaded
+		are always considered dirty.
+		'''
+		if self._dirty is None:
+			return True
+		if prop_name is None:
+			return len(self._dirty) > 0
+		return prop_name in self._dirty
+
 	def put(self, expected_value=None):
 		'''
 		Save this object as it is, with an optional expected value
@@ -234,11 +321,32 @@ class Model(object):
 		:return: This object
 		:rtype: :class:`~.Model`
 		'''
+		from botoweb.db.batch import current_batch
+		b = current_batch()
+		if b is not None and not expected_value:
+			# Written when the batch is flushed
+			b.put(self)
+			return self
+		if self.__write_behind__ and not expected_value:
+			return self.put_later()
 		self._manager.save_object(self, expected_value)
 		return self
 
 	save = put
 
+	def put_later(self):
+		'''
+		Queue this object to be saved by a background thread, see
+		:mod:`botoweb.db.writebehind`. Only use this for writes which
+		don't need to be visible right away.
+
+		:return: This object
+		:rtype: :class:`~.Model`
+		'''
+		from botoweb.db.writebehind import get_queue
+		get_queue().put(self)
+		return self
+
 	def put_attributes(self, attrs):
 		'''
 		Save just these few attributes, not the whole object
@@ -267,15 +375,82 @@ class Model(object):
 		:rtype: :class:`~.Model`
 		'''
 		assert(isinstance(attrs, list)), 'Argument must be a list of names of keys to delete.'
-		self._manager.domain.delete_attributes(self.id, attrs)
+		self._manager.delete_key_value(self, attrs)
 		self.reload()
 		return self
 
 	save_attributes = put_attributes
 
 	def delete(self):
+		from botoweb.db.batch import current_batch
+		b = current_batch()
+		if b is not None:
+			b.delete(self)
+			return
+		from botoweb.db.identity import current_map
+		idmap = current_map()
+		if idmap is not None:
+			idmap.discard(self.id)
 		self._manager.delete_object(self)
 
+	def archive(self):
+		'''
+		Move this object to the archive domain, instead of saving it
+		with "deleted" set. See :attr:`__archive__`.
+
+		:return: This object
+		:rtype: :class:`~.Model`
+		'''
+		from botoweb.db.identity import current_map
+		idmap = current_map()
+		if idmap is not None:
+			idmap.discard(self.id)
+		self._manager.archive_object(self)
+		return self
+
+	def restore(self):
+		'''
+		Move this object out of the archive domain, back to where
+		:meth:`archive` took it from.
+
+		:return: This object
+		:rtype: :class:`~.Model`
+		'''
+		from botoweb.db.identity import current_map
+		idmap = current_map()
+		if idmap is not None:
+			idmap.discard(self.id)
+		self._manager.restore_object(self)
+		return self
+
+	@classmethod
+	def put_multi(cls, objs, max_workers=None):
+		'''
+		Save several objects using as few requests as possible
+
+		:param objs: Objects to save, which may be of any Model class
+		:type objs: list
+		:param max_workers: Maximum number of requests to run at once
+		:type max_workers: int
+		:return: The objects saved
+		:rtype: list
+		'''
+		from botoweb.db.batch import put_multi
+		return put_multi(objs, max_workers)
+
+	@classmethod
+	def delete_multi(cls, objs, max_workers=None):
+		'''
+		Delete several objects using as few requests as possible
+
+		:param objs: Objects to delete, which may be of any Model class
+		:type objs: list
+		:param max_workers: Maximum number of requests to run at once
+		:type max_workers: int
+		'''
+		from botoweb.db.batch import delete_multi
+		return delete_multi(objs, max_workers)
+
 	def key(self):
 		return Key(obj=self)
 
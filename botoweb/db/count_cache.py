@@ -0,0 +1,110 @@
+# Copyright (c) 2014 Chris Moyer http://coredumped.org/
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+# Author: Chris Moyer http://coredumped.org/
+# Description: Short lived cache of query counts.
+# Counts are keyed by the class and the generated filter string, and
+# expire after a few seconds. Each class also has a generation number
+# which is part of the key; every write to the class (or a subclass)
+# bumps it, so counts cached before the write are never used again.
+# Memcache is used when botoweb has one configured, so every process
+# shares the same counts and generations, otherwise they're kept in
+# this process.
+
+import time
+import hashlib
+import threading
+
+import botoweb
+
+import logging
+log = logging.getLogger('botoweb.db.count_cache')
+
+_counts = {}
+_generations = {}
+_lock = threading.Lock()
+
+# Don't let the local cache grow forever
+MAX_LOCAL_COUNTS = 1000
+
+
+def _generation_key(cls_name):
+	return 'count-gen:%s' % cls_name
+
+def generation(cls):
+	"""Current generation number for this class"""
+	if botoweb.memc:
+		try:
+			return int(botoweb.memc.get(_generation_key(cls.__name__)) or 0)
+		except Exception:
+			log.exception('Could not get count generation for %s' % cls.__name__)
+	return _generations.get(cls.__name__, 0)
+
+def _key(cls, query_str):
+	return 'count:%s:%s:%s' % (cls.__name__, generation(cls),
+		hashlib.sha1(query_str.encode('utf-8') if isinstance(query_str, unicode) else query_str).hexdigest())
+
+def invalidate(cls):
+	"""Forget every count cached for this class and the classes it
+	inherits from, called whenever one of its objects is written"""
+	for c in cls.__mro__:
+		if not hasattr(c, '_manager'):
+			continue
+		with _lock:
+			_generations[c.__name__] = _generations.get(c.__name__, 0) + 1
+		if botoweb.memc:
+			try:
+				if botoweb.memc.incr(_generation_key(c.__name__)) is None:
+					botoweb.memc.set(_generation_key(c.__name__), 1)
+			except Exception:
+				log.exception('Could not invalidate counts for %s' % c.__name__)
+
+def get_count(cls, query_str):
+	"""Cached count for this query, or None"""
+	key = _key(cls, query_str)
+	if botoweb.memc:
+		return botoweb.memc.get(key)
+	entry = _counts.get(key)
+	if entry and entry[0] > time.time():
+		return entry[1]
+	return None
+
+def set_count(cls, query_str, count, ttl=60):
+	"""Cache the count for this query for ttl seconds"""
+	key = _key(cls, query_str)
+	if botoweb.memc:
+		botoweb.memc.set(key, count, ttl)
+		return
+	with _lock:
+		if len(_counts) >= MAX_LOCAL_COUNTS:
+			_counts.clear()
+		_counts[key] = (time.time() + ttl, count)
+
+def cached_count(query, ttl=60):
+	"""Count the results of this query, using the cache if we can"""
+	if not hasattr(query, 'get_query'):
+		return query.count()
+	query_str = query.get_query()
+	count = get_count(query.model_class, query_str)
+	if count is None:
+		count = query.count()
+		set_count(query.model_class, query_str, count, ttl)
+	return count
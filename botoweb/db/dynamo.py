@@ -31,6 +31,7 @@ from boto.dynamodb.table import Table
 from boto.dynamodb import exceptions
 from boto.exception import DynamoDBResponseError, BotoServerError
 from base64 import b32decode, b32encode
+from botoweb.db.retry import RetryPolicy, is_retryable
 
 import logging
 log = logging.getLogger('botoweb.db.dynamo')
@@ -38,6 +39,14 @@ log = logging.getLogger('botoweb.db.dynamo')
 MAX_RETRIES = 10
 
 
+def _is_retryable(e):
+	'''Throttling and server side errors are retried. Any other Dynamo
+	error, like a failed conditional check or a validation error, is
+	the table's answer to the request, so it's raised straight away
+	and doesn't count against the circuit breaker'''
+	return is_retryable(e)
+
+
 class DynamoModel(Item):
 	'''DynamoDB Model.
 	This is just a wrapper around
@@ -48,6 +57,7 @@ class DynamoModel(Item):
 	_table_name = None
 	_properties = None
 	_prop_cache = None
+	_retry = None
 	# Supports CloudSearch
 	_cs_search_endpoint = None
 	_cs_document_endpoint = None
@@ -127,37 +137,35 @@ class DynamoModel(Item):
 		assert(cls._table), 'Table not created for %s' % cls.__name__
 		return cls._table
 
+	@classmethod
+	def get_retry_policy(cls):
+		'''Get the RetryPolicy shared by all calls for this class'''
+		if cls._retry is None:
+			cls._retry = RetryPolicy('DynamoDB', max_attempts=MAX_RETRIES, retryable=_is_retryable)
+		return cls._retry
+
+	@classmethod
+	def _call_table(cls, method, *args, **kwargs):
+		'''Call a method on our table, dropping the cached table
+		on server errors so the next attempt looks it up again'''
+		try:
+			return getattr(cls.get_table(), method)(*args, **kwargs)
+		except BotoServerError:
+			cls._table = None
+			raise
+
 	@classmethod
 	def get_by_id(cls, hash_key, range_key=None, consistent_read=False):
 		'''Get this type of item by a given ID'''
-		attempt = 0
-		last_error = None
-		while attempt < MAX_RETRIES:
-			table = cls.get_table()
-			try:
-				return table.lookup(
-					hash_key=hash_key,
-					range_key=range_key,
-					consistent_read=consistent_read,
-					item_class=cls
-				)
-			except exceptions.DynamoDBKeyNotFoundError:
-				return None
-			except DynamoDBResponseError, e:
-				log.exception('Could not retrieve item')
-				cls._table = None
-				attempt += 1
-				time.sleep(attempt ** 2)
-				last_error = e
-			except BotoServerError, e:
-				log.error('Boto Server Error: %s' % e)
-				cls._table = None
-				attempt += 1
-				last_error = e
-				time.sleep(attempt ** 2)
-
-		if last_error:
-			raise e
+		try:
+			return cls.get_retry_policy().call(cls._call_table, 'lookup',
+				hash_key=hash_key,
+				range_key=range_key,
+				consistent_read=consistent_read,
+				item_class=cls
+			)
+		except exceptions.DynamoDBKeyNotFoundError:
+			return None
 
 	lookup = get_by_id
 
@@ -195,8 +203,6 @@ class DynamoModel(Item):
 			traversal of the index.  Default is forward (True).
 		'''
 
-		attempt = 0
-		last_error = None
 		# Handle Keyword Searches
 		if kwargs:
 			from decimal import Decimal
@@ -221,29 +227,13 @@ class DynamoModel(Item):
 					data[attr_name] = val
 				yield cls.from_dict(data)
 		else:
-			while attempt < MAX_RETRIES:
-				try:
-					for item in cls.get_table().query(hash_key=hash_key,
-						range_key_condition=range_key_condition,
-						request_limit=request_limit,
-						consistent_read=consistent_read,
-						scan_index_forward=scan_index_forward, item_class=cls):
-						yield item
-					return
-				except DynamoDBResponseError, e:
-					log.exception('Dynamo Response Error: %s' % e)
-					cls._table = None
-					attempt += 1
-					last_error = e
-					time.sleep(attempt ** 2)
-				except BotoServerError, e:
-					log.error('Boto Server Error: %s' % e)
-					cls._table = None
-					attempt += 1
-					last_error = e
-					time.sleep(attempt ** 2)
-		if last_error:
-			raise last_error
+			for item in cls.get_retry_policy().iterate(lambda: cls._call_table('query',
+					hash_key=hash_key,
+					range_key_condition=range_key_condition,
+					request_limit=request_limit,
+					consistent_read=consistent_read,
+					scan_index_forward=scan_index_forward, item_class=cls)):
+				yield item
 
 	find = query
 
@@ -540,20 +530,9 @@ class DynamoQuery(Query):
 	def __iter__(self):
 		'''Override this to change how we query this
 		model'''
-		attempt = 0
-		last_error = None
-		while attempt < MAX_RETRIES:
-			try:
-				for item in self.model_class.get_table().scan(item_class=self.model_class, request_limit=self.request_limit):
-					yield item
-				return
-			except DynamoDBResponseError, e:
-				log.exception('could not execute scan')
-				self.model_class._table = None
-				attempt += 1
-				last_error = e
-		if last_error:
-			raise last_error
+		cls = self.model_class
+		return cls.get_retry_policy().iterate(lambda: cls._call_table('scan',
+			item_class=cls, request_limit=self.request_limit))
 
 	def count(self, quick=True):
 		'''Can't get counts from DynamoDB'''
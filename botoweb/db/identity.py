@@ -0,0 +1,79 @@
+# Copyright (c) 2014 Chris Moyer http://coredumped.org/
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+# Author: Chris Moyer http://coredumped.org/
+# Description: Per-request identity map. While one is active in a
+# thread, every object fetched by ID is remembered, so fetching the same
+# ID again in that request returns the same object without another
+# round trip to the datastore.
+#
+#	with identity_map():
+#		a = Model.get_by_id(id)
+#		b = Model.get_by_id(id)
+#		assert a is b
+
+import threading
+
+_local = threading.local()
+
+def current_map():
+	"""The IdentityMap active in this thread, or None"""
+	stack = getattr(_local, 'stack', None)
+	if stack:
+		return stack[-1]
+	return None
+
+
+class IdentityMap(object):
+	"""Objects loaded in this request, by ID"""
+
+	def __init__(self):
+		self.objects = {}
+
+	def get(self, id):
+		"""Get the object with this ID, or None"""
+		return self.objects.get(id)
+
+	def add(self, obj):
+		if obj is not None and obj.id:
+			self.objects[obj.id] = obj
+		return obj
+
+	def discard(self, id):
+		self.objects.pop(id, None)
+
+	def clear(self):
+		self.objects = {}
+
+	def __len__(self):
+		return len(self.objects)
+
+	def __enter__(self):
+		if getattr(_local, 'stack', None) is None:
+			_local.stack = []
+		_local.stack.append(self)
+		return self
+
+	def __exit__(self, exc_type, exc_value, tb):
+		_local.stack.remove(self)
+		return False
+
+identity_map = IdentityMap
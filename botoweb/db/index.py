@@ -203,7 +203,7 @@ class Index(object):
 		:type obj: `botoweb.db.model.Model`
 		"""
 		for name in self.get_obj_props(obj):
-			self.add(name, obj.id, class_name=obj.__class__.__name__, module_name=obj.__module__, db_name=obj._manager.domain.name)
+			self.add(name, obj.id, class_name=obj.__class__.__name__, module_name=obj.__module__, db_name=obj._manager.db_name)
 
 	def search_object(self, name, consistent_read=False):
 		"""Wrapper around the "search" function that returns 
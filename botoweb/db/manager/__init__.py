@@ -20,6 +20,9 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
 # IN THE SOFTWARE.
 import boto
+import uuid
+from botoweb.db.retry import RetryPolicy
+from botoweb.exceptions import NotFound
 
 def get_manager(cls):
 	"""
@@ -37,10 +40,19 @@ def get_manager(cls):
 		db_passwd = <another aws secret access key>
 		db_name = basic_domain
 		db_port = 1111
+		[DB_TestSharded]
+		shards = 4
+		[DB_TestLog]
+		partition_by = created_at
+		partition_period = month
 	
 	The values in the DB section are "generic values" that will be used if nothing more
 	specific is found.  You can also create a section for a specific Model class that
 	gives the db info for that class.  In the example above, TestBasic is a Model subclass.
+	A SimpleDB class with "shards" set in its section is spread over that many domains,
+	see :class:`~botoweb.db.manager.shardedmanager.ShardedSDBManager`, and one with
+	"partition_by" set is stored in one domain per month (or partition_period), see
+	:class:`~botoweb.db.manager.partitionedmanager.PartitionedSDBManager`.
 	"""
 	db_user = boto.config.get('DB', 'db_user', None)
 	db_passwd = boto.config.get('DB', 'db_passwd', None)
@@ -52,6 +64,9 @@ def get_manager(cls):
 	enable_ssl = boto.config.getbool('DB', 'enable_ssl', True)
 	sql_dir = boto.config.get('DB', 'sql_dir', None)
 	debug = boto.config.getint('DB', 'debug', 0)
+	shards = 1
+	reshard_to = None
+	partition_by = None
 	# first see if there is a fully qualified section name in the Boto config file
 	module_name = cls.__module__.replace('.', '_')
 	db_section = 'DB_' + module_name + '_' + cls.__name__
@@ -67,6 +82,9 @@ def get_manager(cls):
 		db_port = boto.config.getint(db_section, 'db_port', db_port)
 		enable_ssl = boto.config.getint(db_section, 'enable_ssl', enable_ssl)
 		debug = boto.config.getint(db_section, 'debug', debug)
+		shards = boto.config.getint(db_section, 'shards', shards)
+		reshard_to = boto.config.getint(db_section, 'reshard_to', 0) or None
+		partition_by = boto.config.get(db_section, 'partition_by', None)
 	elif hasattr(cls, "_db_name") and cls._db_name is not None:
 		# More specific then the generic DB config is any _db_name class property
 		db_name = cls._db_name
@@ -76,7 +94,19 @@ def get_manager(cls):
 	if hasattr(cls, '_db_type') and cls._db_type is not None:
 		db_type = cls._db_type
 
-	if db_type == 'SimpleDB':
+	if db_type == 'SimpleDB' and partition_by:
+		from botoweb.db.manager.partitionedmanager import PartitionedSDBManager
+		return PartitionedSDBManager(cls, db_name, db_user, db_passwd,
+						  db_host, db_port, db_table, sql_dir, enable_ssl,
+						  partition_by=partition_by,
+						  period=boto.config.get(db_section, 'partition_period', 'month'),
+						  retain=boto.config.getint(db_section, 'partition_retain', 0) or None)
+	elif db_type == 'SimpleDB' and (shards > 1 or reshard_to):
+		from botoweb.db.manager.shardedmanager import ShardedSDBManager
+		return ShardedSDBManager(cls, db_name, db_user, db_passwd,
+						  db_host, db_port, db_table, sql_dir, enable_ssl,
+						  shards=shards, reshard_to=reshard_to)
+	elif db_type == 'SimpleDB':
 		from botoweb.db.manager.sdbmanager import SDBManager
 		return SDBManager(cls, db_name, db_user, db_passwd,
 						  db_host, db_port, db_table, sql_dir, enable_ssl)
@@ -118,6 +148,9 @@ class Manager(object):
 		if consistent == None and hasattr(cls, '__consistent__'):
 			consistent = cls.__consistent__
 		self.consistent = consistent
+		# All calls to the datastore should go through this policy,
+		# which shares one circuit breaker per endpoint
+		self.retry = RetryPolicy('%s:%s' % (self.__class__.__name__, db_host))
 		if self._converter_class is not None:
 			self.converter = self._converter_class(self)
 		else:
@@ -147,8 +180,38 @@ class Manager(object):
 	def decode_value(self, prop, value):
 		return self.converter.decode_prop(prop, value)
 
+	def new_id(self, obj):
+		"""ID for a new object"""
+		return str(uuid.uuid4())
+
 	def get_object_from_id(self, id):
 		return self.get_object(None, id)
 
+	def get_objects(self, cls, ids, max_workers=None):
+		"""Get several objects by ID, in the same order as ids, with
+		None for any that don't exist. Managers which can fetch many
+		objects in one request override this"""
+		objs = []
+		for id in ids:
+			try:
+				objs.append(self.get_object(cls, id))
+			except NotFound:
+				objs.append(None)
+		return objs
+
+	def save_objects(self, objs, max_workers=None):
+		"""Save several objects at once. Managers which support
+		batch writes override this, by default we just save each one"""
+		for obj in objs:
+			self.save_object(obj)
+		return objs
+
+	def delete_objects(self, objs, max_workers=None):
+		"""Delete several objects at once. Managers which support
+		batch deletes override this, by default we just delete each one"""
+		for obj in objs:
+			self.delete_object(obj)
+		return objs
+
 	def lookup(self, id):
 		return self.get_object(None, id)
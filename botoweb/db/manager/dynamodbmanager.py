@@ -148,12 +148,12 @@ class DynamoDBManager(Manager):
 			expected_value[1] = v
 
 		# Save
-		raw_item.put(expected_value=expected_value)
+		self.retry(raw_item.put, expected_value=expected_value)
 		return obj
 
 	def get_raw_item(self, obj):
 		try:
-			return self.table.lookup(obj.id)
+			return self.retry(self.table.lookup, obj.id)
 		except boto.dynamodb.exceptions.DynamoDBKeyNotFoundError:
 			return self.table.new_item(obj.id)
 
@@ -176,7 +176,7 @@ class DynamoDBManager(Manager):
 
 	def get_object(self, cls, id, a=None):
 		try:
-			raw_item = self.table.lookup(id)
+			raw_item = self.retry(self.table.lookup, id)
 		except boto.dynamodb.exceptions.DynamoDBKeyNotFoundError:
 			raise botoweb.exceptions.NotFound('Could not find %s "%s"' % (cls.__name__, id))
 
@@ -190,6 +190,23 @@ class DynamoDBManager(Manager):
 		obj._loaded = True
 		return obj
 
+	def get_objects(self, cls, ids, max_workers=None):
+		"""Get several objects by ID with BatchGetItem. Objects are
+		returned in the same order as ids, with None for any that
+		don't exist."""
+		found = {}
+		for raw_item in self.retry.iterate(lambda: self.table.batch_get_item(list(ids))):
+			params = {}
+			for prop in cls.properties(hidden=False):
+				if raw_item.has_key(prop.name):
+					value = self.decode_value(prop, raw_item[prop.name])
+					value = prop.make_value_from_datastore(value)
+					params[prop.name] = value
+			obj = cls(raw_item['__id__'], **params)
+			obj._loaded = True
+			found[obj.id] = obj
+		return [found.get(id) for id in ids]
+
 	#
 	# Searching and querying come out of CloudSearch
 	# 
@@ -0,0 +1,279 @@
+# Copyright (c) 2014 Chris Moyer http://coredumped.org/
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+# Author: Chris Moyer http://coredumped.org/
+# Description: Storing log-like classes in one SDB domain per period
+# of time, by the value of one of their DateTimeProperties when they
+# are created. Enable it in the class's own config section:
+#
+#	[DB_AuditLog]
+#	partition_by = created_at
+#	partition_period = month
+#	partition_retain = 24
+#
+# The period can be "year", "month" or "day", and the partition for
+# March 2014 is stored in "<db_name>_201403". New objects get an ID
+# starting with their partition ("201403_<uuid>"), so reading one by ID
+# only touches its own partition, while queries only search the
+# partitions their filters on partition_by overlap. The property should
+# not change once the object is created, as objects are never moved.
+# Objects stored before partitioning was turned on stay in "<db_name>",
+# which is searched by every query for as long as it exists.
+#
+# Partitions older than partition_retain periods can be deleted with
+# bw_drop_partitions, or PartitionedSDBManager.drop_partitions.
+
+import re
+import time
+import uuid
+from datetime import datetime, date, timedelta
+
+import boto
+from botoweb.db.manager.sdbmanager import SDBManager
+from botoweb.db import count_cache
+
+import logging
+log = logging.getLogger('botoweb.db.manager.partitionedmanager')
+
+# strftime format of the partition key, for each period
+PERIODS = {
+	'year': '%Y',
+	'month': '%Y%m',
+	'day': '%Y%m%d',
+}
+
+
+def partition_key(value, period):
+	"""Key of the partition a date or datetime falls in"""
+	return value.strftime(PERIODS[period])
+
+
+def periods_ago(value, periods, period):
+	"""Start of the period this many periods before value"""
+	if period == 'year':
+		return date(value.year - periods, 1, 1)
+	if period == 'month':
+		months = value.year * 12 + value.month - 1 - periods
+		return date(months // 12, months % 12 + 1, 1)
+	return value - timedelta(days=periods)
+
+
+class PartitionedSDBManager(SDBManager):
+	"""
+	SimpleDB Manager which stores objects in one domain per period
+
+	:param partition_by: Name of the DateTimeProperty to partition on
+	:type partition_by: str
+
+	:param period: "year", "month" or "day"
+	:type period: str
+
+	:param retain: Number of periods to keep, including the current one,
+		or None to keep everything
+	:type retain: int
+	"""
+
+	def __init__(self, cls, db_name, db_user, db_passwd,
+				 db_host, db_port, db_table, ddl_dir, enable_ssl, consistent=None,
+				 partition_by=None, period='month', retain=None):
+		SDBManager.__init__(self, cls, db_name, db_user, db_passwd,
+			db_host, db_port, db_table, ddl_dir, enable_ssl, consistent)
+		if period not in PERIODS:
+			raise ValueError('Unknown partition_period: %s' % period)
+		self.partition_by = partition_by
+		self.period = period
+		self.retain = retain
+		# Seconds before we list the domains again, to see partitions
+		# created by other processes
+		self.refresh_after = boto.config.getint('DB', 'partition_refresh', 300)
+		# Or this many, when asked for a partition we haven't seen
+		self.miss_refresh = boto.config.getint('DB', 'partition_miss_refresh', 10)
+		self._key_length = len(partition_key(date(2000, 1, 1), period))
+		self._name_pattern = re.compile(r'^%s_(\d{%s})$' % (re.escape(db_name), self._key_length))
+		self._partitions = None
+		self._legacy = False
+		self._listed_at = 0
+
+	def partition_name(self, key):
+		"""Name of the domain for a partition"""
+		return '%s_%s' % (self.db_name, key)
+
+	def partitions(self):
+		"""Dict of partition key -> domain, for every partition that exists"""
+		if self._partitions is None or time.time() - self._listed_at > self.refresh_after:
+			partitions = {}
+			legacy = False
+			next_token = None
+			while True:
+				rs = self.retry(self.sdb.get_all_domains, next_token=next_token)
+				for domain in rs:
+					match = self._name_pattern.match(domain.name)
+					if match:
+						partitions[match.group(1)] = domain
+					elif domain.name == self.db_name:
+						legacy = True
+				next_token = rs.next_token
+				if not next_token:
+					break
+			self._partitions = partitions
+			self._legacy = legacy
+			self._listed_at = time.time()
+		return self._partitions
+
+	def create_partition(self, key):
+		"""Create the domain for a partition, if it doesn't exist yet"""
+		domain = self.retry(self.sdb.create_domain, self.partition_name(key))
+		self.partitions()[key] = domain
+		log.info('Created partition %s' % domain.name)
+		return domain
+
+	def new_id(self, obj):
+		"""IDs start with the key of the object's partition"""
+		value = getattr(obj, self.partition_by, None)
+		if not isinstance(value, date):
+			value = datetime.utcnow()
+		return '%s_%s' % (partition_key(value, self.period), uuid.uuid4())
+
+	def _id_key(self, id):
+		"""Partition key an ID starts with, or None for older objects"""
+		if id and id[self._key_length:self._key_length + 1] == '_' and id[:self._key_length].isdigit():
+			return id[:self._key_length]
+		return None
+
+	def domain_for(self, id):
+		"""
+		The partition an ID starts with, or None if there's no such
+		partition, so the item can't exist
+		"""
+		key = self._id_key(id)
+		if key is None:
+			return self.domain
+		domain = self.partitions().get(key)
+		if domain is None and time.time() - self._listed_at > self.miss_refresh:
+			# Another process may have just created it
+			self._partitions = None
+			domain = self.partitions().get(key)
+		return domain
+
+	def query_domains(self, cls, filters):
+		"""Partitions overlapping the range filtered on, oldest first"""
+		partitions = self.partitions()
+		(lo, hi) = self._key_range(cls, filters)
+		keys = [k for k in sorted(partitions) if (lo is None or k >= lo) and (hi is None or k <= hi)]
+		domains = [partitions[k] for k in keys]
+		if self._legacy:
+			domains.insert(0, self.domain)
+		return domains
+
+	def _key_range(self, cls, filters):
+		"""
+		The (first, last) partition keys a query can match, from its
+		filters on partition_by, with None where there's no limit
+		"""
+		lo = hi = None
+		if isinstance(filters, basestring):
+			return (lo, hi)
+		for props, value in filters:
+			if isinstance(props, list):
+				continue
+			(name, op) = props.strip().split(" ", 1)
+			op = op.strip()
+			if name != self.partition_by:
+				continue
+			if not isinstance(value, list):
+				value = [value]
+			keys = [self._value_key(cls, v) for v in value]
+			if not keys or None in keys:
+				continue
+			if op in ('=', 'is'):
+				(first, last) = (min(keys), max(keys))
+			elif op in ('>', '>='):
+				(first, last) = (min(keys), None)
+			elif op in ('<', '<='):
+				(first, last) = (None, max(keys))
+			else:
+				continue
+			if first is not None and (lo is None or first > lo):
+				lo = first
+			if last is not None and (hi is None or last < hi):
+				hi = last
+		return (lo, hi)
+
+	def _value_key(self, cls, value):
+		"""Partition key of a value filtered on, or None"""
+		if isinstance(value, basestring):
+			try:
+				value = self.converter.decode_datetime(value)
+			except Exception:
+				return None
+		if not isinstance(value, date):
+			return None
+		return partition_key(value, self.period)
+
+	def _create_partitions(self, objs):
+		"""Give new objects their IDs, and create any partitions they need"""
+		for obj in objs:
+			if not obj.id:
+				obj.id = self.new_id(obj)
+			key = self._id_key(obj.id)
+			if key is not None and key not in self.partitions():
+				self.create_partition(key)
+
+	def save_object(self, obj, expected_value=None):
+		self._create_partitions([obj])
+		return SDBManager.save_object(self, obj, expected_value)
+
+	def save_objects(self, objs, max_workers=None):
+		self._create_partitions(objs)
+		return SDBManager.save_objects(self, objs, max_workers)
+
+	def expired_partitions(self, before=None, now=None):
+		"""
+		Keys of the partitions older than retain periods, or
+		which end before the date given
+		"""
+		if before is None:
+			if not self.retain:
+				return []
+			before = periods_ago(now or datetime.utcnow(), self.retain - 1, self.period)
+		cutoff = partition_key(before, self.period)
+		return [key for key in sorted(self.partitions()) if key < cutoff]
+
+	def drop_partitions(self, before=None):
+		"""
+		Delete the domains of old partitions, along with everything
+		in them. By default this is every partition older than retain
+		periods.
+
+		:param before: Drop the partitions ending before this date instead
+		:type before: :class:`datetime.date`
+
+		:return: Keys of the partitions dropped
+		:rtype: list
+		"""
+		keys = self.expired_partitions(before)
+		for key in keys:
+			self.retry(self.sdb.delete_domain, self.partition_name(key))
+			self.partitions().pop(key, None)
+			log.info('Dropped partition %s' % self.partition_name(key))
+		if keys:
+			count_cache.invalidate(self.cls)
+		return keys
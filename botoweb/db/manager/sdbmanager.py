@@ -25,16 +25,51 @@ import ssl
 from boto.utils import find_class
 import uuid
 import re
-from time import sleep
+import itertools
+import time
 from botoweb.db.blob import Blob
 from boto.exception import SDBPersistenceError, S3ResponseError
-from botoweb.db.property import ListProperty
+from botoweb.db.property import ListProperty, SetProperty, MapProperty, JSONProperty
 from botoweb.db.converter import StringConverter
 from botoweb.db.manager import Manager
+from botoweb.db.query import Query
+from botoweb.db.retry import RetryPolicy
+from botoweb.db.parallel import parallel_map, chunks
+from botoweb.db import count_cache
+from botoweb.db import offset_cache
+from botoweb.db import object_cache
+from botoweb.db import consistency
+from botoweb.db.readahead import ReadAheadResultSet
+from botoweb.db import planner
 
 import logging
 log = logging.getLogger('botoweb.db.manager.sdbmanager')
 
+# Values of these properties can be changed in place, without going
+# through Property.__set__, so they are always compared on save
+MUTABLE_PROPERTIES = (ListProperty, SetProperty, MapProperty, JSONProperty)
+
+def _raw_values(value):
+	"""Plain values of an encoded list, with the "NNN:" keys taken off"""
+	if not value:
+		return []
+	if not isinstance(value, list):
+		value = [value]
+	return sorted(set([v.split(":", 1)[-1] for v in value]))
+
+def _attr_changed(stored, name, value):
+	"""Check if an encoded value differs from what is stored in SDB"""
+	if name not in stored:
+		return value is not None
+	old = stored[name]
+	if isinstance(old, list) or isinstance(value, list):
+		if not isinstance(old, list):
+			old = [old]
+		if not isinstance(value, list):
+			value = [value]
+		return sorted(old) != sorted(value)
+	return old != value
+
 class SDBConverter(StringConverter):
 	"""SDBConverter is just a StringConverter with special Blob property handling"""
 
@@ -69,48 +104,142 @@ class SDBConverter(StringConverter):
 		if match:
 			s3 = self.manager.get_s3_connection()
 			bucket = s3.get_bucket(match.group(1), validate=False)
-			# Try to retrieve the blob up to five times
-			error = None
-			for attempt in range(0,5):
-				try:
-					key = bucket.get_key(match.group(2))
-				except S3ResponseError, e:
-					error = e
-					log.exception(e)
-					if e.reason != 'Forbidden':
-						sleep(attempt**2)
-						continue
-					return None
-				except Exception, e:
-					log.exception(e)
-					sleep(attempt**2)
-					error = e
-					continue
-				else:
-					error = None
-					break
+			try:
+				key = self.manager.s3_retry(bucket.get_key, match.group(2))
+			except S3ResponseError, e:
+				if e.reason != 'Forbidden':
+					raise
+				log.exception(e)
+				return None
 		else:
 			return None
-		if error:
-			raise error
 		if key:
 			return Blob(file=key, id='s3://%s/%s' % (key.bucket.name, key.name))
 		else:
 			return None
 
 
+# Most query shapes to keep FilterTemplates for
+MAX_TEMPLATES = 1000
+
+class FilterTemplate(object):
+	"""
+	The where clause for one shape of query: the class, the properties
+	and operators filtered on, and the sort and select. Everything that
+	doesn't depend on the values is worked out once, so rendering the
+	clause only encodes and escapes the values.
+	"""
+
+	def __init__(self, manager, cls, shape, order_by=None, select=None):
+		self.manager = manager
+		self.cls = cls
+		self.head = []
+		self.tail = []
+		self.order_by_query = ""
+		order_by_filtered = False
+
+		if order_by:
+			if order_by[0] == "-":
+				order_by_method = "DESC"
+				order_by = order_by[1:]
+			else:
+				order_by_method = "ASC"
+
+		if select:
+			if order_by and order_by in select:
+				order_by_filtered = True
+			self.head.append("(%s)" % select)
+
+		# One list of (property, term encoder, joiner, in encoder) for each filter
+		self.filters = []
+		for filter_props, is_list in shape:
+			if not isinstance(filter_props, tuple):
+				filter_props = [filter_props]
+			slots = []
+			for filter_prop in filter_props:
+				(name, op) = filter_prop.strip().split(" ", 1)
+				property = cls.find_property(name)
+				if name == order_by:
+					order_by_filtered = True
+				joiner = " OR "
+				if op in ["not like", "not", "!="]:
+					joiner = " AND "
+				slots.append((property, manager._term_encoder(property, name, op), joiner,
+					manager._in_encoder(property, name, op)))
+			self.filters.append((slots, is_list))
+
+		if order_by:
+			if not order_by_filtered:
+				self.tail.append("`%s` LIKE '%%'" % order_by)
+			if order_by in ["__id__", "itemName()"]:
+				self.order_by_query = " ORDER BY itemName() %s" % order_by_method
+			else:
+				self.order_by_query = " ORDER BY `%s` %s" % (order_by, order_by_method)
+
+	def render(self, filters):
+		"""The where clause for these filter values"""
+		encode = self.manager.encode_value
+		query_parts = list(self.head)
+		for (slots, is_list), filter in zip(self.filters, filters):
+			value = filter[1]
+			filter_parts = []
+			for property, term, joiner, in_term in slots:
+				if is_list:
+					vals = []
+					for val in value:
+						val = encode(property, val)
+						if isinstance(val, list):
+							vals.extend(val)
+						else:
+							vals.append(val)
+					if in_term and None not in vals:
+						filter_parts.append("(%s)" % in_term(vals))
+					else:
+						filter_parts.append("(%s)" % joiner.join([term(v) for v in vals]))
+				else:
+					val = encode(property, value)
+					if isinstance(val, list):
+						filter_parts.extend([term(v) for v in val])
+					else:
+						filter_parts.append(term(val))
+			query_parts.append("(%s)" % " or ".join(filter_parts))
+		# Looked up every time, subclasses may be defined later
+		query_parts.append(self.manager._type_query(self.cls))
+		query_parts.extend(self.tail)
+		return "WHERE %s %s" % (" AND ".join(query_parts), self.order_by_query)
+
+
 class SDBManager(Manager):
 	"""SimpleDB Manager"""
 	_converter_class = SDBConverter
+	# Cache the attributes of classes with __cache_ttl__ set
+	use_object_cache = True
 	
 	def __init__(self, cls, db_name, db_user, db_passwd,
 				 db_host, db_port, db_table, ddl_dir, enable_ssl, consistent=None):
 		Manager.__init__(self, cls, db_name, db_user, db_passwd,
 			db_host, db_port, db_table, ddl_dir, enable_ssl, consistent)
 		self.s3 = None
+		self.s3_retry = RetryPolicy('S3')
 		self.bucket = None
 		self._sdb = None
 		self._domain = None
+		self.unique_index = None
+		# Filters with more OR'd values than this are split into several selects
+		self.max_or_values = boto.config.getint('DB', 'max_or_values', 20)
+		# Most selects one query's sub-query results may be split into
+		self.max_subquery_selects = boto.config.getint('DB', 'max_subquery_selects', 100)
+		# "type" matches subclasses by __type__, "lineage" by __lineage__
+		self.type_filter = boto.config.get('DB', 'type_filter', 'type')
+		self._templates = {}
+		self._archive = None
+		# Match ListProperties with shadow set on their raw values, turn
+		# this off until backfill_shadows has been run
+		self.list_shadow_queries = boto.config.getbool('DB', 'list_shadow_queries', True)
+		unique_domain = boto.config.get('DB', 'unique_domain', None)
+		if unique_domain:
+			from botoweb.db.unique import UniqueIndex
+			self.unique_index = UniqueIndex(self, unique_domain)
 
 	@property
 	def sdb(self):
@@ -139,9 +268,25 @@ class SDBManager(Manager):
 		# It's much more efficient to do it this way rather than
 		# having this make a roundtrip each time to validate.
 		# The downside is that if the domain doesn't exist, it breaks
-		self._domain = self._sdb.lookup(self.db_name, validate=False)
-		if not self._domain:
-			self._domain = self._sdb.create_domain(self.db_name)
+		self._domain = self._get_domain(self.db_name)
+
+	def _get_domain(self, name):
+		"""Look up a domain, creating it if it doesn't exist yet"""
+		domain = self.sdb.lookup(name, validate=False)
+		if not domain:
+			domain = self.sdb.create_domain(name)
+		return domain
+
+	def domain_for(self, id):
+		"""
+		The domain the item with this ID is stored in, or None if
+		there's nowhere it could be stored
+		"""
+		return self.domain
+
+	def query_domains(self, cls, filters):
+		"""The domains a query with these filters has to search"""
+		return [self.domain]
 
 	def get_s3_connection(self):
 		if not self.s3:
@@ -151,7 +296,7 @@ class SDBManager(Manager):
 
 	def get_blob_bucket(self, bucket_name=None):
 		s3 = self.get_s3_connection()
-		bucket_name = '%s-%s' % (boto.config.get('DB', 'blob_bucket_prefix', s3.aws_access_key_id), self.domain.name)
+		bucket_name = '%s-%s' % (boto.config.get('DB', 'blob_bucket_prefix', s3.aws_access_key_id), self.db_name)
 		bucket_name = bucket_name.lower()
 		try:
 			self.bucket = s3.get_bucket(bucket_name)
@@ -162,9 +307,13 @@ class SDBManager(Manager):
 	def load_object(self, obj):
 		if not obj._loaded:
 			obj._validate = False
-			a = self.domain.get_attributes(obj.id,consistent_read=self.consistent)
+			a = self._get_attributes(obj.__class__, obj.id)
+			# Don't overwrite anything changed on a partially loaded object
+			dirty = obj._dirty
 			if a.has_key('__type__'):
 				for prop in obj.properties(hidden=False):
+					if dirty and prop.name in dirty:
+						continue
 					if a.has_key(prop.name):
 						value = self.decode_value(prop, a[prop.name])
 						value = prop.make_value_from_datastore(value)
@@ -172,13 +321,17 @@ class SDBManager(Manager):
 							setattr(obj, prop.name, value)
 						except Exception, e:
 							log.exception(e)
+				obj._mark_clean(a)
+				if dirty:
+					obj._dirty = dirty
+			obj._partial = None
 			obj._loaded = True
 			obj._validate = True
 		
 	def get_object(self, cls, id, a=None):
 		obj = None
 		if not a:
-			a = self.domain.get_attributes(id,consistent_read=self.consistent)
+			a = self._get_attributes(cls, id)
 		if a.has_key('__type__'):
 			if not cls or a['__type__'] != cls.__name__:
 				cls = find_class(a['__module__'], a['__type__'])
@@ -191,165 +344,766 @@ class SDBManager(Manager):
 						params[prop.name] = value
 				obj = cls(id, **params)
 				obj._loaded = True
+				obj._mark_clean(a)
 			else:
 				s = '(%s) class %s.%s not found' % (id, a['__module__'], a['__type__'])
 				log.info('sdbmanager: %s' % s)
 		return obj
-		
+
+	def _get_attributes(self, cls, id):
+		"""
+		Stored attributes of an item, from the object cache if the
+		class has __cache_ttl__ set. Cache misses are read consistently,
+		so an item isn't cached as it was before its last write.
+		"""
+		ttl = self._cache_ttl(cls)
+		consistent = self._consistent(id)
+		if ttl and not consistent:
+			a = object_cache.get(self.cls, id)
+			if a is not None:
+				return a
+			consistent = True
+		domain = self.domain_for(id)
+		if domain is None:
+			return {}
+		read_at = time.time()
+		a = self.retry(domain.get_attributes, id, consistent_read=consistent)
+		if ttl:
+			object_cache.put(self.cls, id, a, ttl, read_at)
+		return a
+
+	def _cache_ttl(self, cls=None):
+		"""Seconds objects of this class are cached for, 0 if they aren't"""
+		if not self.use_object_cache:
+			return 0
+		return object_cache.cache_ttl(cls or self.cls)
+
+	def _consistent(self, id=None):
+		"""
+		Whether to use a consistent read, for an item or (without an ID)
+		a query. Besides classes which are always read consistently,
+		this is anything the current session wrote in the last few
+		seconds, see :mod:`botoweb.db.consistency`.
+		"""
+		if self.consistent:
+			return True
+		tracker = consistency.current_tracker()
+		return tracker is not None and tracker.is_recent(self.cls, id)
+
+	def _written(self, objs):
+		"""
+		Called once objects are written: removes them from the object
+		cache, and records them so this session reads them back
+		consistently
+		"""
+		tracker = consistency.current_tracker()
+		if tracker is not None:
+			tracker.record(self.cls, [obj.id for obj in objs])
+		if not self.use_object_cache:
+			return
+		ids = [obj.id for obj in objs if object_cache.cache_ttl(obj.__class__) or object_cache.cache_ttl(self.cls)]
+		if ids:
+			object_cache.invalidate(self.cls, ids)
+
+	def get_objects(self, cls, ids, max_workers=None):
+		"""
+		Get several objects by ID using "itemName() in (...)" selects of
+		20 IDs each, running up to max_workers selects at once.
+		Objects are returned in the same order as ids, with None for
+		any that don't exist. For cached classes only the IDs that
+		aren't in the object cache are selected.
+		"""
+		found = {}
+		missing = ids
+		if self._cache_ttl(cls):
+			# Items this session just wrote are read from SDB
+			cached = object_cache.get_multi(self.cls, [id for id in ids if not self._consistent(id)])
+			for name, a in cached.items():
+				if a:
+					found[name] = self.get_object(cls, name, a)
+			missing = [id for id in ids if id not in cached]
+		found.update(self._fetch_objects(cls, missing, max_workers))
+		return [found.get(id) for id in ids]
+
+	def _fetch_objects(self, cls, ids, max_workers=None):
+		"""
+		Select objects by ID, 20 at a time, and add them (or the fact
+		they don't exist) to the object cache for cached classes. Those
+		are selected consistently, like in :meth:`_get_attributes`.
+
+		:return: Dict of ID -> object, for the IDs that were found
+		:rtype: dict
+		"""
+		ttl = self._cache_ttl(cls)
+		# Worked out here, the write tracker isn't seen by the worker threads
+		recent = set([id for id in ids if self._consistent(id)])
+		def fetch(job):
+			(domain, chunk) = job
+			query_str = "select * from `%s` where itemName() in (%s)" % (domain.name,
+				", ".join(["'%s'" % id.replace("'", "''") for id in chunk]))
+			consistent = bool(ttl) or bool(recent.intersection(chunk))
+			return [(item.name, item) for item in self.retry.iterate(
+				lambda: domain.select(query_str, consistent_read=consistent))]
+		found = {}
+		fetched = {}
+		read_at = time.time()
+		for items in parallel_map(fetch, self._domain_chunks(ids, lambda id: id, 20), max_workers):
+			for name, item in items:
+				fetched[name] = item
+				found[name] = self.get_object(cls, name, item)
+		if ttl and ids:
+			object_cache.put_multi(self.cls, dict((id, fetched.get(id, {})) for id in ids), ttl, read_at)
+		return found
+
+	def _domain_chunks(self, items, get_id, size):
+		"""
+		Split items into (domain, chunk) pairs of at most size items,
+		with every item in a chunk stored in the same domain. Items
+		which can't be stored anywhere are left out.
+
+		:param get_id: Function which returns the ID of an item
+		:type get_id: function
+		"""
+		groups = []
+		index = {}
+		for item in items:
+			domain = self.domain_for(get_id(item))
+			if domain is None:
+				continue
+			if domain.name not in index:
+				index[domain.name] = len(groups)
+				groups.append((domain, []))
+			groups[index[domain.name]][1].append(item)
+		return [(domain, chunk) for (domain, group) in groups for chunk in chunks(group, size)]
+
 	def query(self, query):
-		query_str = "select * from `%s` %s" % (self.domain.name, self._build_filter_part(query.model_class, query.filters, query.sort_by, query.select))
-		if query.limit:
-			query_str += " limit %s" % query.limit
-		rs = self.domain.select(query_str, max_items=query.limit, next_token = query.next_token)
+		split = self._split_filters(query.model_class, query.filters)
+		domains = self.query_domains(query.model_class, query.filters)
+		selects = self._split_select(query.select)
+		# No domains at all just gives an empty merge
+		merged = split or len(domains) != 1 or len(selects) != 1
+		hydrate = getattr(query, "hydrate", False) and not query.fields and self._cache_ttl(query.model_class)
+		output = "*"
+		if hydrate:
+			# Just the IDs, and whatever the merge needs to see
+			names = []
+			if split:
+				names = self._split_names(query.model_class, query.filters[split[0]], query.sort_by)
+			elif merged and query.sort_by:
+				names = [query.sort_by.lstrip("-")]
+			if len(selects) != 1:
+				names += query.select.names
+			names = [n for n in names if n not in ("__id__", "itemName()")]
+			output = ", ".join(["`%s`" % name for name in names]) or "itemName()"
+		elif query.fields:
+			names = ['__type__', '__module__', '__lineage__'] + list(query.fields)
+			if split:
+				# The merge needs the split and sort attributes
+				names += self._split_names(query.model_class, query.filters[split[0]], query.sort_by)
+			elif merged and query.sort_by:
+				names.append(query.sort_by.lstrip("-"))
+			if len(selects) != 1:
+				names += [n for n in query.select.names if n != "itemName()"]
+			output = ", ".join(["`%s`" % name for name in names])
+		offset = getattr(query, "offset", 0) or 0
+		if merged:
+			rs = self._merged_query(query, output, domains, split, selects)
+			objs = rs
+			if offset:
+				# The merged results are skipped through one by one
+				if query.limit:
+					rs.max_items = query.limit + offset
+				objs = itertools.islice(rs, offset, None)
+		else:
+			domain = domains[0]
+			filter_part = self._build_filter_part(query.model_class, query.filters, query.sort_by, selects[0])
+			query_str = "select %s from `%s` %s" % (output, domain.name, filter_part)
+			if query.limit:
+				query_str += " limit %s" % query.limit
+			next_token = query.next_token
+			if offset:
+				next_token = self._skip(query.model_class, filter_part, offset, next_token, domain)
+				if next_token is False:
+					# There are no more than offset results
+					query.rs = ReadAheadResultSet(domain, query_str)
+					return iter([])
+			# Each page is retried on its own, and later pages are fetched
+			# while the caller works through the current one
+			rs = ReadAheadResultSet(domain, query_str, max_items=query.limit,
+				next_token=next_token, consistent_read=self._consistent(), retry=self.retry)
+			objs = rs
+			if offset and query.limit and query.next_token is None:
+				# Paging on by offset, so the next page needn't count
+				objs = self._offset_lister(query.model_class, filter_part, rs, offset, query.limit)
 		query.rs = rs
-		return self._object_lister(query.model_class, rs)
+		if hydrate:
+			return self._hydrated_lister(query, objs)
+		objs = self._object_lister(query.model_class, objs)
+		if query.fields:
+			objs = self._partial_lister(objs, query.fields)
+		return objs
+
+	def _skip(self, cls, filter_part, offset, next_token=None, domain=None):
+		"""
+		Get the next_token which starts offset results into a query,
+		counting through the results with "select count(*) ... limit N"
+		so none of the items are transferred. Tokens found this way are
+		cached, so we only count from the nearest offset we already know.
+		Returns False if there are no results past the offset.
+
+		:param filter_part: The query, as built by _build_filter_part
+		:type filter_part: str
+
+		:param next_token: Count from here instead of from the start,
+			nothing is cached when this is given
+		:type next_token: str
+
+		:param domain: Domain to query, by default our own
+		"""
+		if domain is None:
+			domain = self.domain
+		position = 0
+		cache = next_token is None
+		if cache:
+			position, next_token = offset_cache.nearest(cls, filter_part, offset)
+		while position < offset:
+			query_str = "select count(*) from `%s` %s limit %s" % (domain.name, filter_part, min(offset - position, 2500))
+			rs = self.retry(domain.connection.select, domain, query_str,
+				next_token=next_token, consistent_read=self._consistent())
+			for row in rs:
+				position += int(row['Count'])
+			next_token = rs.next_token
+			if next_token is None:
+				return False
+			if cache:
+				offset_cache.remember(cls, filter_part, position, next_token)
+		return next_token
+
+	def _offset_lister(self, cls, filter_part, rs, offset, limit):
+		"""Remember where the next page starts once this page is done"""
+		num = 0
+		for item in rs:
+			num += 1
+			yield item
+		if num == limit and rs.next_token:
+			offset_cache.remember(cls, filter_part, offset + num, rs.next_token)
+
+	def _split_filters(self, cls, filters):
+		"""Split the filters into several queries if one of them has more
+		OR'd values than max_or_values"""
+		return planner.split_filters(filters, self.max_or_values)
+
+	def _split_select(self, select):
+		"""
+		The select expressions to send for a query's select, more
+		than one when its sub-queries found more IDs than fit in one
+		"""
+		if isinstance(select, planner.SubQuerySelect):
+			return select.chunks(self.max_or_values, self.max_subquery_selects)
+		return [select]
+
+	def _split_names(self, cls, filter, sort_by):
+		"""Attributes the merge needs to see on each item"""
+		props = filter[0]
+		if not isinstance(props, list):
+			props = [props]
+		names = []
+		for filter_prop in props:
+			(name, op) = filter_prop.strip().split(" ", 1)
+			names.append(self._term_ops(cls.find_property(name), name, op.strip())[0])
+		if sort_by:
+			names.append(sort_by.lstrip("-"))
+		return [n for n in names if n not in ("__id__", "itemName()")]
+
+	def _merged_query(self, query, output, domains, split=None, expressions=None):
+		"""
+		Run one select for each domain, and each part of a split query
+		or select, at the same time, returning a MergedResultSet over
+		all of them. An item is only ever stored in one domain, so only
+		the parts of a split query need to agree on which of them
+		returns it.
+
+		:param expressions: The select expressions, from _split_select
+		:type expressions: list
+		"""
+		cls = query.model_class
+		if split:
+			(index, parts) = split
+		else:
+			parts = [query.filters]
+		if expressions is None:
+			expressions = [query.select]
+		filter_parts = [self._build_filter_part(cls, filters, query.sort_by, select)
+			for filters in parts for select in expressions]
+		selects = [(domain, filter_part) for domain in domains for filter_part in filter_parts]
+		states = planner.decode_token(query.next_token, len(selects))
+		consistent = self._consistent()
+		# With a limit the merge rarely needs a part's second page,
+		# so it's only fetched when it does
+		depth = None
+		if query.limit:
+			depth = 0
+		result_sets = []
+		for (domain, filter_part), state in zip(selects, states):
+			query_str = "select %s from `%s` %s" % (output, domain.name, filter_part)
+			if query.limit:
+				query_str += " limit %s" % query.limit
+			token = None
+			if state:
+				token = state[0]
+			result_sets.append((ReadAheadResultSet(domain, query_str,
+				next_token=token, consistent_read=consistent, depth=depth, retry=self.retry), state))
+
+		owner = None
+		if split or len(expressions) > 1:
+			def owner(item):
+				x = 0
+				if split:
+					for x, filters in enumerate(parts):
+						if self._matches_filter(cls, filters[index], item):
+							break
+					else:
+						return None
+				if len(expressions) > 1:
+					return x * len(expressions) + query.select.owner(item, self.max_or_values)
+				return x
+
+		log.debug("Merging %s selects over %s domains for %s" % (len(selects), len(domains), cls.__name__))
+		return planner.MergedResultSet(result_sets, owner, sort_by=query.sort_by,
+			max_items=query.limit, next_token=query.next_token, group_size=len(filter_parts))
+
+	def _matches_filter(self, cls, filter, item):
+		"""Check if an item matches any of the OR'd values in one filter"""
+		props = filter[0]
+		if not isinstance(props, list):
+			props = [props]
+		for filter_prop in props:
+			(name, op) = filter_prop.strip().split(" ", 1)
+			property = cls.find_property(name)
+			for value in filter[1]:
+				value = self.encode_value(property, value)
+				if not isinstance(value, list):
+					value = [value]
+				for v in value:
+					if planner.match_term(item, *self._filter_term(property, name, op.strip(), v)):
+						return True
+		return False
+
+	def _hydrated_lister(self, query, items, batch_size=100):
+		"""
+		Objects for the results of an ID-only query, from the object
+		cache, with the ones that aren't cached in each batch of results
+		fetched together. The hits and misses are counted on the query.
+		"""
+		cls = query.model_class
+		if query.limit:
+			batch_size = min(batch_size, query.limit)
+		query.cache_hits = 0
+		query.cache_misses = 0
+		items = iter(items)
+		while True:
+			ids = [item.name for item in itertools.islice(items, batch_size)]
+			if not ids:
+				break
+			# Anything cached as missing was just found, so it's stale,
+			# and anything this session just wrote is read from SDB
+			cached = object_cache.get_multi(self.cls, [id for id in ids if not self._consistent(id)])
+			cached = dict([(id, a) for (id, a) in cached.items() if a])
+			missing = [id for id in ids if id not in cached]
+			query.cache_hits += len(cached)
+			query.cache_misses += len(missing)
+			found = self._fetch_objects(cls, missing)
+			for id in ids:
+				if id in cached:
+					obj = self.get_object(cls, id, cached[id])
+				else:
+					obj = found.get(id)
+				if obj:
+					yield obj
+		log.debug("%s query: %s of %s results from the object cache" % (cls.__name__,
+			query.cache_hits, query.cache_hits + query.cache_misses))
+
+	def _partial_lister(self, objs, fields):
+		"""Mark objects which only had some fields selected"""
+		fields = set(fields)
+		for obj in objs:
+			obj._partial = fields
+			yield obj
 
 	def count(self, cls, filters, quick=True, sort_by=None, select=None):
 		"""
 		Get the number of results that would
 		be returned in this query
 		"""
-		query = "select count(*) from `%s` %s" % (self.domain.name, self._build_filter_part(cls, filters, sort_by, select))
+		split = self._split_filters(cls, filters)
+		domains = self.query_domains(cls, filters)
+		selects = self._split_select(select)
+		# Worked out here, the write tracker isn't seen by the worker threads
+		consistent = self._consistent()
+		if split or len(domains) != 1 or len(selects) != 1:
+			# Items matching more than one part of a multi-valued
+			# filter (or split select) are counted once for each part
+			parts = [filters]
+			if split:
+				parts = split[1]
+			counts = [(domain, part, s) for domain in domains for part in parts for s in selects]
+			return sum(parallel_map(lambda (domain, part, s): self._count(domain, cls, part, quick, sort_by, s, consistent), counts))
+		return self._count(domains[0], cls, filters, quick, sort_by, selects[0], consistent)
+
+	def _count(self, domain, cls, filters, quick=True, sort_by=None, select=None, consistent=False):
+		"""Count the results of a query in one domain"""
+		query = "select count(*) from `%s` %s" % (domain.name, self._build_filter_part(cls, filters, sort_by, select))
 		count = 0
-		for row in self.domain.select(query):
+		for row in self.retry.iterate(lambda: domain.select(query, consistent_read=consistent)):
 			count += int(row['Count'])
 			if quick:
 				return count
 		return count
 
 
-	def _build_filter(self, property, name, op, val):
+	def _type_query(self, cls):
+		"""
+		Clause matching objects of this class or any subclass. With
+		type_filter set to "lineage" this is a prefix match on the
+		__lineage__ attribute, instead of one comparison per subclass.
+		"""
+		if '_type_query' not in cls.__dict__:
+			# Not set up by ModelMeta
+			type_query = "(`__type__` = '%s'" % cls.__name__
+			for subclass in self.get_all_decendents(cls).keys():
+				type_query += " or `__type__` = '%s'" % subclass
+			return type_query + ")"
+		if self.type_filter == "lineage":
+			return cls._lineage_query
+		return cls._type_query
+
+	def _term_ops(self, property, name, op):
+		"""
+		How values are compared for this property and operator:
+		(name, operator used for None, operator, list prefix needed)
+		"""
 		if name == "__id__":
 			name = 'itemName()'
-		if name != "itemName()":
-			name = '`%s`' % name
-		if val == None:
-			if op in ('is','='):
-				return "%(name)s is null" % {"name": name}
-			elif op in ('is not', '!='):
-				return "%s is not null" % name
-			else:
-				val = ""
-		if property.__class__ == ListProperty:
+		null_op = None
+		if op in ('is','='):
+			null_op = "is null"
+		elif op in ('is not', '!='):
+			null_op = "is not null"
+		is_list = property.__class__ == ListProperty
+		if is_list and self.list_shadow_queries and getattr(property, 'shadow', False):
+			# The raw values can be matched directly, using the index
+			name = property.shadow_name
+			is_list = False
+			if op == "is":
+				op = "="
+			elif op == "not":
+				op = "!="
+		elif is_list:
 			if op in ("is", "="):
 				op = "like"
 			elif op in ("!=", "not"):
 				op = "not like"
-			if not(op in ["like", "not like"] and val.startswith("%")):
+		return (name, null_op, op, is_list)
+
+	def _filter_term(self, property, name, op, val):
+		"""
+		The (name, op, value) of the comparison sent to SDB,
+		value is None for "is null" and "is not null"
+		"""
+		(name, null_op, op, is_list) = self._term_ops(property, name, op)
+		if val == None:
+			if null_op:
+				return (name, null_op, None)
+			val = ""
+		if is_list and not(op in ["like", "not like"] and val.startswith("%")):
+			val = "%%:%s" % val
+		return (name, op, val)
+
+	def _term_encoder(self, property, name, op):
+		"""
+		Function which turns an encoded value into the comparison
+		string for this property and operator
+		"""
+		(name, null_op, op, is_list) = self._term_ops(property, name, op)
+		if name != "itemName()":
+			name = '`%s`' % name
+		null_term = None
+		if null_op:
+			null_term = "%s %s" % (name, null_op)
+		like = op in ["like", "not like"]
+		def term(val):
+			if val == None:
+				if null_term:
+					return null_term
+				val = ""
+			if is_list and not(like and val.startswith("%")):
 				val = "%%:%s" % val
-		return "%s %s '%s'" % (name, op, val.replace("'", "''"))
+			return "%s %s '%s'" % (name, op, val.replace("'", "''"))
+		return term
 
-	def _build_filter_part(self, cls, filters, order_by=None, select=None):
+	def _in_encoder(self, property, name, op):
 		"""
-		Build the filter part
+		Function which turns a list of encoded values into a single
+		"in" comparison, or None if this property doesn't use one.
+		Only the raw value attributes of ListProperties use "in".
 		"""
-		import types
-		query_parts = []
-		order_by_filtered = False
+		if not getattr(property, 'shadow', False):
+			return None
+		(name, null_op, op, is_list) = self._term_ops(property, name, op)
+		if is_list or op != "=":
+			return None
+		def in_term(vals):
+			return "`%s` in (%s)" % (name, ", ".join(["'%s'" % v.replace("'", "''") for v in vals]))
+		return in_term
 
-		if order_by:
-			if order_by[0] == "-":
-				order_by_method = "DESC";
-				order_by = order_by[1:]
-			else:
-				order_by_method = "ASC";
+	def _build_filter(self, property, name, op, val):
+		return self._term_encoder(property, name, op)(val)
 
-		if select:
-			if order_by and order_by in select:
-				order_by_filtered = True
-			query_parts.append("(%s)" % select)
+	def _build_filter_part(self, cls, filters, order_by=None, select=None):
+		"""
+		Build the filter part
+		"""
 		if isinstance(filters, str) or isinstance(filters, unicode):
 			query = "WHERE %s AND `__type__` = '%s'" % (filters, cls.__name__)
-			if order_by in ["__id__", "itemName()"]:
-				query += " ORDER BY itemName() %s" % order_by_method
-			elif order_by != None:
-				query += " ORDER BY `%s` %s" % (order_by, order_by_method)
+			if order_by:
+				order_by_method = "ASC"
+				if order_by[0] == "-":
+					order_by_method = "DESC"
+					order_by = order_by[1:]
+				if order_by in ["__id__", "itemName()"]:
+					query += " ORDER BY itemName() %s" % order_by_method
+				else:
+					query += " ORDER BY `%s` %s" % (order_by, order_by_method)
 			return query
+		return self._filter_template(cls, filters, order_by, select).render(filters)
 
+	def _filter_template(self, cls, filters, order_by=None, select=None):
+		"""
+		Get the FilterTemplate for this shape of query, most requests
+		only differ in the values they filter on
+		"""
+		shape = []
 		for filter in filters:
-			filter_parts = []
-			filter_props = filter[0]
-			if type(filter_props) != list:
-				filter_props = [filter_props]
-			for filter_prop in filter_props:
-				(name, op) = filter_prop.strip().split(" ", 1)
-				value = filter[1]
-				property = cls.find_property(name)
-				if name == order_by:
-					order_by_filtered = True
-				if types.TypeType(value) == types.ListType:
-					filter_parts_sub = []
-					for val in value:
-						val = self.encode_value(property, val)
-						if isinstance(val, list):
-							for v in val:
-								filter_parts_sub.append(self._build_filter(property, name, op, v))
-						else:
-							filter_parts_sub.append(self._build_filter(property, name, op, val))
-					if op in ["not like", "not", "!="]:
-						filter_parts.append("(%s)" % (" AND ".join(filter_parts_sub)))
-					else:
-						filter_parts.append("(%s)" % (" OR ".join(filter_parts_sub)))
-				else:
-					val = self.encode_value(property, value)
-					if isinstance(val, list):
-						for v in val:
-							filter_parts.append(self._build_filter(property, name, op, v))
-					else:
-						filter_parts.append(self._build_filter(property, name, op, val))
-			query_parts.append("(%s)" % (" or ".join(filter_parts)))
-
-
-		type_query = "(`__type__` = '%s'" % cls.__name__
-		for subclass in self.get_all_decendents(cls).keys():
-			type_query += " or `__type__` = '%s'" % subclass
-		type_query +=")"
-		query_parts.append(type_query)
-
-		order_by_query = ""
-
-		if order_by:
-			if not order_by_filtered:
-				query_parts.append("`%s` LIKE '%%'" % order_by)
-			if order_by in ["__id__", "itemName()"]:
-				order_by_query = " ORDER BY itemName() %s" % order_by_method
-			else:
-				order_by_query = " ORDER BY `%s` %s" % (order_by, order_by_method)
+			props = filter[0]
+			if isinstance(props, list):
+				props = tuple(props)
+			shape.append((props, type(filter[1]) == list))
+		key = (cls, tuple(shape), order_by, select, self.list_shadow_queries)
+		template = self._templates.get(key)
+		if template is None:
+			if len(self._templates) >= MAX_TEMPLATES:
+				self._templates.clear()
+			template = FilterTemplate(self, cls, shape, order_by, select)
+			self._templates[key] = template
+		return template
 
-		if len(query_parts) > 0:
-			return "WHERE %s %s" % (" AND ".join(query_parts), order_by_query)
-		else:
-			return ""
+	def _build_attrs(self, obj):
+		"""
+		Work out which attributes need to be written and which need to
+		be deleted to save this object.
 
-	def save_object(self, obj, expected_value=None):
+		:return: (attrs, del_attrs, partial), where partial is True if
+			only the changes since the object was loaded are included
+		:rtype: tuple
+		"""
 		if not obj.id:
-			obj.id = str(uuid.uuid4())
+			obj.id = self.new_id(obj)
 
 		attrs = {'__type__' : obj.__class__.__name__,
 				 '__module__' : obj.__class__.__module__,
 				 '__lineage__' : obj.get_lineage()}
 		del_attrs = []
+		# Objects we loaded from SDB only need their changes written,
+		# anything else (like a brand new object) gets a full write
+		stored = obj._stored_attrs
+		partial = stored is not None and obj._dirty is not None
+		if partial:
+			for name in attrs.keys():
+				if not _attr_changed(stored, name, attrs[name]):
+					del attrs[name]
 		for property in obj.properties(hidden=False):
+			if partial and not (property.name in obj._dirty
+					or isinstance(property, MUTABLE_PROPERTIES)
+					or getattr(property, 'auto_now', False)
+					or property.is_calculated):
+				continue
 			if property.is_calculated:
-				del_attrs.append(property.name)
+				if not partial or property.name in stored:
+					del_attrs.append(property.name)
 				continue
 			value = property.get_value_for_datastore(obj)
 			if value is not None:
 				value = self.encode_value(property, value)
 			if value == []:
 				value = None
+			if getattr(property, 'shadow', False):
+				self._shadow_attrs(property, value, attrs, del_attrs, stored if partial else None)
 			if value == None:
-				del_attrs.append(property.name)
+				if not partial or property.name in stored:
+					del_attrs.append(property.name)
+				continue
+			if partial and not _attr_changed(stored, property.name, value):
 				continue
 			attrs[property.name] = value
-			if property.unique:
-				try:
-					args = {property.name: value}
-					obj2 = obj.find(**args).next()
-					if obj2.id != obj.id:
-						raise SDBPersistenceError("Error: %s must be unique!" % property.name)
-				except(StopIteration):
-					pass
+		return (attrs, del_attrs, partial)
+
+	def _shadow_attrs(self, property, value, attrs, del_attrs, stored=None):
+		"""
+		Add the raw values of a ListProperty with shadow set to the
+		attributes to write, or delete them if the list is empty.
+		stored is the stored attributes for a partial write.
+		"""
+		name = property.shadow_name
+		raw = _raw_values(value)
+		if not raw:
+			if stored is None or name in stored:
+				del_attrs.append(name)
+		elif stored is None or _attr_changed(stored, name, raw):
+			attrs[name] = raw
+
+	def backfill_shadows(self, cls):
+		"""
+		Write the raw value attributes for every ListProperty with shadow
+		set on existing objects of this class. Only objects whose raw
+		values are missing or out of date are written. Until this has
+		been run, set the "list_shadow_queries" option in the [DB]
+		section to false so queries still use the old "like" matches.
+
+		:return: Number of objects updated
+		:rtype: int
+		"""
+		props = [p for p in cls.properties(hidden=False) if getattr(p, 'shadow', False)]
+		if not props:
+			return 0
+		puts = {}
+		deletes = {}
+		for obj in cls.all():
+			stored = obj._stored_attrs or {}
+			attrs = {}
+			del_attrs = []
+			for prop in props:
+				self._shadow_attrs(prop, stored.get(prop.name), attrs, del_attrs, stored)
+			if attrs:
+				puts[obj.id] = attrs
+			if del_attrs:
+				deletes[obj.id] = del_attrs
+		for domain, chunk in self._domain_chunks(puts.keys(), lambda id: id, 25):
+			self.retry(domain.batch_put_attributes, dict([(id, puts[id]) for id in chunk]), replace=True)
+		for domain, chunk in self._domain_chunks(deletes.keys(), lambda id: id, 25):
+			self.retry(domain.batch_delete_attributes, dict([(id, deletes[id]) for id in chunk]))
+		count_cache.invalidate(cls)
+		if self._cache_ttl(cls):
+			object_cache.invalidate(self.cls, set(puts.keys()) | set(deletes.keys()))
+		return len(set(puts.keys()) | set(deletes.keys()))
+
+	def _mark_saved(self, obj, attrs, del_attrs, partial):
+		"""Update the stored attributes of an object after writing it"""
+		if partial:
+			stored = obj._stored_attrs
+			stored.update(attrs)
+		else:
+			stored = dict(attrs)
+		for name in del_attrs:
+			stored.pop(name, None)
+		obj._mark_clean(stored)
+
+	def check_unique(self, objs, attrs=None):
+		"""
+		Make sure the unique properties of these objects don't clash with
+		each other, or with any object already stored.
+
+		If a unique_domain is configured each value is claimed in the
+		UniqueIndex, otherwise this runs one query per class and property
+		(for every 20 values) no matter how many objects are being saved.
+
+		:param objs: Objects about to be saved
+		:type objs: list
+
+		:param attrs: Optional dict of object id -> encoded attributes that
+			are about to be written. Only properties in here are checked.
+		:type attrs: dict
+		"""
+		pending = {}
+		for obj in objs:
+			for prop in obj.properties(hidden=False):
+				if not prop.unique:
+					continue
+				if attrs is not None:
+					if prop.name not in attrs[obj.id]:
+						continue
+					value = attrs[obj.id][prop.name]
+				else:
+					value = self.encode_value(prop, prop.get_value_for_datastore(obj))
+				if value is None:
+					continue
+				cls = obj.__class__
+				if self.unique_index is not None:
+					cls = self.unique_index.scope(cls, prop)
+				values = pending.setdefault((cls, prop), {})
+				if not isinstance(value, list):
+					value = [value]
+				for v in value:
+					if values.get(v, obj).id != obj.id:
+						raise SDBPersistenceError("Error: %s must be unique!" % prop.name)
+					values[v] = obj
+
+		if self.unique_index is not None:
+			for (cls, prop), values in pending.items():
+				for v, obj in values.items():
+					self.unique_index.claim(obj, prop, v)
+			return
+
+		for (cls, prop), values in pending.items():
+			for chunk in chunks(values.keys(), 20):
+				for obj2 in cls.find().filter('%s =' % prop.name, chunk):
+					found = (obj2._stored_attrs or {}).get(prop.name)
+					if not isinstance(found, list):
+						found = [found]
+					for v in found:
+						if v in values and values[v].id != obj2.id:
+							raise SDBPersistenceError("Error: %s must be unique!" % prop.name)
+
+	def _unique_released(self, obj, attrs=None, del_attrs=None):
+		"""
+		Find the unique values this write stops using, so they can be
+		released from the UniqueIndex once it succeeds. With no attrs
+		(when deleting) every stored unique value is released.
+
+		:return: List of (property, value) tuples
+		:rtype: list
+		"""
+		released = []
+		if self.unique_index is None or not obj._stored_attrs:
+			return released
+		for prop in obj.properties(hidden=False):
+			if not prop.unique or prop.name not in obj._stored_attrs:
+				continue
+			old = obj._stored_attrs[prop.name]
+			if attrs is None or prop.name in (del_attrs or []):
+				new = []
+			elif prop.name in attrs:
+				new = attrs[prop.name]
+			else:
+				continue
+			if not isinstance(old, list):
+				old = [old]
+			if not isinstance(new, list):
+				new = [new]
+			released.extend((prop, v) for v in old if v not in new)
+		return released
+
+	def _release_unique(self, obj, released):
+		for prop, value in released:
+			try:
+				self.unique_index.release(obj, prop, value)
+			except Exception:
+				# A stale entry is taken over the next time it's claimed
+				log.exception('Could not release %s=%s for %s' % (prop.name, value, obj.id))
+
+	def save_object(self, obj, expected_value=None):
+		attrs, del_attrs, partial = self._build_attrs(obj)
+		self.check_unique([obj], {obj.id: attrs})
+		released = self._unique_released(obj, attrs, del_attrs)
 		# Convert the Expected value to SDB format
 		if expected_value:
 			prop = obj.find_property(expected_value[0])
@@ -357,30 +1111,188 @@ class SDBManager(Manager):
 			if v is not None and not type(v) == bool:
 				v = self.encode_value(prop, v)
 			expected_value[1] = v
-		self.domain.put_attributes(obj.id, attrs, replace=True, expected_value=expected_value)
+			if not attrs:
+				# A conditional put still needs something to write
+				attrs['__type__'] = obj.__class__.__name__
+		if attrs or not partial:
+			self.retry(self.domain_for(obj.id).put_attributes, obj.id, attrs, replace=True, expected_value=expected_value)
 		if len(del_attrs) > 0:
-			self.domain.delete_attributes(obj.id, del_attrs)
+			self.retry(self.domain_for(obj.id).delete_attributes, obj.id, del_attrs)
+		self._release_unique(obj, released)
+		self._mark_saved(obj, attrs, del_attrs, partial)
+		count_cache.invalidate(obj.__class__)
+		self._written([obj])
 		return obj
 
+	def save_objects(self, objs, max_workers=None):
+		"""
+		Save several objects using BatchPutAttributes and
+		BatchDeleteAttributes, 25 items per call, running up to
+		max_workers calls at once. Failed calls are retried through
+		our RetryPolicy; anything that still fails is reported in
+		a BatchWriteError once every other call has finished.
+		"""
+		from botoweb.db.batch import BatchWriteError
+		writes = []
+		for obj in objs:
+			attrs, del_attrs, partial = self._build_attrs(obj)
+			writes.append((obj, attrs, del_attrs, partial))
+		self.check_unique(objs, dict((w[0].id, w[1]) for w in writes))
+
+		def put_chunk(domain, chunk):
+			items = dict((obj.id, attrs) for (obj, attrs, del_attrs, partial) in chunk)
+			self.retry(domain.batch_put_attributes, items, replace=True)
+
+		def delete_chunk(domain, chunk):
+			items = dict((obj.id, del_attrs) for (obj, attrs, del_attrs, partial) in chunk)
+			self.retry(domain.batch_delete_attributes, items)
+
+		get_id = lambda w: w[0].id
+		jobs = []
+		for domain, chunk in self._domain_chunks([w for w in writes if w[1] or not w[3]], get_id, 25):
+			jobs.append((put_chunk, domain, chunk))
+		for domain, chunk in self._domain_chunks([w for w in writes if w[2]], get_id, 25):
+			jobs.append((delete_chunk, domain, chunk))
+		results = parallel_map(lambda job: job[0](job[1], job[2]), jobs, max_workers, return_errors=True)
+
+		failed = {}
+		errors = []
+		for job, result in zip(jobs, results):
+			if isinstance(result, Exception):
+				errors.append(result)
+				for w in job[2]:
+					failed[w[0].id] = w[0]
+		for (obj, attrs, del_attrs, partial) in writes:
+			if obj.id not in failed:
+				self._release_unique(obj, self._unique_released(obj, attrs, del_attrs))
+				self._mark_saved(obj, attrs, del_attrs, partial)
+		for cls in set(obj.__class__ for obj in objs):
+			count_cache.invalidate(cls)
+		self._written(objs)
+		if errors:
+			raise BatchWriteError(failed.values(), errors)
+		return objs
+
 	def delete_object(self, obj):
-		self.domain.delete_attributes(obj.id)
+		released = self._unique_released(obj)
+		self.retry(self.domain_for(obj.id).delete_attributes, obj.id)
+		self._release_unique(obj, released)
+		count_cache.invalidate(obj.__class__)
+		self._written([obj])
+
+	def delete_objects(self, objs, max_workers=None):
+		"""Delete several objects using BatchDeleteAttributes"""
+		from botoweb.db.batch import BatchWriteError
+		def delete_chunk(job):
+			(domain, chunk) = job
+			items = dict((obj.id, None) for obj in chunk)
+			self.retry(domain.batch_delete_attributes, items)
+		jobs = self._domain_chunks(objs, lambda obj: obj.id, 25)
+		results = parallel_map(delete_chunk, jobs, max_workers, return_errors=True)
+		failed = []
+		errors = []
+		for (domain, chunk), result in zip(jobs, results):
+			if isinstance(result, Exception):
+				errors.append(result)
+				failed.extend(chunk)
+			else:
+				for obj in chunk:
+					self._release_unique(obj, self._unique_released(obj))
+		for cls in set(obj.__class__ for obj in objs):
+			count_cache.invalidate(cls)
+		self._written(objs)
+		if errors:
+			raise BatchWriteError(failed, errors)
+		return objs
+
+	@property
+	def archive(self):
+		"""
+		Manager for the archive domain, which soft-deleted objects of
+		classes with __archive__ set are moved to. The domain is named
+		by __archive__ if that's a string, otherwise it's this
+		domain's name with "_archive" added.
+		"""
+		if self._archive is None:
+			name = getattr(self.cls, '__archive__', None)
+			if not isinstance(name, basestring):
+				name = '%s_archive' % self.db_name
+			self._archive = ArchiveManager(self.cls, name, self.db_user, self.db_passwd,
+				self.db_host, self.db_port, self.db_table, self.ddl_dir, self.enable_ssl, self.consistent)
+		return self._archive
+
+	def _archive_attrs(self, obj):
+		"""All of the attributes of an object, for writing it to the archive"""
+		stored = obj._stored_attrs
+		obj._stored_attrs = None
+		try:
+			(attrs, del_attrs, partial) = self._build_attrs(obj)
+		finally:
+			obj._stored_attrs = stored
+		return attrs
+
+	def archive_object(self, obj):
+		"""
+		Move an object from this domain into the archive domain.
+		It's written to the archive before it's removed from here,
+		so it's never missing from both.
+		"""
+		archive = self.archive
+		attrs = self._archive_attrs(obj)
+		archive.retry(archive.domain.put_attributes, obj.id, attrs, replace=True)
+		self.delete_object(obj)
+		obj._manager = archive
+		archive._mark_saved(obj, attrs, [], False)
+		count_cache.invalidate(obj.__class__)
+
+	def archive_deleted(self, cls, max_workers=None):
+		"""
+		Move every object of this class already marked as deleted into
+		the archive domain, for turning __archive__ on for a class that
+		has existing data.
+
+		:return: Number of objects moved
+		:rtype: int
+		"""
+		archive = self.archive
+		objs = list(Query(cls, manager=self).filter('deleted =', True))
+		for chunk in chunks(objs, 25):
+			items = dict((obj.id, self._archive_attrs(obj)) for obj in chunk)
+			archive.retry(archive.domain.batch_put_attributes, items, replace=True)
+			self.delete_objects(chunk, max_workers)
+			log.info('Archived %s deleted %s objects' % (len(chunk), cls.__name__))
+		count_cache.invalidate(cls)
+		return len(objs)
 
 	def set_property(self, prop, obj, name, value):
 		setattr(obj, name, value)
 		value = prop.get_value_for_datastore(obj)
 		value = self.encode_value(prop, value)
+		released = []
 		if prop.unique:
-			try:
-				args = {prop.name: value}
-				obj2 = obj.find(**args).next()
-				if obj2.id != obj.id:
-					raise SDBPersistenceError("Error: %s must be unique!" % prop.name)
-			except(StopIteration):
-				pass
-		self.domain.put_attributes(obj.id, {name : value}, replace=True)
+			self.check_unique([obj], {obj.id: {name: value}})
+			released = self._unique_released(obj, {name: value})
+		attrs = {name: value}
+		del_attrs = []
+		if getattr(prop, 'shadow', False):
+			# Keep the raw values of a shadowed list in step
+			self._shadow_attrs(prop, value, attrs, del_attrs)
+		domain = self.domain_for(obj.id)
+		self.retry(domain.put_attributes, obj.id, attrs, replace=True)
+		if del_attrs:
+			self.retry(domain.delete_attributes, obj.id, del_attrs)
+		self._release_unique(obj, released)
+		count_cache.invalidate(obj.__class__)
+		self._written([obj])
+		if obj._stored_attrs is not None:
+			obj._stored_attrs.update(attrs)
+			for attr in del_attrs:
+				obj._stored_attrs.pop(attr, None)
+		if obj._dirty is not None:
+			obj._dirty.discard(name)
 
 	def get_property(self, prop, obj, name):
-		a = self.domain.get_attributes(obj.id,consistent_read=self.consistent)
+		a = self._get_attributes(obj.__class__, obj.id)
 
 		# try to get the attribute value from SDB
 		if name in a:
@@ -391,18 +1303,62 @@ class SDBManager(Manager):
 		raise AttributeError, '%s not found' % name
 
 	def set_key_value(self, obj, name, value):
-		self.domain.put_attributes(obj.id, {name : value}, replace=True)
+		self.retry(self.domain_for(obj.id).put_attributes, obj.id, {name : value}, replace=True)
+		self._written([obj])
 
 	def delete_key_value(self, obj, name):
-		self.domain.delete_attributes(obj.id, name)
+		self.retry(self.domain_for(obj.id).delete_attributes, obj.id, name)
+		self._written([obj])
 
 	def get_key_value(self, obj, name):
-		a = self.domain.get_attributes(obj.id, name,consistent_read=self.consistent)
+		a = self.retry(self.domain_for(obj.id).get_attributes, obj.id, name, consistent_read=self._consistent(obj.id))
 		if a.has_key(name):
 			return a[name]
 		else:
 			return None
 	
 	def get_raw_item(self, obj):
-		return self.domain.get_item(obj.id)
+		return self.retry(self.domain_for(obj.id).get_item, obj.id)
 		
+
+
+class ArchiveManager(SDBManager):
+	"""
+	Manager for the archive domain of a class, see SDBManager.archive.
+	Objects loaded from the archive are saved back to and deleted
+	from the archive, until restore_object moves them back. Unique values aren't kept for archived objects.
+	"""
+
+	# Archived objects share their IDs with the live ones
+	use_object_cache = False
+
+	def __init__(self, *args, **kwargs):
+		SDBManager.__init__(self, *args, **kwargs)
+		self.unique_index = None
+
+	@property
+	def archive(self):
+		return self
+
+	def check_unique(self, objs, attrs=None):
+		pass
+
+	def get_object(self, cls, id, a=None):
+		obj = SDBManager.get_object(self, cls, id, a)
+		if obj is not None:
+			obj._manager = self
+		return obj
+
+	def restore_object(self, obj):
+		"""
+		Move an object from the archive back into the live domain of
+		its class, the reverse of SDBManager.archive_object. It's
+		written there (claiming its unique values again) before it's
+		removed from here.
+		"""
+		live = self.cls._manager
+		# Everything gets written, not just what changed in here
+		obj._stored_attrs = None
+		live.save_object(obj)
+		obj._manager = live
+		self.delete_object(obj)
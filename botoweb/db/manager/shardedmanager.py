@@ -0,0 +1,328 @@
+# Copyright (c) 2014 Chris Moyer http://coredumped.org/
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+# Author: Chris Moyer http://coredumped.org/
+# Description: Spreading the items of one class over several SDB
+# domains, by a hash of their itemName(). Reads and writes of a single
+# item go to the one domain it hashes to, queries are sent to every
+# domain at once and their results merged. Enable it in the class's own
+# config section:
+#
+#	[DB_MyClass]
+#	shards = 8
+#
+# Shard n is stored in the domain "<db_name>_<shards>_<n>", except with
+# a single shard, which is just "<db_name>". To change the number of
+# shards, set reshard_to to the new number so every write is also
+# copied to the new layout, run bw_reshard to copy the existing items,
+# then change shards and take reshard_to out again.
+
+import hashlib
+
+from boto.exception import SDBPersistenceError
+from botoweb.db.manager.sdbmanager import SDBManager
+from botoweb.db.parallel import parallel_map
+
+import logging
+log = logging.getLogger('botoweb.db.manager.shardedmanager')
+
+
+def shard_index(id, shards):
+	"""The shard an item ID hashes to, the same in every process"""
+	if isinstance(id, unicode):
+		id = id.encode('utf-8')
+	return int(hashlib.md5(id).hexdigest()[:8], 16) % shards
+
+
+def _normalized(item):
+	"""Attributes of an item, with multiple values in a stable order"""
+	attrs = {}
+	for name, value in item.items():
+		if isinstance(value, list):
+			value = sorted(value)
+		attrs[name] = value
+	return attrs
+
+
+class ReshardError(SDBPersistenceError):
+	"""Raised when some items kept changing while they were copied, so
+	the new shards may not match the current ones. Everything else was
+	copied, and running the copy again picks up where this left off.
+
+	:ivar count: Number of items copied
+	:ivar unsynced: Names of the items which may differ
+	"""
+
+	def __init__(self, count, unsynced):
+		self.count = count
+		self.unsynced = list(unsynced)
+		SDBPersistenceError.__init__(self, "Error: %s items kept changing while they were copied: %s" % (
+			len(self.unsynced), ", ".join(self.unsynced[:10])))
+
+
+class MirroredDomain(object):
+	"""
+	Domain of one shard which, while resharding, also copies every write
+	to the domain the item is moving to. Reads only use the current
+	shard. A copy that fails is logged instead of raised, since the
+	write itself went through; running bw_reshard again repairs it.
+
+	:param domain: Domain of the current shard
+	:param mirror_for: Function which returns the new domain for an ID
+	:type mirror_for: function
+	"""
+
+	def __init__(self, domain, mirror_for):
+		self.domain = domain
+		self.mirror_for = mirror_for
+		self.name = domain.name
+
+	def __getattr__(self, name):
+		return getattr(self.domain, name)
+
+	def put_attributes(self, item_name, attributes, replace=True, expected_value=None):
+		result = self.domain.put_attributes(item_name, attributes, replace=replace, expected_value=expected_value)
+		self._copy(item_name, 'put_attributes', item_name, attributes, replace=replace)
+		return result
+
+	def delete_attributes(self, item_name, attributes=None, expected_value=None):
+		result = self.domain.delete_attributes(item_name, attributes, expected_value=expected_value)
+		self._copy(item_name, 'delete_attributes', item_name, attributes)
+		return result
+
+	def batch_put_attributes(self, items, replace=True):
+		result = self.domain.batch_put_attributes(items, replace=replace)
+		self._copy_batch('batch_put_attributes', items, replace=replace)
+		return result
+
+	def batch_delete_attributes(self, items):
+		result = self.domain.batch_delete_attributes(items)
+		self._copy_batch('batch_delete_attributes', items)
+		return result
+
+	def _copy(self, item_name, method, *args, **kwargs):
+		try:
+			getattr(self.mirror_for(item_name), method)(*args, **kwargs)
+		except Exception:
+			log.exception('Could not copy %s of %s to the new shards' % (method, item_name))
+
+	def _copy_batch(self, method, items, **kwargs):
+		groups = {}
+		for name, value in items.items():
+			domain = self.mirror_for(name)
+			groups.setdefault(domain.name, (domain, {}))[1][name] = value
+		for domain, group in groups.values():
+			try:
+				getattr(domain, method)(group, **kwargs)
+			except Exception:
+				log.exception('Could not copy %s of %s items to %s' % (method, len(group), domain.name))
+
+
+class ShardedSDBManager(SDBManager):
+	"""
+	SimpleDB Manager which spreads items over several domains
+
+	:param shards: Number of domains to spread the items over
+	:type shards: int
+
+	:param reshard_to: Number of shards being moved to, every write is
+		copied to that layout as well
+	:type reshard_to: int
+	"""
+
+	def __init__(self, cls, db_name, db_user, db_passwd,
+				 db_host, db_port, db_table, ddl_dir, enable_ssl, consistent=None,
+				 shards=1, reshard_to=None):
+		SDBManager.__init__(self, cls, db_name, db_user, db_passwd,
+			db_host, db_port, db_table, ddl_dir, enable_ssl, consistent)
+		self.shards = shards
+		self.reshard_to = reshard_to
+		self._layouts = {}
+		self._mirrored = None
+
+	def shard_name(self, n, shards=None):
+		"""Name of the domain for shard n out of this many shards"""
+		if shards is None:
+			shards = self.shards
+		if shards == 1:
+			return self.db_name
+		return '%s_%s_%s' % (self.db_name, shards, n)
+
+	def layout(self, shards=None):
+		"""The domain of every shard, for this many shards"""
+		if shards is None:
+			shards = self.shards
+		if shards not in self._layouts:
+			self._layouts[shards] = [self._get_domain(self.shard_name(n, shards)) for n in range(shards)]
+		return self._layouts[shards]
+
+	def create_layout(self, shards=None):
+		"""Create the domain of every shard, for this many shards.
+		Domains that already exist are left as they are."""
+		if shards is None:
+			shards = self.shards
+		self._layouts[shards] = [self.retry(self.sdb.create_domain, self.shard_name(n, shards)) for n in range(shards)]
+		return self._layouts[shards]
+
+	@property
+	def shard_domains(self):
+		"""The domains we read from and write to"""
+		if not self.reshard_to or self.reshard_to == self.shards:
+			return self.layout()
+		if self._mirrored is None:
+			target = self.layout(self.reshard_to)
+			mirror_for = lambda id: target[shard_index(id, self.reshard_to)]
+			self._mirrored = [MirroredDomain(domain, mirror_for) for domain in self.layout()]
+		return self._mirrored
+
+	def domain_for(self, id):
+		return self.shard_domains[shard_index(id, self.shards)]
+
+	def query_domains(self, cls, filters):
+		"""Every shard, unless the query is limited to some IDs"""
+		# Selects only read, so they go straight to the current shards
+		domains = self.layout()
+		ids = self._id_filter(filters)
+		if ids is None:
+			return list(domains)
+		wanted = set([shard_index(id, self.shards) for id in ids])
+		return [d for n, d in enumerate(domains) if n in wanted] or domains[:1]
+
+	def _id_filter(self, filters):
+		"""The IDs an "__id__ =" filter limits a query to, or None"""
+		if isinstance(filters, basestring):
+			return None
+		for props, value in filters:
+			if isinstance(props, list):
+				continue
+			(name, op) = props.strip().split(" ", 1)
+			if name not in ("__id__", "itemName()") or op.strip() not in ("=", "is"):
+				continue
+			if not isinstance(value, list):
+				value = [value]
+			if value and not [v for v in value if not isinstance(v, basestring)]:
+				return value
+		return None
+
+	def reshard(self, shards, max_workers=None):
+		"""
+		Copy every item into the layout for this many shards, which
+		has to have been created with create_layout, reading
+		each current shard and writing its items to their new shards
+		with batch puts. The application can keep running while this
+		runs, as long as reshard_to is set so new writes are copied
+		too. Each batch is read again with a consistent read before
+		it's written, and checked against the current shard afterwards,
+		so a write that lands in between is copied again instead of
+		being overwritten with older data.
+
+		:param shards: Number of shards to copy to
+		:type shards: int
+
+		:return: Number of items copied
+		:rtype: int
+
+		:raises ReshardError: Once everything else is copied, if any
+			items kept changing
+		"""
+		if shards == self.shards:
+			raise SDBPersistenceError('Already using %s shards' % shards)
+		target = self.layout(shards)
+
+		def copy(domain):
+			count = 0
+			unsynced = []
+			pending = {}
+			def sync(n):
+				copied, changing = self._sync(domain, target[n], pending.pop(n))
+				unsynced.extend(changing)
+				return copied
+			for item in self.retry.iterate(lambda: domain.select("select itemName() from `%s`" % domain.name)):
+				n = shard_index(item.name, shards)
+				batch = pending.setdefault(n, [])
+				batch.append(item.name)
+				# 20 at a time, the most we can read in one select
+				if len(batch) == 20:
+					count += sync(n)
+			for n in pending.keys():
+				count += sync(n)
+			log.info('Copied %s items from %s' % (count, domain.name))
+			return (count, unsynced)
+
+		results = parallel_map(copy, self.layout(), max_workers)
+		count = sum([copied for (copied, unsynced) in results])
+		unsynced = [name for (copied, names) in results for name in names]
+		if unsynced:
+			raise ReshardError(count, unsynced)
+		return count
+
+	def _read_items(self, domain, names):
+		"""Consistent read of these items, a dict of name -> attributes"""
+		query_str = "select * from `%s` where itemName() in (%s)" % (domain.name,
+			", ".join(["'%s'" % name.replace("'", "''") for name in names]))
+		return dict([(item.name, _normalized(item)) for item in self.retry.iterate(
+			lambda: domain.select(query_str, consistent_read=True))])
+
+	def _sync(self, source, target, names, max_rounds=5):
+		"""
+		Make these items in the target domain the same as in the source,
+		deleting any that are gone and any attributes they no longer
+		have. Items changed in the source while this ran are synced
+		again, up to max_rounds times.
+
+		:return: (number of items that exist in the source, names of
+			the items still changing after max_rounds)
+		:rtype: tuple
+		"""
+		count = None
+		for attempt in range(max_rounds):
+			items = self._read_items(source, names)
+			if count is None:
+				count = len(items)
+			stored = self._read_items(target, names)
+			deletes = {}
+			for name, attrs in stored.items():
+				if name not in items:
+					deletes[name] = None
+				else:
+					gone = [k for k in attrs if k not in items[name]]
+					if gone:
+						deletes[name] = gone
+			if items:
+				self.retry(target.batch_put_attributes, items, replace=True)
+			if deletes:
+				self.retry(target.batch_delete_attributes, deletes)
+			# Mirrored writes reach the current shard first, so anything
+			# written since we read it shows up here
+			changed = self._read_items(source, names)
+			names = [name for name in names if changed.get(name) != items.get(name)]
+			if not names:
+				return (count, [])
+		log.error('Items in %s kept changing while copying them to %s: %s' % (source.name, target.name, ', '.join(names)))
+		return (count, names)
+
+	def drop_layout(self, shards):
+		"""Delete the domains of an old shard layout, once nothing uses it"""
+		if shards in (self.shards, self.reshard_to):
+			raise SDBPersistenceError('The layout with %s shards is still in use' % shards)
+		for n in range(shards):
+			self.retry(self.sdb.delete_domain, self.shard_name(n, shards))
+		self._layouts.pop(shards, None)
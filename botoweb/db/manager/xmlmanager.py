@@ -26,6 +26,7 @@ from botoweb.db.coremodel import Model
 from datetime import datetime
 from xml.dom.minidom import getDOMImplementation, parse, parseString, Node
 from botoweb.db.converter import Converter
+from botoweb.db.retry import RetryPolicy
 from botoweb import ISO8601
 
 class XMLConverter(Converter):
@@ -200,6 +201,7 @@ class XMLManager(object):
 
 		self.connection = None
 		self.enable_ssl = enable_ssl
+		self.retry = RetryPolicy(db_host and 'XMLManager:%s' % db_host)
 		self.auth_header = None
 		if self.db_user:
 			import base64
@@ -220,6 +222,9 @@ class XMLManager(object):
 		"""
 		Make a request on this connection
 		"""
+		return self.retry(self._send_request, method, url, body)
+
+	def _send_request(self, method, url, body=None):
 		if not self.connection:
 			self._connect()
 		try:
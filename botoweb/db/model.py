@@ -2,7 +2,13 @@
 # Author: Chris Moyer http://coredumped.org/
 #
 
+import re
+
 from botoweb.db.coremodel import Model as CoreModel
+from botoweb.db import consistency
+from botoweb.db.parallel import parallel_map
+from botoweb.db.planner import SubQuerySelect
+from botoweb.exceptions import BadRequest
 from botoweb.db.property import DateTimeProperty, ReferenceProperty, BooleanProperty
 from botoweb.resources.user import User
 
@@ -55,51 +61,99 @@ def query(cls, qs):
 	When processed, this is translated into the SimpleDB query:
 			`created_by` in ('123987123-29384732', '129387218371-1293874213'...)
 
-	:NOTE: Due to this handling of passing the query directly onto SDB,
-	you're limitted to the number of query modifiers you may use. This may be
-	quite quickly reached if you hit a sub-query which returns a lot of results.
-	I haven't yet figured out a better way to handle this.
+	Sub-queries next to each other are run at the same time, and each
+	one is paged through to the end. If one returns more IDs than SDB
+	allows in one select, the query is sent as one select per chunk
+	of them, which are run at the same time and merged. That only
+	works where the results are matched with "in" and not negated.
 	"""
 	# First we need to find and resolve any sub-queries
-	qs = _findSubQueries(cls, qs)
-	for prop in cls.properties():
-		qs = qs.replace("`%s`" % prop.verbose_name, "`%s`" % prop.name)
 	q = cls.all()
-	q.select = qs
-
+	q.select = _findSubQueries(cls, qs)
 	return q
 
-def _findSubQueries(cls, qs):
-	"""Find any possible sub-queries in this query
-	This is a complicated bit of parsing which essentially
-	allows for nested sub-queries"""
-	# If there's no "[" in it, just return the query
-	if not "[" in qs:
-		return qs
-	# Otherwise, we split this apart, 
-	# the retQ is the return query we're
-	# building, and the leftovers still need
-	# to be processed
-	(retQ, leftovers) = qs.split("[", 1)
-	leftovers = _findSubQueries(cls, leftovers).split("]", 1)
-	subQ = leftovers[0].strip()
-
-	# Now that we FOUND the sub query, we need to 
-	# perform the query, and insert the IDs in
-	# it's place
+# The property a sub-query's results are matched against with "in"
+SUBQUERY_IN = re.compile(r"(`[^`]*`|itemName\(\))\s+in\s*$", re.I)
+
+def _findSubQueries(cls, qs, max_workers=None):
+	"""Find any possible sub-queries in this query, and resolve them.
+	Sub-queries nested in another one are resolved as part of it.
+	Returns the query with property names in place of verbose names,
+	as a SubQuerySelect if there were any sub-queries."""
+	parts = []
+	subqueries = []
+	for x, part in enumerate(_splitSubQueries(qs)):
+		if x % 2:
+			subqueries.append(part)
+			parts.append(None)
+		else:
+			parts.append(_propertyNames(cls, part))
+	if not subqueries:
+		return parts[0]
+	# The worker threads read this session's writes consistently too
+	tracker = consistency.current_tracker()
+	# More IDs than this can't be sent, so stop reading them there
+	manager = cls._manager
+	max_results = None
+	if hasattr(manager, 'max_subquery_selects'):
+		max_results = manager.max_or_values * manager.max_subquery_selects
+	results = parallel_map(lambda subQ: _resolveSubQuery(subQ, tracker, max_results), subqueries, max_workers)
+	for x, ids in enumerate(results):
+		name = SUBQUERY_IN.search(parts[x * 2])
+		parts[x * 2 + 1] = (name and name.group(1), ids)
+	return SubQuerySelect(parts)
+
+def _splitSubQueries(qs):
+	"""Split a query into the text around each top-level [ ] and the
+	sub-query inside it, alternately. Brackets inside quoted values
+	and property names are left alone."""
+	parts = []
+	start = 0
+	depth = 0
+	quote = None
+	for x, c in enumerate(qs):
+		if quote:
+			if c == quote:
+				quote = None
+		elif c in ("'", '"', "`"):
+			quote = c
+		elif c == "[":
+			if not depth:
+				parts.append(qs[start:x])
+				start = x + 1
+			depth += 1
+		elif c == "]" and depth:
+			depth -= 1
+			if not depth:
+				parts.append(qs[start:x])
+				start = x + 1
+	if depth:
+		raise BadRequest(description="Unclosed [ in query: %s" % qs)
+	parts.append(qs[start:])
+	return parts
+
+def _resolveSubQuery(subQ, tracker=None, max_results=None):
+	"""IDs of every result of one sub-query, run with this WriteTracker
+	active. Raises BadRequest as soon as there are more than max_results"""
+	if tracker is not None:
+		with tracker:
+			return _resolveSubQuery(subQ, None, max_results)
 	# Step 1, find the model to use
-	(model_name, q2) = subQ.split(" ", 1)
+	(model_name, q2) = subQ.strip().split(" ", 1)
 	model = CoreModel.find_subclass(model_name)
 	if not model:
 		raise Exception, "Error, model: %s not found" % model_name
-	subq_results = query(model, q2)
-	# A limit placed here to prevent catostrophic failures, 
-	# you can't really make this much higher or bad things happen
-	subq_results.limit = 30
-
-	ids = ["'%s'" % obj.id for obj in subq_results]
-	retQ += "(%s)" % ",".join(ids)
-	if len(leftovers) > 1:
-		retQ += leftovers[1]
-
-	return retQ
+	# Only the IDs are used, so don't fetch anything else
+	subq_results = query(model, q2).select_fields("__id__")
+	ids = []
+	for obj in subq_results:
+		ids.append(obj.id)
+		if max_results and len(ids) > max_results:
+			raise BadRequest(description="Sub-query returned more than %s results" % max_results)
+	return ids
+
+def _propertyNames(cls, qs):
+	"""Replace property verbose names with their names"""
+	for prop in cls.properties():
+		qs = qs.replace("`%s`" % prop.verbose_name, "`%s`" % prop.name)
+	return qs
@@ -0,0 +1,241 @@
+# Copyright (c) 2014 Chris Moyer http://coredumped.org/
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+# Author: Chris Moyer http://coredumped.org/
+# Description: Read-through cache of the stored attributes of objects,
+# for classes with __cache_ttl__ set to the number of seconds to keep
+# them. Entries are keyed by the class the manager stores (so looking
+# an object up through its base class or its own class finds the same
+# entry) and the ID, and hold the attributes as compact JSON. Items
+# which don't exist are cached too, for a few seconds.
+#
+# Entries are kept in a small LRU in this process, and in memcache when
+# botoweb has one configured. Writes through the manager remove them
+# from both, but other processes may still have them in their LRU, so
+# with memcache the local copies are only kept for a few seconds.
+#
+# Removing an entry leaves a tombstone with the time of the write for
+# a few seconds, and attributes read before then aren't cached, so a
+# read which was already running can't put the old ones back.
+
+import time
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+import boto
+import botoweb
+
+import logging
+log = logging.getLogger('botoweb.db.object_cache')
+
+_entries = OrderedDict()
+_tombstones = {}
+_lock = threading.Lock()
+
+# Stored in place of the attributes of an item that doesn't exist
+MISSING = '-'
+
+
+def cache_ttl(cls):
+	"""Seconds to cache objects of this class for, 0 if they aren't"""
+	if cls is None:
+		return 0
+	return getattr(cls, '__cache_ttl__', None) or 0
+
+def max_local():
+	"""Most entries to keep in this process, "object_cache_size" in [DB]"""
+	return boto.config.getint('DB', 'object_cache_size', 1000)
+
+def negative_ttl():
+	"""Seconds to remember an item doesn't exist, "object_cache_negative_ttl" in [DB]"""
+	return boto.config.getint('DB', 'object_cache_negative_ttl', 10)
+
+def local_ttl():
+	"""Most seconds to keep a local copy when memcache is shared, "object_cache_local_ttl" in [DB]"""
+	return boto.config.getint('DB', 'object_cache_local_ttl', 5)
+
+def tombstone_ttl():
+	"""Seconds to remember when an item was written, "object_cache_tombstone_ttl" in [DB].
+	Reads which take longer than this may still cache what they read."""
+	return boto.config.getint('DB', 'object_cache_tombstone_ttl', 10)
+
+# Seconds the clocks of processes sharing memcache may be apart
+CLOCK_SKEW = 1.0
+
+def _key(cls, id):
+	if isinstance(id, unicode):
+		id = id.encode('utf-8')
+	return 'obj:%s:%s' % (cls.__name__, hashlib.sha1(id).hexdigest())
+
+def _encode(attrs):
+	if '__type__' not in attrs:
+		return MISSING
+	return json.dumps(attrs, separators=(',', ':'))
+
+def _decode(value):
+	if value == MISSING:
+		return {}
+	return json.loads(value)
+
+def _get_local(key):
+	with _lock:
+		entry = _entries.pop(key, None)
+		if entry is None:
+			return None
+		if entry[0] <= time.time():
+			return None
+		# Most recently used go at the end
+		_entries[key] = entry
+		return entry[1]
+
+def _set_local(key, value, ttl):
+	if botoweb.memc:
+		ttl = min(ttl, local_ttl())
+	with _lock:
+		_entries.pop(key, None)
+		_entries[key] = (time.time() + ttl, value)
+		while len(_entries) > max_local():
+			_entries.popitem(last=False)
+
+def get(cls, id):
+	"""
+	Cached attributes of an item, {} if it's known not to exist,
+	or None if it isn't cached
+	"""
+	return get_multi(cls, [id]).get(id)
+
+def get_multi(cls, ids):
+	"""Dict of ID -> cached attributes, for the IDs that are cached"""
+	found = {}
+	remote = []
+	for id in ids:
+		value = _get_local(_key(cls, id))
+		if value is None:
+			remote.append(id)
+		else:
+			found[id] = _decode(value)
+	if remote and botoweb.memc:
+		keys = dict((_key(cls, id), id) for id in remote)
+		try:
+			values = botoweb.memc.get_multi(keys.keys())
+		except Exception:
+			log.exception('Could not get cached %s objects' % cls.__name__)
+			values = {}
+		for key, value in values.items():
+			_set_local(key, value, local_ttl())
+			found[keys[key]] = _decode(value)
+	return found
+
+def put(cls, id, attrs, ttl, read_at=None):
+	"""Cache the attributes of an item, as returned by SDB"""
+	put_multi(cls, {id: attrs}, ttl, read_at)
+
+def _written_keys(keys, read_at):
+	"""The keys which were written at or after read_at"""
+	now = time.time()
+	written = set()
+	known = set()
+	with _lock:
+		for key in keys:
+			tombstone = _tombstones.get(key)
+			if tombstone is not None:
+				if tombstone[0] <= now:
+					del _tombstones[key]
+				else:
+					# Written by this process, so the time is exact
+					known.add(key)
+					if tombstone[1] >= read_at:
+						written.add(key)
+	if botoweb.memc and len(known) < len(keys):
+		tombs = dict(('tomb:%s' % key, key) for key in keys if key not in known)
+		try:
+			found = botoweb.memc.get_multi(tombs.keys())
+		except Exception:
+			log.exception('Could not check for written items')
+			# Can't tell, so don't cache anything
+			return set(keys)
+		for tomb, at in found.items():
+			if float(at) + CLOCK_SKEW >= read_at:
+				written.add(tombs[tomb])
+	return written
+
+def put_multi(cls, items, ttl, read_at=None):
+	"""
+	Cache the attributes of several items, a dict of ID -> attributes,
+	leaving out any written since read_at (the time the read of them
+	started, by default now).
+	"""
+	if read_at is None:
+		read_at = time.time()
+	remote = {}
+	missing = {}
+	keys = dict((_key(cls, id), id) for id in items)
+	written = _written_keys(keys.keys(), read_at)
+	for key, id in keys.items():
+		if key in written:
+			continue
+		value = _encode(items[id])
+		if value == MISSING:
+			_set_local(key, value, min(ttl, negative_ttl()))
+			missing[key] = value
+		else:
+			_set_local(key, value, ttl)
+			remote[key] = value
+	if botoweb.memc:
+		try:
+			if remote:
+				botoweb.memc.set_multi(remote, ttl)
+			if missing:
+				botoweb.memc.set_multi(missing, min(ttl, negative_ttl()))
+		except Exception:
+			log.exception('Could not cache %s objects' % cls.__name__)
+
+def invalidate(cls, ids):
+	"""
+	Forget the cached attributes of these items, and don't cache
+	anything read from before now
+	"""
+	keys = [_key(cls, id) for id in ids]
+	ttl = tombstone_ttl()
+	now = time.time()
+	with _lock:
+		for key in keys:
+			_entries.pop(key, None)
+			_tombstones[key] = (now + ttl, now)
+		if len(_tombstones) > max_local():
+			for key, tombstone in _tombstones.items():
+				if tombstone[0] <= now:
+					del _tombstones[key]
+	if botoweb.memc and keys:
+		try:
+			# The tombstone goes first, so no one can cache it in between
+			botoweb.memc.set_multi(dict(('tomb:%s' % key, repr(now)) for key in keys), ttl)
+			botoweb.memc.delete_multi(keys)
+		except Exception:
+			log.exception('Could not invalidate cached %s objects' % cls.__name__)
+
+def clear():
+	"""Forget everything cached in this process"""
+	with _lock:
+		_entries.clear()
+		_tombstones.clear()
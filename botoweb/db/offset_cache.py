@@ -0,0 +1,104 @@
+# Copyright (c) 2014 Chris Moyer http://coredumped.org/
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+# Author: Chris Moyer http://coredumped.org/
+# Description: Cache of the next_token found at each offset into a query.
+# SDB has no offset, so skipping ahead means counting through the
+# results with "select count(*) ... limit N" selects. The tokens found
+# that way (and at the end of every page served with an offset) are kept
+# here, keyed by the class and the filter string, so going deeper into
+# the same results starts from the nearest known offset instead of the
+# start.
+# Like count_cache, every write to the class makes these obsolete.
+
+import time
+import hashlib
+import threading
+
+import boto
+import botoweb
+from botoweb.db import count_cache
+
+import logging
+log = logging.getLogger('botoweb.db.offset_cache')
+
+_tokens = {}
+_lock = threading.Lock()
+
+# Don't let the local cache grow forever
+MAX_LOCAL_QUERIES = 1000
+
+# Most offsets to keep for one query
+MAX_OFFSETS = 100
+
+
+def default_ttl():
+	"""Seconds to keep offset tokens, the "offset_ttl" option in [DB]"""
+	return boto.config.getint('DB', 'offset_ttl', 300)
+
+def _key(cls, query_str):
+	return 'offset:%s:%s:%s' % (cls.__name__, count_cache.generation(cls),
+		hashlib.sha1(query_str.encode('utf-8') if isinstance(query_str, unicode) else query_str).hexdigest())
+
+def get_tokens(cls, query_str):
+	"""Dict of offset to next_token known for this query"""
+	key = _key(cls, query_str)
+	if botoweb.memc:
+		try:
+			return botoweb.memc.get(key) or {}
+		except Exception:
+			log.exception('Could not get offset tokens for %s' % cls.__name__)
+			return {}
+	entry = _tokens.get(key)
+	if entry and entry[0] > time.time():
+		return entry[1]
+	return {}
+
+def nearest(cls, query_str, offset):
+	"""The closest known (offset, next_token) at or before this offset,
+	(0, None) if there isn't one"""
+	tokens = get_tokens(cls, query_str)
+	known = [o for o in tokens if o <= offset]
+	if not known:
+		return (0, None)
+	best = max(known)
+	return (best, tokens[best])
+
+def remember(cls, query_str, offset, token, ttl=None):
+	"""Keep the next_token which starts offset results into this query"""
+	if ttl is None:
+		ttl = default_ttl()
+	key = _key(cls, query_str)
+	tokens = dict(get_tokens(cls, query_str))
+	if len(tokens) >= MAX_OFFSETS and offset not in tokens:
+		# Keep the deepest ones, they're the most work to find again
+		del tokens[min(tokens)]
+	tokens[offset] = token
+	if botoweb.memc:
+		try:
+			botoweb.memc.set(key, tokens, ttl)
+		except Exception:
+			log.exception('Could not set offset tokens for %s' % cls.__name__)
+		return
+	with _lock:
+		if len(_tokens) >= MAX_LOCAL_QUERIES and key not in _tokens:
+			_tokens.clear()
+		_tokens[key] = (time.time() + ttl, tokens)
@@ -0,0 +1,133 @@
+# Copyright (c) 2014 Chris Moyer http://coredumped.org/
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+# Author: Chris Moyer http://coredumped.org/
+# Description: Small helpers for running independent datastore
+# calls at the same time on a bounded number of threads.
+
+import sys
+import threading
+from Queue import Queue, Empty
+
+import boto
+
+import logging
+log = logging.getLogger('botoweb.db.parallel')
+
+
+def default_workers():
+	"""Default number of threads to use for parallel datastore calls"""
+	return boto.config.getint('DB', 'max_parallel', 4)
+
+
+def parallel_map(fnc, items, max_workers=None, return_errors=False):
+	"""Call fnc(item) for every item, running up to max_workers calls at
+	the same time, and return the results in the same order as items.
+
+	If any call raises, the first exception (in item order) is re-raised
+	once every call has finished, unless return_errors is set, in which
+	case the exception is returned in place of that item's result.
+
+	:param fnc: Function to call with each item
+	:type fnc: function
+
+	:param items: Items to call the function with
+	:type items: iterable
+
+	:param max_workers: Maximum number of threads to use, by default
+		this is the "max_parallel" option in the [DB] config section
+	:type max_workers: int
+
+	:param return_errors: Return exceptions instead of raising them
+	:type return_errors: bool
+	"""
+	items = list(items)
+	if max_workers is None:
+		max_workers = default_workers()
+	max_workers = max(1, min(max_workers, len(items)))
+	results = [None] * len(items)
+	errors = [None] * len(items)
+
+	# Not worth a thread if there's only one thing to do
+	if max_workers == 1:
+		for x, item in enumerate(items):
+			try:
+				results[x] = fnc(item)
+			except Exception, e:
+				errors[x] = sys.exc_info()
+	else:
+		queue = Queue()
+		for x, item in enumerate(items):
+			queue.put((x, item))
+
+		def worker():
+			while True:
+				try:
+					x, item = queue.get_nowait()
+				except Empty:
+					return
+				try:
+					results[x] = fnc(item)
+				except Exception, e:
+					errors[x] = sys.exc_info()
+
+		threads = [threading.Thread(target=worker) for n in range(max_workers)]
+		for t in threads:
+			t.daemon = True
+			t.start()
+		for t in threads:
+			t.join()
+
+	for x, error in enumerate(errors):
+		if error:
+			if return_errors:
+				results[x] = error[1]
+			else:
+				raise error[0], error[1], error[2]
+	return results
+
+
+def in_context(fnc):
+	"""Wrap fnc so that, whichever thread calls it, it runs with the
+	WriteTracker and IdentityMap active in this thread. Both are
+	thread-local, so calls made through parallel_map don't see them
+	otherwise.
+
+	:param fnc: Function to wrap
+	:type fnc: function
+	"""
+	from botoweb.db import consistency, identity
+	contexts = [c for c in (consistency.current_tracker(), identity.current_map()) if c is not None]
+	def run(*args, **kwargs):
+		for c in contexts:
+			c.__enter__()
+		try:
+			return fnc(*args, **kwargs)
+		finally:
+			for c in reversed(contexts):
+				c.__exit__(None, None, None)
+	return run
+
+
+def chunks(items, size):
+	"""Split a list of items into lists of at most size items"""
+	items = list(items)
+	return [items[x:x + size] for x in range(0, len(items), size)]
@@ -0,0 +1,411 @@
+# Copyright (c) 2014 Chris Moyer http://coredumped.org/
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+# Author: Chris Moyer http://coredumped.org/
+# Description: Splitting a select with a long list of OR'd values into
+# several smaller selects, and merging their results back together.
+# SDB only allows 20 comparisons in a predicate, so a filter such as
+# "name =" ['a', 'b', ... ] with more values than that is sent as one
+# select per chunk of values. Every item is owned by the first chunk it
+# matches, and only returned from that select, so the merged results
+# have no duplicates and can be paged through with a merged next_token.
+# The same merge is used for classes stored in several domains, and
+# for select expressions whose [Model ...] sub-queries returned more
+# IDs than fit in one select (see SubQuerySelect).
+
+import re
+import itertools
+import json
+import base64
+
+from botoweb.exceptions import BadRequest
+from botoweb.db.parallel import parallel_map, chunks
+
+import logging
+log = logging.getLogger('botoweb.db.planner')
+
+# Operators we can split a list of values on, the values are OR'd
+SPLIT_OPS = ('=', 'is', 'like')
+
+# Prefix for merged next tokens, so they're never mistaken for SDB's own
+TOKEN_PREFIX = 'm:'
+
+
+def split_filters(filters, max_values):
+	"""Find the filter with the most OR'd values, and if it has more than
+	max_values values return (index, [filters, ...]) with one copy of
+	filters per chunk of values. Returns None if nothing needs splitting.
+
+	:param filters: Query filters, as (property_operator, value) tuples
+	:type filters: list
+
+	:param max_values: Most values to send in one select
+	:type max_values: int
+	"""
+	if isinstance(filters, basestring):
+		return None
+	best = None
+	for x, (props, value) in enumerate(filters):
+		if not isinstance(value, list) or len(value) <= max_values:
+			continue
+		if not isinstance(props, list):
+			props = [props]
+		ops = [p.strip().split(" ", 1)[-1].strip().lower() for p in props]
+		if [op for op in ops if op not in SPLIT_OPS]:
+			continue
+		if best is None or len(value) > len(filters[best][1]):
+			best = x
+	if best is None:
+		return None
+
+	values = []
+	for v in filters[best][1]:
+		if v not in values:
+			values.append(v)
+	parts = []
+	for start in range(0, len(values), max_values):
+		part = list(filters)
+		part[best] = (filters[best][0], values[start:start + max_values])
+		parts.append(part)
+	return best, parts
+
+
+class SubQuerySelect(unicode):
+	"""
+	A select expression with the results of its sub-queries in it.
+	As a string it has every ID inlined, but when a sub-query found
+	more than max_values IDs, the manager sends it as one select per
+	chunk of them instead (see chunks), and merges the results.
+
+	:param parts: The expression, as a list of text and one
+		(attribute, IDs) tuple for each sub-query, attribute being
+		"`name`" or "itemName()" when the sub-query's results are
+		matched with "in", otherwise None
+	:type parts: list
+	"""
+
+	def __new__(cls, parts):
+		text = u"".join([cls._render(p) for p in parts])
+		self = unicode.__new__(cls, text)
+		self.parts = parts
+		self._splits = {}
+		return self
+
+	@staticmethod
+	def _render(part, ids=None):
+		"""Text of one part, with these IDs for a sub-query instead of all of them"""
+		if isinstance(part, basestring):
+			if isinstance(part, str):
+				part = part.decode('utf-8')
+			return part
+		if ids is None:
+			ids = part[1]
+		return u"(%s)" % u", ".join([u"'%s'" % id.replace("'", "''") for id in ids])
+
+	@property
+	def names(self):
+		"""Attributes the sub-query results are matched against"""
+		names = []
+		for part in self.parts:
+			if not isinstance(part, basestring) and part[0]:
+				names.append(part[0].strip("`"))
+		return names
+
+	def split(self, max_values):
+		"""
+		For each sub-query with more than max_values IDs, the index of
+		its part and a dict of ID -> chunk, along with the number of
+		chunks
+		"""
+		if max_values not in self._splits:
+			split = []
+			for x, part in enumerate(self.parts):
+				if isinstance(part, basestring) or len(part[1]) <= max_values:
+					continue
+				ids = []
+				for id in part[1]:
+					if id not in ids:
+						ids.append(id)
+				parts = chunks(ids, max_values)
+				index = dict([(id, n) for n, chunk in enumerate(parts) for id in chunk])
+				split.append((x, parts, index))
+			self._splits[max_values] = split
+		return self._splits[max_values]
+
+	def chunks(self, max_values, max_selects=None):
+		"""
+		The select expressions to send, one for every combination of
+		the chunks of IDs, or just this one if they all fit. Splitting
+		only works where the IDs are matched with "in", and not negated.
+
+		:param max_selects: Most selects to send, more raises BadRequest
+		:type max_selects: int
+		"""
+		split = self.split(max_values)
+		if not split:
+			return [self]
+		for x, parts, index in split:
+			if not self.parts[x][0]:
+				raise BadRequest(description="Sub-query with more than %s results must be used with in" % max_values)
+		text = u"".join([self._render(p) for p in self.parts if isinstance(p, basestring)])
+		text = re.sub(r"'(?:[^']|'')*'|`[^`]*`", "", text)
+		if re.search(r"\bnot\b", text, re.I):
+			raise BadRequest(description="Sub-query with more than %s results can't be used with not" % max_values)
+		num = reduce(lambda a, b: a * b, [len(parts) for x, parts, index in split])
+		if max_selects and num > max_selects:
+			raise BadRequest(description="Sub-queries returned too many results, they need %s selects" % num)
+		selects = []
+		for combo in itertools.product(*[parts for x, parts, index in split]):
+			ids = dict(zip([x for x, parts, index in split], combo))
+			selects.append(u"".join([self._render(p, ids.get(x)) for x, p in enumerate(self.parts)]))
+		return selects
+
+	def owner(self, item, max_values):
+		"""
+		Index of the select from chunks which should return an item.
+		That's the one with the first chunk holding any of the item's
+		values for each sub-query, which always matches it, since
+		without negation a select can only match more items when it
+		has more of their values.
+		"""
+		owner = 0
+		for x, parts, index in self.split(max_values):
+			name = self.parts[x][0]
+			if name == "itemName()":
+				values = [item.name]
+			else:
+				values = item.get(name.strip("`"))
+				if values is None:
+					values = []
+				elif not isinstance(values, list):
+					values = [values]
+			found = [index[v] for v in values if v in index]
+			owner = owner * len(parts) + min(found or [0])
+		return owner
+
+
+def like_match(pattern, value):
+	"""Check a value against an SDB "like" pattern"""
+	regex = ".*".join([re.escape(p) for p in pattern.split("%")])
+	return re.match("^%s$" % regex, value, re.S) is not None
+
+
+def match_term(item, name, op, value):
+	"""Check if an item returned by a select matches one comparison,
+	as built by SDBManager._filter_term. Comparisons we can't check
+	are assumed to match."""
+	if name == "itemName()":
+		values = [item.name]
+	else:
+		values = item.get(name)
+		if values is None:
+			values = []
+		elif not isinstance(values, list):
+			values = [values]
+	if op == "is null":
+		return not values
+	if op == "is not null":
+		return bool(values)
+	if op in ("=", "is"):
+		return value in values
+	if op == "like":
+		return len([v for v in values if like_match(value, v)]) > 0
+	return True
+
+
+def encode_token(states):
+	"""Merged next token, from the (token, skip) state of each part"""
+	return TOKEN_PREFIX + base64.urlsafe_b64encode(json.dumps(states))
+
+
+def decode_token(token, num_parts):
+	"""Get the state of each part back from a merged next token.
+	A state of None means that part has no more results."""
+	if token is None:
+		return [[None, 0]] * num_parts
+	try:
+		if not token.startswith(TOKEN_PREFIX):
+			raise ValueError(token)
+		states = json.loads(base64.urlsafe_b64decode(str(token[len(TOKEN_PREFIX):])))
+		if not isinstance(states, list) or len(states) != num_parts:
+			raise ValueError(token)
+	except (ValueError, TypeError):
+		raise BadRequest(description="Invalid next_token")
+	return states
+
+
+class _Part(object):
+	"""Cursor over the results of one of the split selects. The next
+	page is only fetched once the merge asks for the item after the
+	last one it took."""
+
+	def __init__(self, index, rs, skip=0, done=False):
+		self.index = index
+		self.rs = rs
+		self.skip = skip
+		self.done = done
+		self.page = None
+		self._head = None
+		self._stale = False
+
+	def start(self):
+		"""Fetch the first page, run on a worker thread for each part"""
+		if self.done:
+			return
+		self.pages = self.rs.pages()
+		self.page_token = self.rs.next_token
+		self.page = self._fetch()
+		self.pos = self.skip
+		self._fill()
+
+	def _fetch(self):
+		try:
+			return self.pages.next()
+		except StopIteration:
+			return None
+
+	def _fill(self):
+		while self.page is not None and self.pos >= len(self.page):
+			self.page_token = self.page.next_token
+			if self.page_token is None:
+				self.page = None
+			else:
+				self.page = self._fetch()
+				self.pos = 0
+		if self.page is None:
+			self._head = None
+		else:
+			self._head = self.page[self.pos]
+		self._stale = False
+
+	@property
+	def head(self):
+		if self._stale:
+			self._fill()
+		return self._head
+
+	def pop(self):
+		item = self.head
+		self.pos += 1
+		self._stale = True
+		return item
+
+	def state(self):
+		"""Where to pick up from, None if there's nothing left"""
+		if self.page is None:
+			return None
+		if self.pos < len(self.page):
+			return [self.page_token, self.pos]
+		# This page is used up, start from the next one without fetching it
+		if self.page.next_token is None:
+			return None
+		return [self.page.next_token, 0]
+
+
+class MergedResultSet(object):
+	"""Iterates over the results of several split selects as one.
+
+	Without sort_by the parts are returned one after another, otherwise
+	they're merged in sort_by order. Either way next_token, once
+	iteration stops, picks up exactly where this left off.
+
+	:param result_sets: One (ReadAheadResultSet, state) for each part,
+		state being the part's entry from decode_token
+	:type result_sets: list
+
+	:param owner: Function which takes an item and returns the index of
+		the part that should return it, or None if any part can
+	:type owner: function
+
+	:param sort_by: Property name to sort on, prefixed with "-" for
+		descending order
+	:type sort_by: str
+
+	:param group_size: When querying several domains, the parts come in
+		groups of this many, one group per domain, and owner returns
+		the index of the part within its group
+	:type group_size: int
+	"""
+
+	def __init__(self, result_sets, owner, sort_by=None, max_items=None, next_token=None, max_workers=None, group_size=None):
+		self.result_sets = result_sets
+		self.owner = owner
+		self.group_size = group_size
+		self.sort_by = sort_by
+		self.max_items = max_items
+		self.next_token = next_token
+		self.max_workers = max_workers
+
+	def sort_key(self, item):
+		name = self.sort_by.lstrip("-")
+		if name in ("__id__", "itemName()"):
+			return item.name
+		value = item.get(name)
+		if isinstance(value, list):
+			value = min(value or [""])
+		return value or ""
+
+	def _pick(self, parts):
+		if not self.sort_by:
+			return parts[0]
+		desc = self.sort_by.startswith("-")
+		best = None
+		for part in parts:
+			key = self.sort_key(part.head)
+			# Strict comparisons, so ties go to the lowest part
+			if best is None or (key > best_key if desc else key < best_key):
+				best, best_key = part, key
+		return best
+
+	def __iter__(self):
+		parts = []
+		for x, (rs, state) in enumerate(self.result_sets):
+			if state is None:
+				parts.append(_Part(x, rs, done=True))
+			else:
+				parts.append(_Part(x, rs, skip=state[1]))
+		# The first page of every part is fetched at the same time
+		parallel_map(lambda part: part.start(), parts, self.max_workers)
+
+		num_results = 0
+		while True:
+			if self.max_items and num_results >= self.max_items:
+				states = [p.state() for p in parts]
+				self.next_token = None
+				if [state for state in states if state is not None]:
+					self.next_token = encode_token(states)
+				return
+			live = [p for p in parts if p.head is not None]
+			if not live:
+				self.next_token = None
+				return
+			part = self._pick(live)
+			item = part.pop()
+			if self.owner is not None:
+				index = part.index
+				if self.group_size:
+					index = index % self.group_size
+				owner = self.owner(item)
+				if owner is not None and owner != index:
+					# Another part returns this one
+					continue
+			yield item
+			num_results += 1
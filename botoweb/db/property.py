@@ -58,6 +58,10 @@ class Property(object):
 		#log.info('%s,%s' % (self.slot_name,objtype))
 		#log.info(self.verbose_name)
 		if obj:
+			partial = getattr(obj, "_partial", None)
+			if partial is not None and self.name not in partial:
+				# Only some properties were fetched, go get the rest
+				obj._loaded = False
 			obj.load()
 			return getattr(obj, self.slot_name)
 		else:
@@ -76,6 +80,11 @@ class Property(object):
 			boto.log.exception('Exception running on_set_%s' % self.name)
 
 		setattr(obj, self.slot_name, value)
+		# Track which properties changed since the object was loaded,
+		# so saving it only has to write those
+		dirty = getattr(obj, '_dirty', None)
+		if dirty is not None:
+			dirty.add(self.name)
 
 	def __property_config__(self, model_class, property_name):
 		self.model_class = model_class
@@ -485,6 +494,10 @@ class ReferenceProperty(Property):
 
 	def __get__(self, obj, objtype):
 		if obj:
+			partial = getattr(obj, "_partial", None)
+			if partial is not None and self.name not in partial:
+				obj._loaded = False
+				obj.load()
 			value = getattr(obj, self.slot_name)
 			if value == self.default_value():
 				return value
@@ -603,12 +616,23 @@ class ListProperty(Property):
 	data_type = list
 	type_name = 'List'
 
-	def __init__(self, item_type, verbose_name=None, name=None, default=None, **kwds):
+	def __init__(self, item_type, verbose_name=None, name=None, default=None, shadow=False, **kwds):
+		"""
+		:param shadow: Also store the plain values in a "_raw_<name>"
+			attribute, so SimpleDB can match them with an indexed "="
+			instead of a "like '%:value'" that scans the whole domain
+		:type shadow: bool
+		"""
 		if default is None:
 			default = []
 		self.item_type = item_type
+		self.shadow = shadow
 		Property.__init__(self, verbose_name, name, default=default, required=True, **kwds)
 
+	@property
+	def shadow_name(self):
+		return '_raw_%s' % self.name
+
 	def validate(self, value):
 		if self.validator:
 			self.validator(value)
@@ -19,10 +19,32 @@
 # WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
 # IN THE SOFTWARE.
+import boto
 
 class Query(object):
-	'''Lazy loading Query resource, which lets us filter results'''
+	'''Lazy loading Query resource, which lets us filter results.
+
+	The results of the first complete iteration are kept, so iterating
+	again and count() don't go back to the datastore, and len() can be
+	used. Only up to
+	memo_size results (the "query_memo_size" option in the [DB] config
+	section) are kept, bigger result sets are streamed every time so
+	exports don't hold everything in memory. Call refresh() to re-run
+	the query.
+
+	For classes in the object cache, from_cache() only selects the IDs
+	of the results and fills the objects in from the cache. The number
+	of results found in the cache the last time it ran are kept in
+	cache_hits and cache_misses.'''
 	__local_iter__ = None
+	_peeked = None
+	_results = None
+	_results_limit = None
+	_exhaustive = False
+	memo_size = None
+	hydrate = False
+	cache_hits = 0
+	cache_misses = 0
 
 	def __init__(self, model_class, limit=None, next_token=None, manager=None):
 		self.model_class = model_class
@@ -34,20 +56,83 @@ class Query(object):
 			self.manager = self.model_class._manager
 		self.filters = []
 		self.select = None
+		self.fields = None
 		self.sort_by = None
 		self.rs = None
 		self.next_token = next_token
 
 	def __iter__(self):
-		return iter(self.manager.query(self))
+		# Nothing is decided until the first item is asked for, since
+		# list() calls len() after iter() but before iterating
+		if self._results is not None and self._results_limit == self.limit:
+			for obj in self._results:
+				yield obj
+			return
+		start_token = self.next_token
+		results = self.manager.query(self)
+		memo_size = self.memo_size
+		if memo_size is None:
+			memo_size = boto.config.getint('DB', 'query_memo_size', 1000)
+		kept = []
+		for obj in results:
+			if kept is not None:
+				if len(kept) < memo_size:
+					kept.append(obj)
+				else:
+					# Too many to keep, just stream them
+					kept = None
+			yield obj
+		if kept is not None:
+			self._results = kept
+			self._results_limit = self.limit
+			# Only when we started at the beginning and went all the way
+			# to the end is this every matching result
+			self._exhaustive = (start_token is None and self.limit is None
+				and getattr(self.rs, 'next_token', None) is None)
+
+	def __len__(self):
+		'''Number of results, once they've been kept by iterating over
+		the query. It doesn't run the query, since list() calls len()
+		before iterating, so use count() otherwise'''
+		if self._results is not None and self._results_limit == self.limit:
+			return len(self._results)
+		raise TypeError("Query results aren't loaded, use count()")
+
+	def __nonzero__(self):
+		# Don't run the whole query just to test the truth value
+		return True
+
+	def refresh(self):
+		'''Forget any kept results, so the query is run again
+		the next time it is used'''
+		self._results = None
+		self._exhaustive = False
+		self.__local_iter__ = None
+		self._peeked = None
+		self.rs = None
+		return self
 
 	def next(self):
+		if self._peeked:
+			return self._peeked.pop()
 		if self.__local_iter__ == None:
 			self.__local_iter__ = self.__iter__()
 		return self.__local_iter__.next()
 
+	def peek(self):
+		'''Fetch the next result now, without consuming it, so the
+		request for the first page is made straight away.
+		Returns None if there are no more results.'''
+		if not self._peeked:
+			try:
+				self._peeked = [self.next()]
+			except StopIteration:
+				return None
+		return self._peeked[0]
+
 	def filter(self, property_operator, value):
 		self.filters.append((property_operator, value))
+		self._results = None
 		return self
 
 	def fetch(self, limit, offset=0):
@@ -55,9 +140,13 @@ class Query(object):
 		to allow them to set a limit in a chainable method'''
 		self.limit = limit
 		self.offset = offset
+		self._results = None
+		self._exhaustive = False
 		return self
 
 	def count(self, quick=True):
+		if self._results is not None and self._exhaustive:
+			return len(self._results)
 		return self.manager.count(self.model_class, self.filters, quick, self.sort_by, self.select)
 
 	def get_query(self):
@@ -65,6 +154,33 @@ class Query(object):
 
 	def order(self, key):
 		self.sort_by = key
+		self._results = None
+		return self
+
+	def from_cache(self, hydrate=True):
+		'''Only select the IDs of the results, and get the objects
+		from the object cache, fetching the ones that aren't cached
+		in batches. Only used for classes with __cache_ttl__ set'''
+		self.hydrate = hydrate
+		self._results = None
+		return self
+
+	@property
+	def hit_ratio(self):
+		'''Share of the results found in the object cache, the last
+		time this query was run from the cache, or None'''
+		total = self.cache_hits + self.cache_misses
+		if not total:
+			return None
+		return float(self.cache_hits) / total
+
+	def select_fields(self, *names):
+		'''Only fetch these properties. Objects returned are partially
+		loaded, any other property is fetched the first time it's used'''
+		if len(names) == 1 and isinstance(names[0], (list, tuple)):
+			names = names[0]
+		self.fields = list(names) or None
+		self._results = None
 		return self
 	
 	def to_xml(self, doc=None):
@@ -84,6 +200,9 @@ class Query(object):
 
 	def set_next_token(self, token):
 		self._next_token = token
+		# A different page of results
+		self._results = None
+		self._exhaustive = False
 
 	next_token = property(get_next_token, set_next_token)
 
@@ -97,6 +216,7 @@ class LocalQuery(Query):
 		self.next_token = next_token
 		self.iterator = iterator
 		self.sort_by = None
+		self.fields = None
 		self.model_class = model_class
 		self.rs = None
 		self.counter = None
@@ -0,0 +1,147 @@
+# Copyright (c) 2014 Chris Moyer http://coredumped.org/
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+# Author: Chris Moyer http://coredumped.org/
+# Description: Read-ahead replacement for boto's SelectResultSet.
+# While the caller works through one page of results (usually
+# serializing them), the next pages are fetched on a background thread,
+# so streaming a big result takes as long as the slower of the two
+# instead of the sum of both.
+
+import sys
+import threading
+from Queue import Queue, Full
+
+import boto
+
+import logging
+log = logging.getLogger('botoweb.db.readahead')
+
+
+class ReadAheadResultSet(object):
+	"""Iterates over the results of an SDB select like SelectResultSet,
+	but keeps up to ``depth`` pages fetched ahead of the caller.
+
+	The first page is fetched in the calling thread, a background thread
+	is only started if there are more pages wanted after that.
+	Stopping early (or hitting max_items) stops the background thread.
+
+	:param depth: Number of pages to fetch ahead, 0 disables read-ahead.
+		By default this is the "read_ahead" option in the [DB] section.
+	:type depth: int
+
+	:param retry: Optional RetryPolicy each page fetch is run through
+	:type retry: :class:`~botoweb.db.retry.RetryPolicy`
+	"""
+
+	def __init__(self, domain=None, query='', max_items=None,
+			next_token=None, consistent_read=False, depth=None, retry=None):
+		if depth is None:
+			depth = boto.config.getint('DB', 'read_ahead', 1)
+		self.domain = domain
+		self.query = query
+		self.max_items = max_items
+		self.next_token = next_token
+		self.consistent_read = consistent_read
+		self.depth = depth
+		self.retry = retry
+
+	def fetch_page(self, next_token):
+		"""Fetch one page of results"""
+		args = (self.domain, self.query)
+		kwargs = dict(next_token=next_token, consistent_read=self.consistent_read)
+		if self.retry:
+			return self.retry(self.domain.connection.select, *args, **kwargs)
+		return self.domain.connection.select(*args, **kwargs)
+
+	def pages(self):
+		"""Generate each page of results. As soon as the first page is
+		in, the following pages start being fetched in the background."""
+		rs = self.fetch_page(self.next_token)
+		fetched = len(rs)
+		if rs.next_token is None or (self.max_items and fetched >= self.max_items):
+			yield rs
+			return
+		if self.depth <= 0:
+			yield rs
+			token = rs.next_token
+			while token is not None and not (self.max_items and fetched >= self.max_items):
+				rs = self.fetch_page(token)
+				fetched += len(rs)
+				token = rs.next_token
+				yield rs
+			return
+
+		queue = Queue(maxsize=self.depth)
+		stop = threading.Event()
+
+		def put(entry):
+			# Give up if the consumer went away
+			while not stop.is_set():
+				try:
+					queue.put(entry, timeout=0.5)
+					return True
+				except Full:
+					pass
+			return False
+
+		def producer(token, fetched):
+			try:
+				while token is not None and not (self.max_items and fetched >= self.max_items):
+					page = self.fetch_page(token)
+					fetched += len(page)
+					token = page.next_token
+					if not put(('page', page)):
+						return
+			except Exception:
+				put(('error', sys.exc_info()))
+				return
+			put(('end', None))
+
+		t = threading.Thread(target=producer, args=(rs.next_token, fetched), name='ReadAhead')
+		t.daemon = True
+		t.start()
+		try:
+			yield rs
+			while True:
+				kind, value = queue.get()
+				if kind == 'end':
+					return
+				if kind == 'error':
+					raise value[0], value[1], value[2]
+				yield value
+		finally:
+			stop.set()
+
+	def __iter__(self):
+		num_results = 0
+		for rs in self.pages():
+			for item in rs:
+				if self.max_items and num_results >= self.max_items:
+					return
+				yield item
+				num_results += 1
+			self.next_token = rs.next_token
+			if self.max_items and num_results >= self.max_items:
+				return
+
+	def next(self):
+		return next(self.__iter__())
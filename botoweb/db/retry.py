@@ -0,0 +1,247 @@
+# Copyright (c) 2014 Chris Moyer http://coredumped.org/
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+# Author: Chris Moyer http://coredumped.org/
+# Description: Shared retry policy and circuit breaker for datastore calls.
+# Every manager runs its remote calls through a RetryPolicy, which
+# retries with jittered exponential backoff inside a fixed time budget,
+# and trips a per-endpoint CircuitBreaker when the endpoint keeps failing
+# so that further calls fail fast instead of tying up worker threads.
+
+import time
+import random
+import socket
+import threading
+
+import boto
+from botoweb.exceptions import ServiceUnavailable
+
+import logging
+log = logging.getLogger('botoweb.db.retry')
+
+
+class CircuitOpenError(ServiceUnavailable):
+	"""Raised instead of calling an endpoint whose circuit is open"""
+
+	def __init__(self, endpoint):
+		self.endpoint = endpoint
+		ServiceUnavailable.__init__(self, description='Datastore %s is temporarily unavailable' % endpoint)
+
+
+class CircuitBreaker(object):
+	"""Per-endpoint circuit breaker.
+
+	The breaker starts CLOSED. After ``threshold`` consecutive failures it
+	goes OPEN and rejects every call for ``reset_timeout`` seconds, after
+	which it goes HALF_OPEN and lets a single trial call through. A success
+	closes the circuit again, a failure re-opens it.
+	"""
+	CLOSED = 'closed'
+	OPEN = 'open'
+	HALF_OPEN = 'half-open'
+
+	def __init__(self, endpoint, threshold=5, reset_timeout=30.0, clock=time.time):
+		self.endpoint = endpoint
+		self.threshold = threshold
+		self.reset_timeout = reset_timeout
+		self.clock = clock
+		self.failures = 0
+		self.opened_at = None
+		self._state = self.CLOSED
+		self._trial = False
+		self._lock = threading.Lock()
+
+	@property
+	def state(self):
+		with self._lock:
+			return self._current_state()
+
+	def _current_state(self):
+		if self._state == self.OPEN and self.clock() - self.opened_at >= self.reset_timeout:
+			self._state = self.HALF_OPEN
+			self._trial = False
+		return self._state
+
+	def allow(self):
+		"""Returns True if a call may be made to this endpoint right now"""
+		with self._lock:
+			state = self._current_state()
+			if state == self.CLOSED:
+				return True
+			if state == self.HALF_OPEN and not self._trial:
+				# Only one trial request goes through while half-open
+				self._trial = True
+				return True
+			return False
+
+	def record_success(self):
+		with self._lock:
+			self.failures = 0
+			self._trial = False
+			self._state = self.CLOSED
+
+	def record_failure(self):
+		with self._lock:
+			self.failures += 1
+			if self._state == self.HALF_OPEN or self.failures >= self.threshold:
+				if self._state != self.OPEN:
+					log.warn('Opening circuit for %s after %s failures' % (self.endpoint, self.failures))
+				self._state = self.OPEN
+				self.opened_at = self.clock()
+				self._trial = False
+
+	def reset(self):
+		self.record_success()
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+def get_breaker(endpoint):
+	"""Get the shared CircuitBreaker for this endpoint, creating it
+	from the [DB] config the first time it is requested"""
+	with _breakers_lock:
+		breaker = _breakers.get(endpoint)
+		if breaker is None:
+			breaker = CircuitBreaker(endpoint,
+				threshold=boto.config.getint('DB', 'breaker_threshold', 5),
+				reset_timeout=boto.config.getfloat('DB', 'breaker_reset', 30.0))
+			_breakers[endpoint] = breaker
+		return breaker
+
+
+def is_retryable(e):
+	"""Default check for whether an exception is worth retrying.
+	Network level errors and server side (5xx) or throttling errors are,
+	client errors such as a bad query or a failed conditional put are not"""
+	from boto.exception import BotoServerError
+	import httplib
+	import ssl
+	if isinstance(e, BotoServerError):
+		if e.status is None or e.status >= 500:
+			return True
+		return e.error_code in ('Throttling', 'ThrottlingException',
+			'ProvisionedThroughputExceededException', 'RequestTimeout')
+	return isinstance(e, (socket.error, httplib.HTTPException, ssl.SSLError))
+
+
+class RetryPolicy(object):
+	"""Retry a callable with full-jitter exponential backoff.
+
+	:param endpoint: Name of the endpoint being called, used to pick the
+		shared CircuitBreaker. Pass None to disable the breaker.
+	:type endpoint: str
+
+	:param max_attempts: Maximum number of calls to make
+	:type max_attempts: int
+
+	:param budget: Total number of seconds, including sleeps, that we may
+		spend on one call before giving up
+	:type budget: float
+
+	:param base_delay: Backoff before the second attempt, doubled for
+		each attempt after that (before jitter)
+	:type base_delay: float
+
+	:param max_delay: Upper bound for a single backoff
+	:type max_delay: float
+
+	:param retryable: Function which takes an exception and returns True
+		if the call should be retried
+	:type retryable: function
+	"""
+
+	def __init__(self, endpoint=None, max_attempts=None, budget=None, base_delay=None,
+				max_delay=None, retryable=is_retryable, breaker=None,
+				sleep=time.sleep, clock=time.time):
+		if max_attempts is None:
+			max_attempts = boto.config.getint('DB', 'retry_attempts', 5)
+		if budget is None:
+			budget = boto.config.getfloat('DB', 'retry_budget', 10.0)
+		if base_delay is None:
+			base_delay = boto.config.getfloat('DB', 'retry_base_delay', 0.1)
+		if max_delay is None:
+			max_delay = boto.config.getfloat('DB', 'retry_max_delay', 2.0)
+		self.endpoint = endpoint
+		self.max_attempts = max_attempts
+		self.budget = budget
+		self.base_delay = base_delay
+		self.max_delay = max_delay
+		self.retryable = retryable
+		if breaker is None and endpoint:
+			breaker = get_breaker(endpoint)
+		self.breaker = breaker
+		self.sleep = sleep
+		self.clock = clock
+
+	def backoff(self, attempt):
+		"""Number of seconds to wait after the given (1-based) failed attempt"""
+		ceiling = min(self.max_delay, self.base_delay * (2 ** (attempt - 1)))
+		return random.uniform(0, ceiling)
+
+	def call(self, fnc, *args, **kwargs):
+		"""Call fnc(*args, **kwargs), retrying on retryable errors"""
+		deadline = self.clock() + self.budget
+		attempt = 0
+		while True:
+			if self.breaker and not self.breaker.allow():
+				raise CircuitOpenError(self.breaker.endpoint)
+			attempt += 1
+			try:
+				ret = fnc(*args, **kwargs)
+			except Exception, e:
+				if not self.retryable(e):
+					# The endpoint answered, it just didn't like the request
+					if self.breaker:
+						self.breaker.record_success()
+					raise
+				if self.breaker:
+					self.breaker.record_failure()
+				delay = self.backoff(attempt)
+				if attempt >= self.max_attempts or self.clock() + delay > deadline:
+					log.error('Giving up on %s after %s attempts: %s' % (self.endpoint, attempt, e))
+					raise
+				log.warn('Retrying %s in %.02fs (attempt %s): %s' % (self.endpoint, delay, attempt, e))
+				self.sleep(delay)
+			else:
+				if self.breaker:
+					self.breaker.record_success()
+				return ret
+
+	__call__ = call
+
+	def iterate(self, make_iter):
+		"""Iterate over make_iter(), retrying the whole iteration only if
+		it fails before anything was yielded, so callers never see
+		duplicate items"""
+		def first():
+			it = iter(make_iter())
+			try:
+				item = it.next()
+			except StopIteration:
+				return None, None
+			return it, item
+		it, item = self.call(first)
+		if it is None:
+			return
+		yield item
+		for item in it:
+			yield item
@@ -19,7 +19,21 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
 # IN THE SOFTWARE.
 
+import time
+import threading
+
+import boto
 from boto.exception import SDBResponseError
+from botoweb.db.retry import RetryPolicy
+
+import logging
+log = logging.getLogger('botoweb.db.sequence')
+
+
+class SequenceConflict(ValueError):
+	"""Another process changed the sequence since we read it"""
+	pass
+
 
 class SequenceGenerator(object):
 	"""Generic Sequence Generator object, this takes a single
@@ -104,10 +118,21 @@ increment_string = SequenceGenerator("ABCDEFGHIJKLMNOPQRSTUVWXYZ")
 class Sequence(object):
 	"""A simple Sequence using the new SDB "Consistent" features
 	Based largly off of the "Counter" example from mitch garnaat:
-	http://bitbucket.org/mitch/stupidbototricks/src/tip/counter.py"""
+	http://bitbucket.org/mitch/stupidbototricks/src/tip/counter.py
 
+	By default every call to next() reads the sequence and writes the
+	new value, raising ValueError if another process wrote first. With
+	block_size set, one write reserves that many values, which next()
+	then hands out from memory, so most calls don't touch SDB at all.
+	Values reserved by a process that stops are never used, and values
+	from different processes interleave, so block mode leaves gaps and
+	doesn't keep strict order. gap_free reserves one value at a time
+	instead, which keeps them in order without gaps. In both modes a
+	reservation that conflicts with another process is retried."""
 
-	def __init__(self, id=None, domain_name=None, fnc=increment_by_one, init_val=None):
+
+	def __init__(self, id=None, domain_name=None, fnc=increment_by_one, init_val=None,
+			block_size=1, gap_free=False, max_attempts=None):
 		"""Create a new Sequence, using an optional function to 
 		increment to the next number, by default we just increment by one.
 		Every parameter here is optional, if you don't specify any options
@@ -130,7 +155,29 @@ class Sequence(object):
 		:param init_val: Initial value, by default this is the first element in your sequence, 
 			but you can pass in any value, even a string if you pass in a function that uses
 			strings instead of ints to increment
+
+		:param block_size: Number of values to reserve with each write
+		:type block_size: int
+
+		:param gap_free: Reserve one value at a time, so values are handed
+			out in strict order with no gaps, retrying on conflict
+		:type gap_free: bool
+
+		:param max_attempts: Most times to try a reservation that keeps
+			conflicting, by default "sequence_attempts" in [DB]
+		:type max_attempts: int
 		"""
+		if max_attempts is None:
+			max_attempts = boto.config.getint('DB', 'sequence_attempts', 10)
+		self.block_size = max(1, block_size or 1)
+		self.gap_free = gap_free
+		self.retry = RetryPolicy(max_attempts=max_attempts, base_delay=0.01, max_delay=0.5,
+			retryable=lambda e: isinstance(e, SequenceConflict))
+		# Reserved (value, last value) pairs not handed out yet
+		self._block = []
+		self._block_end = None
+		self._issued = None
+		self._lock = threading.Lock()
 		self._db = None
 		self._value = None
 		self.last_value = None
@@ -157,13 +204,18 @@ class Sequence(object):
 
 	def set(self, val):
 		"""Set the value"""
-		import time
+		self._write(val, self._value)
+
+	def _write(self, val, last_value):
+		"""Write a new value, as long as the stored value is still
+		the one we last read"""
 		now = time.time()
 		expected_value = []
 		new_val = {}
 		new_val['timestamp'] = now
 		if self._value != None:
-			new_val['last_value'] = self._value
+			if last_value != None:
+				new_val['last_value'] = last_value
 			expected_value = ['current_value', str(self._value)]
 		new_val['current_value'] = val
 		try:
@@ -171,7 +223,7 @@ class Sequence(object):
 			self.timestamp = new_val['timestamp']
 		except SDBResponseError, e:
 			if e.status == 409:
-				raise ValueError, "Sequence out of sync"
+				raise SequenceConflict, "Sequence out of sync"
 			else:
 				raise
 
@@ -218,9 +270,69 @@ class Sequence(object):
 	db = property(_connect)
 
 	def next(self):
+		"""Get the next value, see the class for how they're reserved"""
+		if self.gap_free:
+			with self._lock:
+				(val, last) = self.retry(self._reserve, 1)[0]
+				self._issued = (val, last)
+				return val
+		if self.block_size > 1:
+			with self._lock:
+				if not self._block:
+					self._block = self.retry(self._reserve, self.block_size)
+				(val, last) = self._block.pop(0)
+				self._issued = (val, last)
+				return val
 		self.val = self.fnc(self.val, self.last_value)
 		return self.val
 
+	def _reserve(self, count):
+		"""
+		Reserve the next count values with one conditional write.
+		Raises SequenceConflict if another process wrote first.
+
+		:return: (value, last value) pairs of the values reserved
+		"""
+		current = self.get()
+		last = self.last_value
+		start = (current, last)
+		values = []
+		for n in range(count):
+			(current, last) = (self.fnc(current, last), current)
+			values.append((current, last))
+		self._write(current, last)
+		self._value = current
+		self._block_end = current
+		# Until one is handed out, the last value issued is the one
+		# the block starts after
+		self._issued = start
+		log.debug('Reserved %s values of sequence %s' % (count, self.id))
+		return values
+
+	def release(self):
+		"""
+		Give back the values reserved but not handed out yet, so the
+		next reservation starts with them. This only works if no other
+		process has reserved values since, otherwise they're skipped.
+
+		:return: Number of values given back
+		:rtype: int
+		"""
+		with self._lock:
+			if not self._block:
+				return 0
+			count = len(self._block)
+			(val, last) = self._issued
+			self._block = []
+			self._value = self._block_end
+			try:
+				self._write(val, last)
+			except SequenceConflict:
+				log.info('Could not give back %s values of sequence %s' % (count, self.id))
+				return 0
+			self._value = val
+			return count
+
 	def delete(self):
 		"""Remove this sequence"""
 		self.db.delete_attributes(self.id)
@@ -0,0 +1,202 @@
+# Copyright (c) 2014 Chris Moyer http://coredumped.org/
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+# Author: Chris Moyer http://coredumped.org/
+# Description: Uniqueness index for SimpleDB.
+# Each value of a unique property is claimed by writing an item to a
+# separate domain, keyed by (class, property, value), with a conditional
+# put that only succeeds if nobody owns it yet. That makes the check a
+# single atomic round trip, which is safe under concurrent creates unlike
+# running a select before writing. Values we know we own are cached
+# locally so re-saving an object doesn't need any calls at all.
+#
+# Enable it by naming the index domain in the config:
+#
+#	[DB]
+#	unique_domain = my_domain_unique
+#
+# Existing data must be added to the index with UniqueIndex.rebuild()
+# before switching it on.
+
+import time
+import hashlib
+import threading
+
+import boto
+from boto.exception import SDBResponseError, SDBPersistenceError
+
+import logging
+log = logging.getLogger('botoweb.db.unique')
+
+
+class UniqueIndex(object):
+	"""Uniqueness index stored in its own SDB domain
+
+	:param manager: The SDBManager whose connection and retry policy we use
+	:type manager: :class:`~botoweb.db.manager.sdbmanager.SDBManager`
+
+	:param domain_name: Name of the domain to store the index in
+	:type domain_name: str
+
+	:param cache_size: Maximum number of owned values to remember
+	:type cache_size: int
+
+	:param stale_after: Seconds after which a claim whose owner doesn't
+		have the value (any more) may be taken over. Until then the
+		owner may still be in the middle of saving.
+	:type stale_after: int
+	"""
+
+	def __init__(self, manager, domain_name, cache_size=None, stale_after=None):
+		if cache_size is None:
+			cache_size = boto.config.getint('DB', 'unique_cache_size', 10000)
+		if stale_after is None:
+			stale_after = boto.config.getint('DB', 'unique_stale_after', 300)
+		self.manager = manager
+		self.domain_name = domain_name
+		self.cache_size = cache_size
+		self.stale_after = stale_after
+		self._domain = None
+		self._cache = {}
+		self._lock = threading.Lock()
+
+	@property
+	def domain(self):
+		if self._domain is None:
+			sdb = self.manager.sdb
+			self._domain = sdb.lookup(self.domain_name, validate=False)
+			if not self._domain:
+				self._domain = sdb.create_domain(self.domain_name)
+		return self._domain
+
+	@staticmethod
+	def scope(cls, prop):
+		"""The class a unique property is unique within, which is the
+		class that declares it"""
+		for c in reversed(cls.__mro__):
+			if prop.name in c.__dict__:
+				return c
+		return cls
+
+	def key(self, cls, prop, value):
+		"""Item name in the index for this value"""
+		if isinstance(value, unicode):
+			value = value.encode('utf-8')
+		return hashlib.sha1('%s\0%s\0%s' % (self.scope(cls, prop).__name__, prop.name, value)).hexdigest()
+
+	def _remember(self, key, owner):
+		with self._lock:
+			if len(self._cache) >= self.cache_size:
+				self._cache.clear()
+			self._cache[key] = owner
+
+	def _forget(self, key):
+		with self._lock:
+			self._cache.pop(key, None)
+
+	def owner(self, key):
+		"""ID of the object that owns this key and when it was claimed,
+		or (None, None)"""
+		a = self.manager.retry(self.domain.get_attributes, key, ['owner', 'claimed_at'], consistent_read=True)
+		return (a.get('owner'), int(a.get('claimed_at') or 0))
+
+	def _is_stale(self, owner, claimed_at, prop, value):
+		"""Check if an old claim's owner no longer exists, or no longer
+		has this value"""
+		if time.time() - claimed_at < self.stale_after:
+			return False
+		obj = self.manager.get_object(None, owner)
+		if obj is None or obj._stored_attrs is None:
+			return True
+		stored = obj._stored_attrs.get(prop.name)
+		if isinstance(stored, list):
+			return value not in stored
+		return stored != value
+
+	def claim(self, obj, prop, value):
+		"""Claim this (encoded) value of a unique property for obj.
+
+		:raise: SDBPersistenceError if another object already owns it
+		"""
+		key = self.key(obj.__class__, prop, value)
+		if self._cache.get(key) == obj.id:
+			return
+		attrs = {'owner': obj.id, 'class': self.scope(obj.__class__, prop).__name__,
+			'property': prop.name, 'value': value[:1000], 'claimed_at': str(int(time.time()))}
+		expected = ['owner', False]
+		for attempt in range(3):
+			try:
+				self.manager.retry(self.domain.put_attributes, key, attrs, replace=True, expected_value=expected)
+				break
+			except SDBResponseError, e:
+				if e.status != 409:
+					raise
+			owner, claimed_at = self.owner(key)
+			if owner == obj.id:
+				break
+			if owner is None:
+				# Released since we tried
+				expected = ['owner', False]
+			elif self._is_stale(owner, claimed_at, prop, value):
+				# Left behind by a write that failed or an object that
+				# was changed without updating the index, take it over
+				log.info('Taking over stale unique %s=%s from %s' % (prop.name, value, owner))
+				expected = ['owner', owner]
+			else:
+				raise SDBPersistenceError("Error: %s must be unique!" % prop.name)
+		else:
+			raise SDBPersistenceError("Error: %s must be unique!" % prop.name)
+		self._remember(key, obj.id)
+
+	def release(self, obj, prop, value):
+		"""Release a value obj no longer uses, if it still owns it"""
+		key = self.key(obj.__class__, prop, value)
+		self._forget(key)
+		try:
+			self.manager.retry(self.domain.delete_attributes, key, expected_value=['owner', obj.id])
+		except SDBResponseError, e:
+			if e.status not in (404, 409):
+				raise
+
+	def rebuild(self, cls):
+		"""Add every existing object of this class to the index. Objects
+		which clash with one already indexed are logged and skipped.
+
+		:return: Number of values added
+		:rtype: int
+		"""
+		count = 0
+		for obj in cls.all():
+			for prop in obj.properties(hidden=False):
+				if not prop.unique or not obj._stored_attrs:
+					continue
+				values = obj._stored_attrs.get(prop.name)
+				if values is None:
+					continue
+				if not isinstance(values, list):
+					values = [values]
+				for value in values:
+					try:
+						self.claim(obj, prop, value)
+						count += 1
+					except SDBPersistenceError:
+						log.error('Duplicate %s.%s=%s on %s' % (cls.__name__, prop.name, value, obj.id))
+		return count
@@ -0,0 +1,270 @@
+# Copyright (c) 2014 Chris Moyer http://coredumped.org/
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+# Author: Chris Moyer http://coredumped.org/
+# Description: Write-behind queue for low priority updates.
+# Objects put on the queue are written by a background thread using
+# batched puts, either once enough of them are waiting or once the
+# oldest has waited long enough. Repeated writes to the same item
+# before a flush only result in one write.
+#
+# The queue is opt-in, either per call with Model.put_later(), or per
+# model by setting __write_behind__ = True on the class. Writes which
+# are still waiting are lost if the process is killed outright, so
+# this should only be used for updates which can afford that.
+
+import time
+import signal
+import atexit
+import threading
+
+import boto
+from botoweb.db.consistency import current_tracker
+
+import logging
+log = logging.getLogger('botoweb.db.writebehind')
+
+
+class WriteBehindQueue(object):
+	"""Coalescing queue of objects waiting to be saved
+
+	:param max_size: Flush as soon as this many items are waiting
+	:type max_size: int
+
+	:param max_delay: Flush once the oldest item has been waiting
+		this many seconds
+	:type max_delay: float
+
+	:param max_attempts: Number of flushes an object may fail in before
+		it is dropped
+	:type max_attempts: int
+	"""
+
+	def __init__(self, max_size=None, max_delay=None, max_attempts=3):
+		if max_size is None:
+			max_size = boto.config.getint('DB', 'write_behind_size', 25)
+		if max_delay is None:
+			max_delay = boto.config.getfloat('DB', 'write_behind_delay', 1.0)
+		self.max_size = max_size
+		self.max_delay = max_delay
+		self.max_attempts = max_attempts
+		self._pending = {}
+		self._order = []
+		self._attempts = {}
+		self._oldest = None
+		self._cond = threading.Condition()
+		self._flush_lock = threading.Lock()
+		self._thread = None
+		self._stopping = False
+
+		# Metrics
+		self.flushes = 0
+		self.written = 0
+		self.coalesced = 0
+		self.dropped = 0
+		self.errors = 0
+		self.last_flush_latency = None
+		self.max_flush_latency = 0.0
+
+	@property
+	def depth(self):
+		"""Number of items waiting to be written"""
+		return len(self._pending)
+
+	def stats(self):
+		"""Queue depth and flush metrics, as a dict"""
+		return {
+			'depth': self.depth,
+			'flushes': self.flushes,
+			'written': self.written,
+			'coalesced': self.coalesced,
+			'dropped': self.dropped,
+			'errors': self.errors,
+			'last_flush_latency': self.last_flush_latency,
+			'max_flush_latency': self.max_flush_latency,
+		}
+
+	def put(self, obj):
+		"""Queue this object to be saved. If the same item is already
+		waiting, the newest object replaces it."""
+		if not obj.id:
+			obj.id = obj._manager.new_id(obj)
+		# The write happens in the background, so it's recorded for
+		# read-your-writes as soon as it's queued
+		tracker = current_tracker()
+		if tracker is not None:
+			tracker.record(obj._manager.cls, [obj.id])
+		key = (obj.__class__.__name__, obj.id)
+		with self._cond:
+			if key in self._pending:
+				self.coalesced += 1
+			else:
+				self._order.append(key)
+			self._pending[key] = obj
+			if self._oldest is None:
+				self._oldest = time.time()
+			self._start()
+			if len(self._pending) >= self.max_size:
+				self._cond.notify()
+		return obj
+
+	def _take(self):
+		"""Remove everything that's waiting from the queue"""
+		with self._cond:
+			objs = [(key, self._pending[key]) for key in self._order]
+			self._pending = {}
+			self._order = []
+			self._oldest = None
+		return objs
+
+	def flush(self):
+		"""Write everything that's waiting right now, in this thread"""
+		from botoweb.db.batch import put_multi, BatchWriteError
+		with self._flush_lock:
+			items = self._take()
+			if not items:
+				return 0
+			start = time.time()
+			failed = []
+			try:
+				put_multi([obj for key, obj in items])
+			except BatchWriteError, e:
+				log.error('Write-behind flush failed for %s items: %s' % (len(e.failed), e))
+				failed = [(key, obj) for key, obj in items if obj in e.failed]
+			except Exception, e:
+				log.exception('Write-behind flush failed')
+				failed = items
+			latency = time.time() - start
+			self.flushes += 1
+			self.written += len(items) - len(failed)
+			self.last_flush_latency = latency
+			self.max_flush_latency = max(self.max_flush_latency, latency)
+			if failed:
+				self.errors += 1
+				self._requeue(failed)
+			else:
+				self._attempts = {}
+			log.debug('Flushed %s items in %.03fs, %s waiting' % (len(items) - len(failed), latency, self.depth))
+			return len(items) - len(failed)
+
+	def _requeue(self, failed):
+		"""Put objects that failed to write back on the queue, unless
+		they've already failed too many times"""
+		with self._cond:
+			for key, obj in failed:
+				attempts = self._attempts.get(key, 0) + 1
+				if attempts >= self.max_attempts:
+					log.error('Dropping write of %s<%s> after %s attempts' % (key[0], key[1], attempts))
+					self._attempts.pop(key, None)
+					self.dropped += 1
+					continue
+				self._attempts[key] = attempts
+				# A newer write for the same item wins
+				if key not in self._pending:
+					self._pending[key] = obj
+					self._order.append(key)
+			if self._pending and self._oldest is None:
+				self._oldest = time.time()
+
+	def _start(self):
+		"""Start the background thread, must be called holding the lock"""
+		if self._thread is None or not self._thread.is_alive():
+			self._stopping = False
+			self._thread = threading.Thread(target=self._run, name='WriteBehindQueue')
+			self._thread.daemon = True
+			self._thread.start()
+
+	def _run(self):
+		while True:
+			with self._cond:
+				while not self._stopping:
+					if len(self._pending) >= self.max_size:
+						break
+					if self._oldest is not None:
+						wait = self._oldest + self.max_delay - time.time()
+						if wait <= 0:
+							break
+						self._cond.wait(wait)
+					else:
+						self._cond.wait()
+				stopping = self._stopping
+			self.flush()
+			if stopping:
+				return
+
+	def stop(self, timeout=None):
+		"""Stop the background thread, writing everything still waiting"""
+		with self._cond:
+			self._stopping = True
+			self._cond.notify()
+			thread = self._thread
+		if thread is not None and thread is not threading.current_thread():
+			thread.join(timeout)
+		# Anything queued while we were stopping
+		while self.depth and self.flush():
+			pass
+
+	drain = stop
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+def get_queue():
+	"""The shared WriteBehindQueue, created on first use"""
+	global _queue
+	with _queue_lock:
+		if _queue is None:
+			_queue = WriteBehindQueue()
+			install_handlers()
+		return _queue
+
+
+def drain(timeout=None):
+	"""Write everything still waiting on the shared queue"""
+	if _queue is not None:
+		_queue.stop(timeout)
+
+
+_previous_handler = None
+_installed = False
+
+def _on_sigterm(signum, frame):
+	log.info('SIGTERM received, draining the write-behind queue')
+	drain(boto.config.getfloat('DB', 'write_behind_drain_timeout', 10.0))
+	if callable(_previous_handler):
+		_previous_handler(signum, frame)
+	elif _previous_handler != signal.SIG_IGN:
+		raise SystemExit(0)
+
+def install_handlers():
+	"""Drain the shared queue at exit and when we get a SIGTERM.
+	Signal handlers may only be installed from the main thread, so if
+	we're called from anywhere else we only register the exit hook."""
+	global _previous_handler, _installed
+	if _installed:
+		return
+	_installed = True
+	atexit.register(drain)
+	try:
+		_previous_handler = signal.signal(signal.SIGTERM, _on_sigterm)
+	except ValueError:
+		log.warn('Not in the main thread, write-behind queue will only be drained at exit')
@@ -46,6 +46,16 @@ def addCachedUser(user):
 		USER_CACHE[username] = (user, time.time())
 	return user
 
+def saveUser(user):
+	"""Save a new auth token for this user. If "write_behind_auth" is set
+	in the [DB] section this is written in the background, the user is
+	cached locally so later requests still see the new token"""
+	if boto.config.getbool('DB', 'write_behind_auth', False):
+		user.put_later()
+	else:
+		user.put()
+	return user
+
 class Request(webob.Request):
 	"""We add in a few special extra functions for us here."""
 	file_extension = "html"
@@ -162,7 +172,7 @@ class Request(webob.Request):
 				# Set up an Auth Token
 				bw_auth_token = "%s:%s" % (user.username, uuid.uuid4().hex)
 				user.auth_token = bw_auth_token
-				user.put()
+				saveUser(user)
 				self.cookies['BW_AUTH_TOKEN'] = bw_auth_token
 				addCachedUser(user)
 		except:
@@ -289,7 +299,7 @@ class Request(webob.Request):
 								# Set up an Auth Token
 								bw_auth_token = "%s:%s" % (user.username, uuid.uuid4().hex)
 								user.auth_token = bw_auth_token
-								user.put()
+								saveUser(user)
 							self.cookies['BW_AUTH_TOKEN'] = bw_auth_token
 							addCachedUser(user)
 						else:
@@ -363,7 +373,7 @@ class Request(webob.Request):
 								# Set up an Auth Token
 								bw_auth_token = "%s:%s" % (user.username, jr_auth_token)
 								user.auth_token = bw_auth_token
-								user.put()
+								saveUser(user)
 							self.cookies['BW_AUTH_TOKEN'] = bw_auth_token
 							addCachedUser(user)
 						else:
@@ -197,8 +197,9 @@ class XMLSerializer(object):
 	}
 
 
-	def dump(self, obj, objname = None):
-		"""Dump this object to our serialization"""
+	def dump(self, obj, objname = None, fields=None):
+		"""Dump this object to our serialization, optionally
+		only including the properties named in fields"""
 		from botoweb.db.coremodel import Model
 		from botoweb.db.dynamo import DynamoModel
 		from botoweb.db.property import CalculatedProperty, _ReverseReferenceProperty
@@ -219,6 +220,8 @@ class XMLSerializer(object):
 				self.file.write("<%s>" % objname)
 			if isinstance(obj, Model) or isinstance(obj, DynamoModel):
 				for prop in obj.properties():
+					if fields is not None and prop.name not in fields:
+						continue
 					if not prop.name.startswith("_"):
 						if isinstance(prop, CalculatedProperty):
 							# We encode calculated properties similar to queries because we don't
@@ -341,17 +344,17 @@ class XMLSerializer(object):
 
 
 
-def dump(obj, file=None, objname=None):
+def dump(obj, file=None, objname=None, fields=None):
 	"""Write an XML representation of *obj* to the open file object *file*
 	"""
 	enc = XMLSerializer(file)
-	enc.dump(obj, objname)
+	enc.dump(obj, objname, fields)
 	enc.file.seek(0)
 	return enc.file
 
-def dumps(obj, objname=None):
+def dumps(obj, objname=None, fields=None):
 	"""Dump the XML to a string, this is equivalent to dump(obj).read()"""
-	return dump(obj, objname=objname).read()
+	return dump(obj, objname=objname, fields=fields).read()
 
 def load(file):
 	"""Read a from the open file object *file* and interpret it as an XML serialization
@@ -37,7 +37,7 @@ setup(name = "botoweb",
 			'': ['*.yaml', 'conf/*.yaml', 'installer/*', 'filters/**/*', 'filters/*.xsl'],
 		},
 		license = 'MIT',
-		scripts = ['tools/botoweb', 'tools/botoweb_client', 'tools/bw_client_upload'],
+		scripts = ['tools/botoweb', 'tools/botoweb_client', 'tools/bw_client_upload', 'tools/bw_archive_deleted', 'tools/bw_reshard', 'tools/bw_drop_partitions'],
 		platforms = 'Posix; MacOS X; Windows',
 		classifiers = [
 			'Development Status :: 3 - Alpha',
@@ -0,0 +1,252 @@
+# Copyright (c) 2014 Chris Moyer http://coredumped.org/
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+# In-memory stand-in for a boto SimpleDB Domain, so the managers
+# can be tested without talking to SDB. select() understands simple
+# comparisons joined with AND/OR, "itemName() in (...)", ORDER BY and
+# limit, which is all the managers generate.
+import re
+from boto.exception import SDBResponseError
+
+TERM = re.compile(r"(`[^`]*`|itemName\(\)) (is not null|is null|not like|like|!=|>=|<=|=|>|<|in)(?: '((?:[^']|'')*)'| \(((?:'(?:[^']|'')*'(?:, )?)*)\))?", re.I)
+
+def _like(pattern, value):
+	regex = ".*".join(re.escape(p) for p in pattern.split("%"))
+	return re.match("^%s$" % regex, value, re.S) is not None
+
+def _compare(values, op, val):
+	"""SDB comparisons are true if any of the values matches"""
+	op = op.lower()
+	if op == "is null":
+		return not values
+	if op == "is not null":
+		return bool(values)
+	tests = {
+		"=": lambda v: v == val,
+		"!=": lambda v: v != val,
+		">": lambda v: v > val,
+		">=": lambda v: v >= val,
+		"<": lambda v: v < val,
+		"<=": lambda v: v <= val,
+		"like": lambda v: _like(val, v),
+		"not like": lambda v: not _like(val, v),
+		"in": lambda v: v in val,
+	}
+	return any(tests[op](v) for v in values)
+
+def _values(name, attrs):
+	if name == "itemName()":
+		return [attrs['__name__']]
+	value = attrs.get(name.strip("`"))
+	if value is None:
+		return []
+	if not isinstance(value, list):
+		value = [value]
+	return value
+
+class MemoryItem(dict):
+	"""Minimal boto.sdb.item.Item"""
+
+	def __init__(self, name, attrs=None):
+		dict.__init__(self, attrs or {})
+		self.name = name
+
+
+class MemoryPage(list):
+	"""One page of select results"""
+
+	def __init__(self, items, next_token=None):
+		list.__init__(self, items)
+		self.next_token = next_token
+
+
+class MemoryConnection(object):
+	"""Minimal SDBConnection, selects are passed on to the domain.
+	Domains created through it are kept, like they are in SDB."""
+
+	def __init__(self):
+		self.domains = {}
+
+	def create_domain(self, name):
+		if name not in self.domains:
+			self.domains[name] = MemoryDomain(name, self)
+		return self.domains[name]
+
+	def get_domain(self, name, validate=True):
+		if name not in self.domains:
+			raise SDBResponseError(400, 'NoSuchDomain')
+		return self.domains[name]
+
+	def lookup(self, name, validate=True):
+		if name in self.domains or validate:
+			return self.domains.get(name)
+		# Like SDB, using it fails until the domain is created
+		domain = MemoryDomain(name, self)
+		domain.unchecked = True
+		return domain
+
+	def get_all_domains(self, max_domains=None, next_token=None):
+		return MemoryPage([self.domains[name] for name in sorted(self.domains)])
+
+	def delete_domain(self, name):
+		self.domains.pop(name, None)
+		return True
+
+	def select(self, domain, query='', next_token=None, consistent_read=False):
+		page = domain.select(query, next_token=next_token, consistent_read=consistent_read)
+		if not isinstance(page, MemoryPage):
+			page = MemoryPage(page)
+		return page
+
+
+class MemoryDomain(object):
+	"""Minimal boto.sdb.domain.Domain that records every call made"""
+
+	def __init__(self, name='memory', connection=None):
+		self.name = name
+		self.items = {}
+		self.calls = []
+		# Item names and queries read with consistent_read
+		self.consistent_reads = []
+		self.connection = connection or MemoryConnection()
+		self.unchecked = False
+
+	def _check_exists(self):
+		if self.unchecked and self.name not in self.connection.domains:
+			raise SDBResponseError(400, 'NoSuchDomain')
+
+	def get_attributes(self, item_name, attribute_name=None, consistent_read=False, item=None):
+		self.calls.append(('get_attributes', item_name))
+		self._check_exists()
+		if consistent_read:
+			self.consistent_reads.append(item_name)
+		attrs = self.items.get(item_name, {})
+		if attribute_name:
+			if isinstance(attribute_name, basestring):
+				attribute_name = [attribute_name]
+			attrs = dict((k, v) for k, v in attrs.items() if k in attribute_name)
+		return MemoryItem(item_name, attrs)
+
+	def put_attributes(self, item_name, attributes, replace=True, expected_value=None):
+		self.calls.append(('put_attributes', item_name, dict(attributes)))
+		item = self.items.setdefault(item_name, {})
+		if expected_value:
+			name, value = expected_value
+			if (value is False and name in item) or (value not in (True, False) and item.get(name) != value):
+				raise SDBResponseError(409, 'Conflict')
+		# SDB only stores strings
+		item.update((k, v if isinstance(v, (basestring, list)) else str(v)) for k, v in attributes.items())
+		return True
+
+	def batch_put_attributes(self, items, replace=True):
+		self.calls.append(('batch_put_attributes', sorted(items.keys())))
+		for item_name in items:
+			self.items.setdefault(item_name, {}).update(items[item_name])
+		return True
+
+	def delete_attributes(self, item_name, attributes=None, expected_value=None):
+		self.calls.append(('delete_attributes', item_name, attributes))
+		if expected_value:
+			name, value = expected_value
+			if self.items.get(item_name, {}).get(name) != value:
+				raise SDBResponseError(409, 'Conflict')
+		if attributes is None:
+			self.items.pop(item_name, None)
+		elif item_name in self.items:
+			if isinstance(attributes, basestring):
+				attributes = [attributes]
+			for name in attributes:
+				self.items[item_name].pop(name, None)
+		return True
+
+	def batch_delete_attributes(self, items):
+		self.calls.append(('batch_delete_attributes', sorted(items.keys())))
+		for item_name in items:
+			self.delete_attributes(item_name, items[item_name])
+		return True
+
+	def get_item(self, item_name, consistent_read=False):
+		if item_name in self.items:
+			return MemoryItem(item_name, self.items[item_name])
+		return None
+
+	def select(self, query, next_token=None, consistent_read=False, max_items=None):
+		self.calls.append(('select', query))
+		self._check_exists()
+		if consistent_read:
+			self.consistent_reads.append(query)
+		output = query[len("select "):query.index(" from ")]
+		match = re.search(r"where itemName\(\) in \((.*)\)", query)
+		if match:
+			names = [n.replace("''", "'") for n in re.findall(r"'((?:[^']|'')*)'", match.group(1))]
+		else:
+			names = self._where(query)
+		names = [n for n in names if n in self.items]
+		start = int(next_token or 0)
+		names = names[start:]
+		next_token = None
+		limit = re.search(r" limit (\d+)", query)
+		if limit and len(names) > int(limit.group(1)):
+			names = names[:int(limit.group(1))]
+			next_token = str(start + len(names))
+		if output == "count(*)":
+			return MemoryPage([MemoryItem('Domain', {'Count': str(len(names))})], next_token)
+		items = []
+		for n in names:
+			attrs = self.items[n]
+			if output != "*":
+				attrs = dict((k, v) for k, v in attrs.items() if "`%s`" % k in output)
+			items.append(MemoryItem(n, attrs))
+		return MemoryPage(items, next_token)
+
+	def _where(self, query):
+		"""Names of the items matching the where clause, in order"""
+		match = re.search(r" WHERE (.*?)(?: ORDER BY (`[^`]*`|itemName\(\)) (ASC|DESC))?(?: limit \d+)?$", query.strip(), re.I | re.S)
+		names = sorted(self.items)
+		if not match:
+			return names
+		terms = []
+		def term(m):
+			if m.group(4) is not None:
+				val = [v.replace("''", "'") for v in re.findall(r"'((?:[^']|'')*)'", m.group(4))]
+			else:
+				val = (m.group(3) or "").replace("''", "'")
+			terms.append((m.group(1), m.group(2), val))
+			return " _t(%d) " % (len(terms) - 1)
+		expr = TERM.sub(term, match.group(1))
+		expr = re.sub(r"\bAND\b", " and ", re.sub(r"\bOR\b", " or ", expr, flags=re.I), flags=re.I)
+		found = []
+		for n in names:
+			attrs = dict(self.items[n], __name__=n)
+			t = lambda x: _compare(_values(terms[x][0], attrs), terms[x][1], terms[x][2])
+			if eval(expr, {"_t": t}):
+				found.append(n)
+		if match.group(2):
+			key = lambda n: min(_values(match.group(2), dict(self.items[n], __name__=n)) or [""])
+			found.sort(key=key, reverse=match.group(3).upper() == "DESC")
+		return found
+
+	def reset_calls(self):
+		self.calls = []
+		self.consistent_reads = []
+
+	def calls_to(self, method):
+		return [c for c in self.calls if c[0] == method]
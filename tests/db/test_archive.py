@@ -0,0 +1,126 @@
+# Copyright (c) 2014 Chris Moyer http://coredumped.org/
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+from botoweb.appserver.handlers.db import DBHandler
+from botoweb.appserver.handlers.trash import TrashHandler
+from botoweb.db.coremodel import Model
+from botoweb.db.identity import identity_map
+from botoweb.db.property import StringProperty, BooleanProperty, DateTimeProperty
+from botoweb.exceptions import Gone
+from memory_domain import MemoryDomain
+
+class ArchivedModel(Model):
+	"""Model whose deleted objects are archived"""
+	__archive__ = True
+	name = StringProperty()
+	deleted = BooleanProperty()
+	deleted_at = DateTimeProperty()
+	deleted_by = StringProperty()
+
+
+class FakeUser(object):
+	"""User allowed to do anything"""
+
+	def has_auth(self, method, obj_type, prop_name=None):
+		return True
+
+
+class FakeRequest(object):
+	def __init__(self, user):
+		self.user = user
+
+
+class TestArchive(object):
+	"""Test moving soft-deleted objects to the archive domain"""
+
+	def setup_method(self, method):
+		self.domain = MemoryDomain('live')
+		self.archive = MemoryDomain('live_archive')
+		ArchivedModel._manager._domain = self.domain
+		ArchivedModel._manager.archive._domain = self.archive
+		config = {"db_class": "%s.ArchivedModel" % ArchivedModel.__module__}
+		self.handler = DBHandler(None, config)
+		self.trash = TrashHandler(None, config)
+
+	def test_no_deleted_filter(self):
+		"""Test live queries don't filter on deleted"""
+		query = self.handler.build_query({}, ArchivedModel.all())
+		assert("deleted" not in query.get_query())
+
+	def test_delete_archives(self):
+		obj = ArchivedModel(name='A')
+		obj.put()
+		self.handler.delete(ArchivedModel.get_by_id(obj.id), None)
+		assert(obj.id not in self.domain.items)
+		item = self.archive.items[obj.id]
+		assert(item['name'] == 'A')
+		assert(item['deleted'] == 'true')
+		try:
+			self.handler.read(obj.id, None)
+		except Gone:
+			pass
+		else:
+			assert False, 'Expected the object to be gone'
+
+	def test_trash(self):
+		"""Test the trash reads from and purges the archive"""
+		obj = ArchivedModel(name='A')
+		obj.put()
+		ArchivedModel(name='B').put()
+		self.handler.delete(obj, None)
+		assert([o.name for o in self.trash.search({}, None)] == ['A'])
+		archived = self.trash.read(obj.id, None)
+		assert(archived.name == 'A')
+		archived.delete()
+		assert(self.archive.items == {})
+		assert(len(self.domain.items) == 1)
+
+	def test_archive_deleted(self):
+		"""Test moving existing deleted objects"""
+		for x in range(30):
+			ArchivedModel(name='N%s' % x, deleted=(x % 3 == 0)).put()
+		assert(ArchivedModel._manager.archive_deleted(ArchivedModel) == 10)
+		assert(len(self.domain.items) == 20)
+		assert(len(self.archive.items) == 10)
+		assert(ArchivedModel._manager.archive_deleted(ArchivedModel) == 0)
+
+	def test_restore(self):
+		"""Test undeleting from the trash moves the object back"""
+		obj = ArchivedModel(name='A')
+		obj.put()
+		self.handler.delete(obj, None)
+		user = FakeUser()
+		archived = self.trash.read(obj.id, user)
+		self.trash.update(archived, {'deleted': False, 'name': 'B'}, user, FakeRequest(user))
+		assert(self.archive.items == {})
+		assert(self.domain.items[obj.id]['name'] == 'B')
+		found = self.handler.read(obj.id, user)
+		assert(found.name == 'B')
+		assert(not found.deleted)
+
+	def test_identity_map(self):
+		"""Test archived objects aren't handed out as live ones"""
+		obj = ArchivedModel(name='A')
+		obj.put()
+		self.handler.delete(obj, None)
+		with identity_map():
+			assert(self.trash.read(obj.id, None).name == 'A')
+			assert(ArchivedModel.get_by_id(obj.id) is None)
+			assert(ArchivedModel.get_by_id([obj.id]) == [None])
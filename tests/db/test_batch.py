@@ -0,0 +1,115 @@
+# Copyright (c) 2014 Chris Moyer http://coredumped.org/
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+from botoweb.db import batch
+from botoweb.db.batch import BatchWriteError
+from botoweb.db.coremodel import Model
+from botoweb.db.property import StringProperty, IntegerProperty
+from boto.exception import SDBResponseError
+from memory_domain import MemoryDomain
+
+class BatchModel(Model):
+	"""Simple model stored in memory"""
+	name = StringProperty()
+	num = IntegerProperty()
+
+
+class FailingDomain(MemoryDomain):
+	"""Domain where batch puts containing a given item always fail"""
+
+	def __init__(self, bad_id):
+		MemoryDomain.__init__(self)
+		self.bad_id = bad_id
+
+	def batch_put_attributes(self, items, replace=True):
+		if self.bad_id in items:
+			raise SDBResponseError(400, 'Bad Request')
+		return MemoryDomain.batch_put_attributes(self, items, replace)
+
+
+class TestBatchWrites(object):
+	"""Test writing many objects with batch calls"""
+
+	def setup_method(self, method):
+		self.domain = MemoryDomain()
+		BatchModel._manager._domain = self.domain
+
+	def make(self, count):
+		objs = []
+		for x in range(count):
+			obj = BatchModel()
+			obj.name = 'Obj %s' % x
+			obj.num = x
+			objs.append(obj)
+		return objs
+
+	def test_put_multi_chunks(self):
+		"""Test objects are written 25 at a time"""
+		objs = BatchModel.put_multi(self.make(60))
+		puts = self.domain.calls_to('batch_put_attributes')
+		assert(sorted(len(c[1]) for c in puts) == [10, 25, 25])
+		assert(self.domain.calls_to('put_attributes') == [])
+		assert(len(self.domain.items) == 60)
+		for obj in objs:
+			assert(self.domain.items[obj.id]['name'] == obj.name)
+			assert(not obj.is_dirty())
+
+	def test_batch_context(self):
+		"""Test puts inside a batch block are written when it exits"""
+		with batch():
+			objs = self.make(3)
+			for obj in objs:
+				obj.put()
+				assert(obj.id)
+			assert(self.domain.items == {})
+		assert(len(self.domain.calls_to('batch_put_attributes')) == 1)
+		assert(len(self.domain.items) == 3)
+
+	def test_batch_not_written_on_error(self):
+		"""Test nothing is written if the block raises"""
+		try:
+			with batch():
+				self.make(1)[0].put()
+				raise ValueError('Oops')
+		except ValueError:
+			pass
+		assert(self.domain.items == {})
+
+	def test_delete_multi(self):
+		objs = BatchModel.put_multi(self.make(30))
+		self.domain.reset_calls()
+		BatchModel.delete_multi(objs)
+		deletes = self.domain.calls_to('batch_delete_attributes')
+		assert(sorted(len(c[1]) for c in deletes) == [5, 25])
+		assert(self.domain.items == {})
+
+	def test_partial_failure(self):
+		"""Test a failed chunk doesn't stop the rest being written"""
+		objs = self.make(30)
+		objs[0].id = 'bad'
+		BatchModel._manager._domain = FailingDomain('bad')
+		try:
+			BatchModel.put_multi(objs, max_workers=2)
+		except BatchWriteError, e:
+			assert(len(e.failed) == 25)
+			assert(objs[0] in e.failed)
+		else:
+			assert False, 'Expected a BatchWriteError'
+		assert(len(BatchModel._manager._domain.items) == 5)
@@ -0,0 +1,211 @@
+# Copyright (c) 2014 Chris Moyer http://coredumped.org/
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+import time
+
+import botoweb
+from botoweb.db import object_cache
+from botoweb.db.consistency import WriteTracker, current_tracker, window, MAX_ITEMS, MAX_CLASSES
+from botoweb.db.coremodel import Model
+from botoweb.db.model import query
+from botoweb.db.property import StringProperty
+from memory_domain import MemoryDomain
+
+class TrackedModel(Model):
+	"""Model read back consistently after writes"""
+	name = StringProperty()
+
+
+class TrackedCachedModel(Model):
+	"""Model in the object cache"""
+	__cache_ttl__ = 60
+	name = StringProperty()
+
+
+class TestWriteTracker(object):
+	"""Test recording writes and saving them in a cookie"""
+
+	def test_record(self):
+		tracker = WriteTracker()
+		tracker.record(TrackedModel, ['a'])
+		assert(tracker.changed)
+		assert(tracker.is_recent(TrackedModel, 'a'))
+		assert(tracker.is_recent(TrackedModel))
+		assert(not tracker.is_recent(TrackedModel, 'b'))
+		assert(not tracker.is_recent(TrackedCachedModel))
+
+	def test_expired(self):
+		tracker = WriteTracker({'TrackedModel': int(time.time()) - 1, 'TrackedModel/a': int(time.time()) - 1})
+		assert(not tracker.is_recent(TrackedModel))
+		assert(not tracker.is_recent(TrackedModel, 'a'))
+		assert(tracker.to_cookie() == '')
+
+	def test_cookie(self):
+		tracker = WriteTracker()
+		tracker.record(TrackedModel, ['a'])
+		loaded = WriteTracker.from_cookie(tracker.to_cookie())
+		assert(loaded.is_recent(TrackedModel, 'a'))
+		assert(not loaded.changed)
+
+	def test_bad_cookie(self):
+		for value in (None, '', 'garbage!', 'W10='):
+			assert(len(WriteTracker.from_cookie(value)) == 0)
+
+	def test_untrusted_cookie(self):
+		"""Test a cookie can't make reads consistent for long, or for anything"""
+		until = int(time.time()) + 10 ** 9
+		forged = dict([('Class%s' % n, until) for n in range(MAX_CLASSES + 5)])
+		forged.update({'TrackedModel': until, 'TrackedModel/a': until, 'NotAModel/a': until})
+		loaded = WriteTracker.from_cookie(WriteTracker(forged).to_cookie())
+		assert(sorted(loaded.writes.keys()) == ['TrackedModel', 'TrackedModel/a'])
+		assert(max(loaded.writes.values()) <= time.time() + window() + 1)
+
+	def test_max_classes(self):
+		tracker = WriteTracker()
+		tracker.record(TrackedModel, [])
+		for n in range(MAX_CLASSES):
+			tracker.record(type('Class%s' % n, (object,), {}), [])
+		assert(len(tracker) == MAX_CLASSES)
+
+	def test_max_items(self):
+		tracker = WriteTracker()
+		tracker.record(TrackedModel, [str(n) for n in range(MAX_ITEMS + 5)])
+		assert(len(tracker) == MAX_ITEMS + 1)
+		assert(tracker.is_recent(TrackedModel))
+
+	def test_stack(self):
+		assert(current_tracker() is None)
+		with WriteTracker() as outer:
+			with WriteTracker() as inner:
+				assert(current_tracker() is inner)
+			assert(current_tracker() is outer)
+		assert(current_tracker() is None)
+
+
+class TestReadYourWrites(object):
+	"""Test the manager reads what the session wrote consistently"""
+
+	def setup_method(self, method):
+		botoweb.memc = None
+		object_cache.clear()
+		self.domain = MemoryDomain()
+		TrackedModel._manager._domain = self.domain
+		TrackedCachedModel._manager._domain = self.domain
+
+	def teardown_method(self, method):
+		object_cache.clear()
+
+	def test_without_tracker(self):
+		obj = TrackedModel(name='A')
+		obj.put()
+		TrackedModel.get_by_id(obj.id)
+		list(TrackedModel.all())
+		assert(self.domain.consistent_reads == [])
+
+	def test_item_written(self):
+		other = TrackedModel(name='B')
+		other.put()
+		with WriteTracker():
+			obj = TrackedModel(name='A')
+			obj.put()
+			self.domain.reset_calls()
+			assert(TrackedModel.get_by_id(obj.id).name == 'A')
+			TrackedModel.get_by_id(other.id)
+		assert(self.domain.consistent_reads == [obj.id])
+
+	def test_query_after_write(self):
+		with WriteTracker():
+			list(TrackedModel.all())
+			assert(self.domain.consistent_reads == [])
+			TrackedModel(name='A').put()
+			assert(len(list(TrackedModel.all())) == 1)
+			assert(len(self.domain.consistent_reads) == 1)
+			TrackedCachedModel.all().count()
+			assert(len(self.domain.consistent_reads) == 1)
+
+	def test_cache_bypassed(self):
+		"""Test items written in the session aren't read from the object cache"""
+		obj = TrackedCachedModel(name='A')
+		obj.put()
+		TrackedCachedModel.get_by_id(obj.id)
+		with WriteTracker():
+			TrackedCachedModel.get_by_id(obj.id).put()
+			self.domain.reset_calls()
+			TrackedCachedModel.get_by_id(obj.id)
+			TrackedCachedModel.get_by_id(obj.id)
+		assert(self.domain.consistent_reads == [obj.id, obj.id])
+		self.domain.reset_calls()
+		TrackedCachedModel.get_by_id(obj.id)
+		assert(self.domain.calls_to('get_attributes') == [])
+
+	def test_split_count(self):
+		"""Test counts run on other threads are consistent too"""
+		max_or_values = TrackedModel._manager.max_or_values
+		TrackedModel._manager.max_or_values = 2
+		try:
+			with WriteTracker():
+				for name in 'ABCD':
+					TrackedModel(name=name).put()
+				self.domain.reset_calls()
+				assert(TrackedModel.find(name=list('ABCD')).count() == 4)
+			assert(len(self.domain.calls_to('select')) == 2)
+			assert(len(self.domain.consistent_reads) == 2)
+		finally:
+			TrackedModel._manager.max_or_values = max_or_values
+
+	def test_get_objects_chunks(self):
+		"""Test each chunk with an item written in the session is selected consistently"""
+		objs = [TrackedModel(name='%02d' % n) for n in range(40)]
+		for obj in objs:
+			obj.put()
+		with WriteTracker():
+			objs[0].put()
+			objs[39].put()
+			self.domain.reset_calls()
+			found = TrackedModel.get_by_id([obj.id for obj in objs])
+		assert([o.name for o in found] == [o.name for o in objs])
+		assert(len(self.domain.calls_to('select')) == 2)
+		assert(len(self.domain.consistent_reads) == 2)
+
+	def test_sub_queries(self):
+		"""Test sub-queries run on other threads are consistent too"""
+		with WriteTracker():
+			for name in 'AB':
+				TrackedModel(name=name).put()
+			self.domain.reset_calls()
+			q = query(TrackedModel, "itemName() in [TrackedModel `name` = 'A'] or itemName() in [TrackedModel `name` = 'B']")
+			assert(sorted([o.name for o in q]) == ['A', 'B'])
+		selects = [c[1] for c in self.domain.calls_to('select')]
+		assert(len(selects) == 3)
+		assert(self.domain.consistent_reads == selects)
+
+	def test_parallel_count(self):
+		"""Test the count run next to the first page is consistent too"""
+		from botoweb.appserver.handlers.db import DBHandler
+		from botoweb.response import Response
+		handler = DBHandler(None, {"db_class": "%s.TrackedModel" % TrackedModel.__module__, "count": "parallel"})
+		with WriteTracker():
+			TrackedModel(name='A').put()
+			self.domain.reset_calls()
+			response = Response()
+			handler.set_result_count(response, TrackedModel.all())
+		assert(response.headers['X-Result-Count'] == '1')
+		assert(len(self.domain.consistent_reads) == 2)
+		assert(self.domain.consistent_reads == [c[1] for c in self.domain.calls_to('select')])
@@ -0,0 +1,82 @@
+# Copyright (c) 2014 Chris Moyer http://coredumped.org/
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+import botoweb
+from botoweb.db import count_cache
+from botoweb.db.coremodel import Model
+from botoweb.db.property import StringProperty
+from memory_domain import MemoryDomain
+
+class CountedModel(Model):
+	"""Simple model stored in memory"""
+	name = StringProperty()
+
+class CountedSubModel(CountedModel):
+	"""Subclass, writes to which change the parent's counts"""
+	pass
+
+
+class FakeQuery(object):
+	"""Query that counts how many times it was counted"""
+
+	def __init__(self, model_class, query_str, count):
+		self.model_class = model_class
+		self.query_str = query_str
+		self._count = count
+		self.calls = 0
+
+	def get_query(self):
+		return self.query_str
+
+	def count(self):
+		self.calls += 1
+		return self._count
+
+
+class TestCountCache(object):
+	"""Test caching query counts"""
+
+	def setup_method(self, method):
+		botoweb.memc = None
+		CountedModel._manager._domain = MemoryDomain()
+
+	def test_cached(self):
+		query = FakeQuery(CountedModel, "WHERE `name` = 'a'", 5)
+		assert(count_cache.cached_count(query) == 5)
+		assert(count_cache.cached_count(query) == 5)
+		assert(query.calls == 1)
+		# Different filters have their own counts
+		other = FakeQuery(CountedModel, "WHERE `name` = 'b'", 7)
+		assert(count_cache.cached_count(other) == 7)
+
+	def test_expires(self):
+		query = FakeQuery(CountedModel, "WHERE `name` = 'expires'", 5)
+		count_cache.cached_count(query, ttl=-1)
+		count_cache.cached_count(query, ttl=-1)
+		assert(query.calls == 2)
+
+	def test_write_invalidates(self):
+		"""Test a write to a subclass invalidates the parent's counts"""
+		query = FakeQuery(CountedModel, "WHERE `name` = 'c'", 5)
+		count_cache.cached_count(query)
+		obj = CountedSubModel(name='c')
+		obj.put()
+		count_cache.cached_count(query)
+		assert(query.calls == 2)
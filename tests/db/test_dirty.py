@@ -0,0 +1,107 @@
+# Copyright (c) 2014 Chris Moyer http://coredumped.org/
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+from botoweb.db.coremodel import Model
+from botoweb.db.property import StringProperty, ListProperty, IntegerProperty
+from memory_domain import MemoryDomain
+
+class DirtyModel(Model):
+	"""Simple model stored in memory"""
+	name = StringProperty()
+	email = StringProperty()
+	tags = ListProperty(str)
+	num = IntegerProperty()
+
+
+class TestDirtyTracking(object):
+	"""Test that saving a loaded object only writes what changed"""
+
+	def setup_method(self, method):
+		self.domain = MemoryDomain()
+		DirtyModel._manager._domain = self.domain
+
+	def create(self):
+		obj = DirtyModel()
+		obj.name = 'Name'
+		obj.email = 'foo@example.com'
+		obj.tags = ['A', 'B']
+		obj.num = 1
+		obj.put()
+		self.domain.reset_calls()
+		return DirtyModel.get_by_id(obj.id)
+
+	def test_new_object_full_write(self):
+		"""Test a new object writes all of its attributes"""
+		obj = DirtyModel()
+		obj.name = 'Name'
+		obj.put()
+		puts = self.domain.calls_to('put_attributes')
+		assert(len(puts) == 1)
+		attrs = puts[0][2]
+		assert(attrs['name'] == 'Name')
+		assert(attrs['__type__'] == 'DirtyModel')
+		assert('num' in attrs)
+
+	def test_loaded_object_is_clean(self):
+		obj = self.create()
+		assert(not obj.is_dirty())
+		obj.name = 'Other'
+		assert(obj.is_dirty('name'))
+		assert(not obj.is_dirty('email'))
+
+	def test_partial_write(self):
+		"""Test only the changed attribute is sent"""
+		obj = self.create()
+		self.domain.reset_calls()
+		obj.name = 'Other'
+		obj.put()
+		puts = self.domain.calls_to('put_attributes')
+		assert(len(puts) == 1)
+		assert(puts[0][2] == {'name': 'Other'})
+		assert(self.domain.calls_to('delete_attributes') == [])
+		assert(self.domain.items[obj.id]['email'] == 'foo@example.com')
+
+	def test_unchanged_object_not_written(self):
+		"""Test saving an unchanged object makes no calls at all"""
+		obj = self.create()
+		self.domain.reset_calls()
+		obj.put()
+		assert(self.domain.calls == [])
+
+	def test_in_place_list_change(self):
+		"""Test a list changed in place is still saved"""
+		obj = self.create()
+		self.domain.reset_calls()
+		obj.tags.append('C')
+		obj.put()
+		puts = self.domain.calls_to('put_attributes')
+		assert(len(puts) == 1)
+		assert(puts[0][2].keys() == ['tags'])
+
+	def test_delete_only_when_emptied(self):
+		"""Test the delete call is only made for attributes that became empty"""
+		obj = self.create()
+		self.domain.reset_calls()
+		obj.email = None
+		obj.put()
+		assert(self.domain.calls_to('put_attributes') == [])
+		deletes = self.domain.calls_to('delete_attributes')
+		assert(deletes == [('delete_attributes', obj.id, ['email'])])
+		assert('email' not in self.domain.items[obj.id])
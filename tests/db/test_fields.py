@@ -0,0 +1,71 @@
+# Copyright (c) 2014 Chris Moyer http://coredumped.org/
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+import json
+from botoweb.appserver.handlers.db import JSONWrapper
+from botoweb.db.coremodel import Model
+from botoweb.db.property import StringProperty, IntegerProperty
+from memory_domain import MemoryDomain
+
+class WideModel(Model):
+	"""Model with more properties than we usually list"""
+	name = StringProperty()
+	email = StringProperty()
+	notes = StringProperty()
+	num = IntegerProperty()
+
+
+class TestFieldProjection(object):
+	"""Test only selecting some fields"""
+
+	def setup_method(self, method):
+		self.domain = MemoryDomain()
+		WideModel._manager._domain = self.domain
+		obj = WideModel(name='Name', email='foo@example.com', notes='Long notes', num=3)
+		obj.put()
+		self.domain.reset_calls()
+
+	def test_select_names_fields(self):
+		objs = list(WideModel.find().select_fields('name', 'num'))
+		query = self.domain.calls_to('select')[0][1]
+		assert(query.startswith("select `__type__`, `__module__`, `__lineage__`, `name`, `num` from"))
+		assert(objs[0].name == 'Name')
+		assert(objs[0].num == 3)
+		assert(self.domain.calls_to('get_attributes') == [])
+
+	def test_partial_object_hydrates(self):
+		"""Test reading a field that wasn't selected loads the rest"""
+		obj = list(WideModel.find().select_fields('name'))[0]
+		obj.name = 'Changed'
+		assert(obj.email == 'foo@example.com')
+		assert(len(self.domain.calls_to('get_attributes')) == 1)
+		# Local changes aren't overwritten by loading
+		assert(obj.name == 'Changed')
+		obj.put()
+		assert(self.domain.items[obj.id]['name'] == 'Changed')
+		assert(self.domain.items[obj.id]['notes'] == 'Long notes')
+
+	def test_wrapper_fields(self):
+		"""Test the JSON wrapper only emits the selected fields"""
+		query = WideModel.find().select_fields('name')
+		wrapper = JSONWrapper(iter(query), None, fields=query.fields)
+		obj = json.loads(wrapper.next())
+		assert(sorted(obj.keys()) == ['__id__', '__type__', 'name'])
+		assert(self.domain.calls_to('get_attributes') == [])
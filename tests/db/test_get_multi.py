@@ -0,0 +1,78 @@
+# Copyright (c) 2014 Chris Moyer http://coredumped.org/
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+from botoweb.appserver.handlers.db import DBHandler
+from botoweb.db.coremodel import Model
+from botoweb.db.property import StringProperty
+from botoweb.db.identity import identity_map
+from memory_domain import MemoryDomain
+
+class FetchModel(Model):
+	"""Simple model stored in memory"""
+	name = StringProperty()
+
+
+class TestGetMulti(object):
+	"""Test fetching many objects by ID at once"""
+
+	def setup_method(self, method):
+		self.domain = MemoryDomain()
+		FetchModel._manager._domain = self.domain
+		self.objs = FetchModel.put_multi([FetchModel(name='Obj %s' % x) for x in range(45)])
+		self.domain.reset_calls()
+
+	def test_order_and_missing(self):
+		"""Test results come back in input order with None for missing IDs"""
+		ids = [obj.id for obj in reversed(self.objs)]
+		ids.insert(3, 'missing')
+		objs = FetchModel.get_by_id(ids)
+		assert(len(objs) == 46)
+		assert(objs[3] is None)
+		assert([obj.id for obj in objs if obj] == [obj.id for obj in reversed(self.objs)])
+		assert(objs[0].name == 'Obj 44')
+		selects = self.domain.calls_to('select')
+		assert(len(selects) == 3)
+		assert(self.domain.calls_to('get_attributes') == [])
+
+	def test_quoted_ids(self):
+		obj = FetchModel(name="Quote")
+		obj.id = "it's"
+		obj.put()
+		assert(FetchModel.get_by_id(["it's"])[0].name == 'Quote')
+
+	def test_identity_map(self):
+		"""Test objects already loaded in this request aren't fetched again"""
+		with identity_map():
+			first = FetchModel.get_by_id(self.objs[0].id)
+			self.domain.reset_calls()
+			objs = FetchModel.get_by_id([self.objs[0].id, self.objs[1].id])
+			assert(objs[0] is first)
+			assert(self.domain.calls_to('select')[0][1].count("'") == 2)
+			assert(FetchModel.get_by_id(self.objs[1].id) is objs[1])
+
+	def test_read_multi(self):
+		"""Test the handler's bulk read keeps the order and leaves out missing IDs"""
+		handler = DBHandler(None, {"db_class": "%s.FetchModel" % FetchModel.__module__})
+		ids = [self.objs[2].id, 'does-not-exist', self.objs[0].id]
+		objs = handler.read_multi(ids, None)
+		assert([o.id for o in objs] == [self.objs[2].id, self.objs[0].id])
+		assert(objs[0].name == 'Obj 2')
+		assert(len(self.domain.calls_to('select')) == 1)
+		assert(self.domain.calls_to('get_attributes') == [])
@@ -0,0 +1,107 @@
+# Copyright (c) 2014 Chris Moyer http://coredumped.org/
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+from botoweb.db.coremodel import Model
+from botoweb.db.property import StringProperty, ListProperty
+from memory_domain import MemoryDomain
+
+class ShadowModel(Model):
+	"""Model with a shadowed list"""
+	name = StringProperty()
+	tags = ListProperty(str, shadow=True)
+	other = ListProperty(str)
+
+
+class TestListShadow(object):
+	"""Test the raw value attributes for ListProperties"""
+
+	def setup_method(self, method):
+		self.domain = MemoryDomain()
+		self.manager = ShadowModel._manager
+		self.manager._domain = self.domain
+		self.list_shadow_queries = self.manager.list_shadow_queries
+		self.manager.list_shadow_queries = True
+
+	def teardown_method(self, method):
+		self.manager.list_shadow_queries = self.list_shadow_queries
+
+	def test_raw_values_written(self):
+		obj = ShadowModel(name='A', tags=['b', 'a', 'b'], other=['x'])
+		obj.put()
+		item = self.domain.items[obj.id]
+		assert(item['_raw_tags'] == ['a', 'b'])
+		assert('_raw_other' not in item)
+		obj = ShadowModel.get_by_id(obj.id)
+		obj.tags = []
+		obj.put()
+		assert('_raw_tags' not in self.domain.items[obj.id])
+
+	def test_partial_write(self):
+		"""Test the raw values are only written when the list changes"""
+		obj = ShadowModel(name='A', tags=['a'])
+		obj.put()
+		obj = ShadowModel.get_by_id(obj.id)
+		self.domain.reset_calls()
+		obj.name = 'B'
+		obj.put()
+		assert(self.domain.calls_to('put_attributes')[0][2] == {'name': 'B'})
+		obj.tags.append('c')
+		obj.put()
+		assert(self.domain.items[obj.id]['_raw_tags'] == ['a', 'c'])
+
+	def test_put_attributes(self):
+		"""Test saving just the list keeps the raw values in step"""
+		obj = ShadowModel(name='A', tags=['a', 'b'])
+		obj.put()
+		obj.put_attributes({'tags': ['c']})
+		assert(self.domain.items[obj.id]['_raw_tags'] == ['c'])
+		assert(list(ShadowModel.find(tags='a')) == [])
+		assert([o.id for o in ShadowModel.find(tags='c')] == [obj.id])
+		obj.put_attributes({'tags': []})
+		assert('_raw_tags' not in self.domain.items[obj.id])
+
+	def test_queries(self):
+		"""Test queries use "=" and "in" on the raw values"""
+		ShadowModel(name='A', tags=['a', 'b']).put()
+		ShadowModel(name='B', tags=['b', 'c']).put()
+		q = ShadowModel.find(tags='a')
+		assert("`_raw_tags` = 'a'" in q.get_query())
+		assert([o.name for o in q] == ['A'])
+		q = ShadowModel.find(tags=['a', 'c'])
+		assert("(`_raw_tags` in ('a', 'c'))" in q.get_query())
+		assert(sorted(o.name for o in q) == ['A', 'B'])
+		# Lists without shadow still use like
+		assert("`other` like '%:a'" in ShadowModel.find(other='a').get_query())
+
+	def test_fallback(self):
+		"""Test turning list_shadow_queries off goes back to like"""
+		self.manager.list_shadow_queries = False
+		assert("`tags` like '%:a'" in ShadowModel.find(tags='a').get_query())
+
+	def test_backfill(self):
+		"""Test backfilling items written before the shadow existed"""
+		obj = ShadowModel(name='A', tags=['a', 'b'])
+		obj.put()
+		ShadowModel(name='B', tags=['c']).put()
+		del self.domain.items[obj.id]['_raw_tags']
+		assert([o.name for o in ShadowModel.find(tags='a')] == [])
+		assert(self.manager.backfill_shadows(ShadowModel) == 1)
+		assert([o.name for o in ShadowModel.find(tags='a')] == ['A'])
+		assert(self.manager.backfill_shadows(ShadowModel) == 0)
@@ -0,0 +1,333 @@
+# Copyright (c) 2014 Chris Moyer http://coredumped.org/
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+import time
+import botoweb
+from botoweb.db import object_cache
+from botoweb.db.coremodel import Model
+from botoweb.db.property import StringProperty, ReferenceProperty
+from memory_domain import MemoryDomain
+
+class CachedModel(Model):
+	"""Model kept in the object cache"""
+	__cache_ttl__ = 60
+	name = StringProperty()
+
+
+class CachedChild(CachedModel):
+	"""Subclass, stored with its parent"""
+	pass
+
+
+class UncachedModel(Model):
+	"""Model which isn't cached"""
+	name = StringProperty()
+	ref = ReferenceProperty(CachedModel, collection_name='uncached_set')
+
+
+class FakeMemcache(object):
+	"""Just enough of memcache.Client"""
+
+	def __init__(self):
+		self.values = {}
+
+	def get_multi(self, keys):
+		return dict((k, self.values[k]) for k in keys if k in self.values)
+
+	def set_multi(self, mapping, time=0):
+		self.values.update(mapping)
+
+	def delete_multi(self, keys):
+		for k in keys:
+			self.values.pop(k, None)
+
+
+class StaleDomain(MemoryDomain):
+	"""Domain whose eventually consistent reads return the items as they were"""
+
+	def __init__(self, name='memory'):
+		MemoryDomain.__init__(self, name)
+		self.stale = None
+
+	def get_attributes(self, item_name, attribute_name=None, consistent_read=False, item=None):
+		if self.stale is not None and not consistent_read:
+			self.calls.append(('get_attributes', item_name))
+			return dict(self.stale.get(item_name, {}))
+		return MemoryDomain.get_attributes(self, item_name, attribute_name, consistent_read, item)
+
+	def select(self, query, next_token=None, consistent_read=False, max_items=None):
+		if self.stale is not None and not consistent_read:
+			current = self.items
+			self.items = self.stale
+			try:
+				return MemoryDomain.select(self, query, next_token, consistent_read, max_items)
+			finally:
+				self.items = current
+		return MemoryDomain.select(self, query, next_token, consistent_read, max_items)
+
+
+class TestObjectCache(object):
+	"""Test the read-through object cache"""
+
+	def setup_method(self, method):
+		botoweb.memc = None
+		object_cache.clear()
+		self.domain = MemoryDomain()
+		CachedModel._manager._domain = self.domain
+		UncachedModel._manager._domain = self.domain
+
+	def teardown_method(self, method):
+		botoweb.memc = None
+		object_cache.clear()
+
+	def entries(self):
+		"""Keys of the objects cached in memcache, leaving out tombstones"""
+		return [k for k in botoweb.memc.values if k.startswith('obj:')]
+
+	def create(self, cls=CachedModel, name='A'):
+		obj = cls(name=name)
+		obj.put()
+		self.domain.reset_calls()
+		return obj
+
+	def test_read_through(self):
+		obj = self.create()
+		assert(CachedModel.get_by_id(obj.id).name == 'A')
+		assert(CachedModel.get_by_id(obj.id).name == 'A')
+		assert(len(self.domain.calls_to('get_attributes')) == 1)
+
+	def test_uncached_class(self):
+		obj = self.create(UncachedModel)
+		UncachedModel.get_by_id(obj.id)
+		UncachedModel.get_by_id(obj.id)
+		assert(len(self.domain.calls_to('get_attributes')) == 2)
+
+	def test_subclass_shares_entry(self):
+		"""Test looking an object up through its base class uses the same entry"""
+		obj = self.create(CachedChild)
+		assert(CachedChild.get_by_id(obj.id).name == 'A')
+		found = CachedModel.get_by_id(obj.id)
+		assert(isinstance(found, CachedChild))
+		assert(len(self.domain.calls_to('get_attributes')) == 1)
+
+	def test_reference(self):
+		"""Test lazy references are loaded through the cache"""
+		target = self.create()
+		CachedModel.get_by_id(target.id)
+		obj = self.create(UncachedModel)
+		obj.ref = target
+		obj.put()
+		obj = UncachedModel.get_by_id(obj.id)
+		self.domain.reset_calls()
+		assert(obj.ref.name == 'A')
+		assert(self.domain.calls_to('get_attributes') == [])
+
+	def test_write_invalidates(self):
+		obj = self.create()
+		CachedModel.get_by_id(obj.id)
+		obj.name = 'B'
+		obj.put()
+		assert(CachedModel.get_by_id(obj.id).name == 'B')
+		obj.delete()
+		assert(CachedModel.get_by_id(obj.id) is None)
+
+	def test_set_property_invalidates(self):
+		obj = self.create()
+		loaded = CachedModel.get_by_id(obj.id)
+		CachedModel._manager.set_property(CachedModel.find_property('name'), loaded, 'name', 'C')
+		assert(CachedModel.get_by_id(obj.id).name == 'C')
+
+	def test_negative(self):
+		"""Test missing items are cached, until one is written"""
+		assert(CachedModel.get_by_id('missing') is None)
+		assert(CachedModel.get_by_id('missing') is None)
+		assert(len(self.domain.calls_to('get_attributes')) == 1)
+		obj = CachedModel('missing', name='Now here')
+		obj.put()
+		assert(CachedModel.get_by_id('missing').name == 'Now here')
+
+	def test_get_multi(self):
+		"""Test only the IDs that aren't cached are selected"""
+		objs = [self.create(name=n) for n in 'ABC']
+		CachedModel.get_by_id(objs[0].id)
+		self.domain.reset_calls()
+		found = CachedModel.get_by_id([o.id for o in objs] + ['missing'])
+		assert([o and o.name for o in found] == ['A', 'B', 'C', None])
+		selects = self.domain.calls_to('select')
+		assert(len(selects) == 1)
+		assert(objs[0].id not in selects[0][1])
+		self.domain.reset_calls()
+		found = CachedModel.get_by_id([o.id for o in objs] + ['missing'])
+		assert([o and o.name for o in found] == ['A', 'B', 'C', None])
+		assert(self.domain.calls == [])
+
+	def test_lru(self):
+		"""Test the least recently used entries are dropped first"""
+		max_local = object_cache.max_local
+		object_cache.max_local = lambda: 2
+		try:
+			objs = [self.create(name=n) for n in 'ABC']
+			CachedModel.get_by_id(objs[0].id)
+			CachedModel.get_by_id(objs[1].id)
+			CachedModel.get_by_id(objs[0].id)
+			CachedModel.get_by_id(objs[2].id)
+			self.domain.reset_calls()
+			CachedModel.get_by_id(objs[0].id)
+			assert(self.domain.calls == [])
+			CachedModel.get_by_id(objs[1].id)
+			assert(len(self.domain.calls_to('get_attributes')) == 1)
+		finally:
+			object_cache.max_local = max_local
+
+	def test_memcache(self):
+		"""Test entries are shared through memcache"""
+		botoweb.memc = FakeMemcache()
+		obj = self.create()
+		CachedModel.get_by_id(obj.id)
+		assert(len(self.entries()) == 1)
+		# Like another process, with nothing cached locally
+		object_cache.clear()
+		assert(CachedModel.get_by_id(obj.id).name == 'A')
+		assert(len(self.domain.calls_to('get_attributes')) == 1)
+		obj.name = 'B'
+		obj.put()
+		assert(self.entries() == [])
+
+
+	def test_no_stale_refill(self):
+		"""Test a lagging read after a write doesn't put the old item back in the cache"""
+		self.domain = StaleDomain()
+		CachedModel._manager._domain = self.domain
+		objs = [self.create(name=n) for n in 'AB']
+		CachedModel.get_by_id(objs[0].id)
+		CachedModel.get_by_id([o.id for o in objs])
+		self.domain.stale = dict((id, dict(a)) for (id, a) in self.domain.items.items())
+		for obj in objs:
+			obj.name = 'Changed'
+			obj.put()
+		assert(CachedModel.get_by_id(objs[0].id).name == 'Changed')
+		assert(CachedModel.get_by_id(objs[0].id).name == 'Changed')
+		assert([o.name for o in CachedModel.get_by_id([o.id for o in objs])] == ['Changed', 'Changed'])
+		assert([o.name for o in CachedModel.get_by_id([o.id for o in objs])] == ['Changed', 'Changed'])
+
+
+	def test_no_refill_during_write(self):
+		"""Test attributes read just before a write aren't cached after it"""
+		objs = [self.create(name=n) for n in 'AB']
+		get_attributes = self.domain.get_attributes
+		select = self.domain.select
+
+		def racing_get(item_name, *args, **kwargs):
+			# The read returns, then the write lands before it's cached
+			a = get_attributes(item_name, *args, **kwargs)
+			self.domain.get_attributes = get_attributes
+			objs[0].name = 'Changed'
+			objs[0].put()
+			return a
+		self.domain.get_attributes = racing_get
+		assert(CachedModel.get_by_id(objs[0].id).name == 'A')
+		assert(CachedModel.get_by_id(objs[0].id).name == 'Changed')
+
+		def racing_select(*args, **kwargs):
+			page = list(select(*args, **kwargs))
+			self.domain.select = select
+			objs[1].name = 'Changed'
+			objs[1].put()
+			return page
+		self.domain.select = racing_select
+		assert([o.name for o in CachedModel.get_by_id([objs[1].id])] == ['B'])
+		assert([o.name for o in CachedModel.get_by_id([objs[1].id])] == ['Changed'])
+
+	def test_no_refill_during_write_memcache(self):
+		"""Test a write by another process stops older reads being cached"""
+		botoweb.memc = FakeMemcache()
+		obj = self.create()
+		read_at = time.time()
+		# Written elsewhere, only the tombstone in memcache says so
+		object_cache.invalidate(CachedModel, [obj.id])
+		object_cache._tombstones.clear()
+		object_cache.put(CachedModel, obj.id, {'__type__': 'CachedModel', 'name': 'A'}, 60, read_at)
+		assert(self.entries() == [])
+		object_cache.put(CachedModel, obj.id, {'__type__': 'CachedModel', 'name': 'A'}, 60,
+			time.time() + object_cache.CLOCK_SKEW + 1)
+		assert(len(self.entries()) == 1)
+
+
+class TestHydratedQueries(object):
+	"""Test ID-only queries filled in from the object cache"""
+
+	def setup_method(self, method):
+		botoweb.memc = None
+		object_cache.clear()
+		self.domain = MemoryDomain()
+		CachedModel._manager._domain = self.domain
+		UncachedModel._manager._domain = self.domain
+		self.objs = []
+		for name in 'EDCBA':
+			obj = CachedModel(name=name)
+			obj.put()
+			self.objs.append(obj)
+		self.domain.reset_calls()
+
+	def teardown_method(self, method):
+		object_cache.clear()
+
+	def test_hydrate(self):
+		"""Test only the IDs are selected, and the misses fetched in one batch"""
+		CachedModel.get_by_id(self.objs[0].id)
+		CachedModel.get_by_id(self.objs[1].id)
+		self.domain.reset_calls()
+		query = CachedModel.find().order('name').from_cache()
+		assert([obj.name for obj in query] == ['A', 'B', 'C', 'D', 'E'])
+		selects = [call[1] for call in self.domain.calls_to('select')]
+		assert(len(selects) == 2)
+		assert(selects[0].startswith('select itemName() from'))
+		assert(self.objs[0].id not in selects[1] and self.objs[2].id in selects[1])
+		assert((query.cache_hits, query.cache_misses) == (2, 3))
+		assert(query.hit_ratio == 0.4)
+
+		# Everything is cached now
+		self.domain.reset_calls()
+		query = CachedModel.find().order('name').from_cache()
+		assert([obj.name for obj in query] == ['A', 'B', 'C', 'D', 'E'])
+		assert(len(self.domain.calls_to('select')) == 1)
+		assert(query.hit_ratio == 1.0)
+
+	def test_limit(self):
+		query = CachedModel.find(limit=2).order('name').from_cache()
+		assert([obj.name for obj in query] == ['A', 'B'])
+		assert(query.cache_misses == 2)
+
+	def test_write_seen(self):
+		"""Test a query after a write sees the new values"""
+		list(CachedModel.find().from_cache())
+		self.objs[0].name = 'Z'
+		self.objs[0].put()
+		names = [obj.name for obj in CachedModel.find().order('name').from_cache()]
+		assert(names == ['A', 'B', 'C', 'D', 'Z'])
+
+	def test_uncached_class(self):
+		"""Test classes without __cache_ttl__ still select everything"""
+		UncachedModel(name='A').put()
+		self.domain.reset_calls()
+		query = UncachedModel.find().from_cache()
+		assert([obj.name for obj in query] == ['A'])
+		assert(self.domain.calls_to('select')[0][1].startswith('select * from'))
+		assert(query.hit_ratio is None)
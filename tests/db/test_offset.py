@@ -0,0 +1,91 @@
+# Copyright (c) 2014 Chris Moyer http://coredumped.org/
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+from botoweb.db.coremodel import Model
+from botoweb.db.property import StringProperty
+from botoweb.db import count_cache
+from botoweb.db import offset_cache
+from memory_domain import MemoryDomain
+
+class OffsetModel(Model):
+	"""Simple model stored in memory"""
+	name = StringProperty()
+
+
+class TestOffset(object):
+	"""Test skipping ahead with count(*) selects"""
+
+	def setup_method(self, method):
+		self.domain = MemoryDomain()
+		OffsetModel._manager._domain = self.domain
+		self.names = ['N%02d' % x for x in range(20)]
+		for name in self.names:
+			OffsetModel(name=name).put()
+		# Start every test with nothing cached
+		count_cache.invalidate(OffsetModel)
+		self.domain.reset_calls()
+
+	def page(self, offset, limit=5):
+		return [o.name for o in OffsetModel.all().order('name').fetch(limit, offset)]
+
+	def counts(self):
+		return [c[1] for c in self.domain.calls_to('select') if c[1].startswith('select count(*)')]
+
+	def test_offset(self):
+		"""Test the offset is skipped with a count, not by fetching items"""
+		assert(self.page(7) == self.names[7:12])
+		counts = self.counts()
+		assert(len(counts) == 1)
+		assert(counts[0].endswith('limit 7'))
+
+	def test_past_the_end(self):
+		assert(self.page(25) == [])
+		assert(self.page(20) == [])
+
+	def test_next_page_cached(self):
+		"""Test the next page starts from the token the last page ended at"""
+		assert(self.page(5) == self.names[5:10])
+		self.domain.reset_calls()
+		assert(self.page(10) == self.names[10:15])
+		assert(self.counts() == [])
+
+	def test_first_page_not_remembered(self):
+		"""Test pages without an offset don't touch the offset cache"""
+		offset_cache._tokens.clear()
+		assert(self.page(0) == self.names[0:5])
+		assert(offset_cache._tokens == {})
+
+	def test_deep_offset_counts_from_nearest(self):
+		"""Test going deeper only counts from the deepest known offset"""
+		self.page(10)
+		self.domain.reset_calls()
+		assert(self.page(17, 2) == self.names[17:19])
+		counts = self.counts()
+		assert(len(counts) == 1)
+		assert(counts[0].endswith('limit 2'))
+
+	def test_write_forgets_tokens(self):
+		self.page(5)
+		OffsetModel(name='N00a').put()
+		self.domain.reset_calls()
+		assert(self.page(10) == ['N09'] + self.names[10:14])
+		counts = self.counts()
+		assert(len(counts) == 1)
+		assert(counts[0].endswith('limit 10'))
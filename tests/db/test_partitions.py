@@ -0,0 +1,138 @@
+# Copyright (c) 2014 Chris Moyer http://coredumped.org/
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+from datetime import datetime, date
+from botoweb.db.coremodel import Model
+from botoweb.db.property import StringProperty, DateTimeProperty
+from botoweb.db.manager.partitionedmanager import PartitionedSDBManager
+from memory_domain import MemoryConnection
+
+class LogModel(Model):
+	"""Log-like model partitioned by month"""
+	message = StringProperty()
+	created_at = DateTimeProperty(auto_now_add=True)
+
+
+class TestPartitions(object):
+	"""Test storing a class in one domain per month"""
+
+	def setup_method(self, method):
+		self.sdb = MemoryConnection()
+		self.manager = PartitionedSDBManager(LogModel, 'log', None, None, 'sdb.amazonaws.com', 443,
+			None, None, True, partition_by='created_at', period='month', retain=3)
+		self.manager._sdb = self.sdb
+		self.manager._domain = self.sdb.lookup('log', validate=False)
+		LogModel._manager = self.manager
+
+	def create(self):
+		"""Two entries in each month from January to April 2014"""
+		objs = []
+		for month in range(1, 5):
+			for day in (5, 20):
+				obj = LogModel(message='%s/%s' % (month, day), created_at=datetime(2014, month, day, 12))
+				obj.put()
+				objs.append(obj)
+		for domain in self.sdb.domains.values():
+			domain.reset_calls()
+		return objs
+
+	def selected(self):
+		"""Names of the domains selected from"""
+		return sorted([name for name, d in self.sdb.domains.items() if d.calls_to('select')])
+
+	def test_writes_routed(self):
+		"""Test each object is stored in the domain for its month"""
+		objs = self.create()
+		assert(sorted(self.sdb.domains) == ['log_201401', 'log_201402', 'log_201403', 'log_201404'])
+		for obj in objs:
+			assert(obj.id.startswith(obj.created_at.strftime('%Y%m_')))
+			assert(obj.id in self.sdb.domains['log_%s' % obj.created_at.strftime('%Y%m')].items)
+
+	def test_point_read(self):
+		"""Test getting an object by ID only reads its own partition"""
+		obj = self.create()[2]
+		assert(LogModel.get_by_id(obj.id).message == '2/5')
+		reads = [name for name, d in self.sdb.domains.items() if d.calls_to('get_attributes')]
+		assert(reads == ['log_201402'])
+
+	def test_range_query(self):
+		"""Test a range query only searches the partitions it overlaps"""
+		self.create()
+		query = LogModel.find().filter('created_at >=', datetime(2014, 3, 1)).order('created_at')
+		assert([obj.message for obj in query] == ['3/5', '3/20', '4/5', '4/20'])
+		assert(self.selected() == ['log_201403', 'log_201404'])
+
+		for domain in self.sdb.domains.values():
+			domain.reset_calls()
+		query = LogModel.find().filter('created_at >', datetime(2014, 1, 10)).filter('created_at <', datetime(2014, 2, 10))
+		assert([obj.message for obj in query] == ['1/20', '2/5'])
+		assert(self.selected() == ['log_201401', 'log_201402'])
+
+	def test_unbounded_query(self):
+		"""Test queries without a range search every partition"""
+		self.create()
+		messages = [obj.message for obj in LogModel.find().order('-created_at')]
+		assert(messages == ['4/20', '4/5', '3/20', '3/5', '2/20', '2/5', '1/20', '1/5'])
+		assert(LogModel.find().count() == 8)
+		assert(LogModel.find(message='2/20').count() == 1)
+
+	def test_no_partitions(self):
+		assert(list(LogModel.find()) == [])
+		assert(LogModel.find().count() == 0)
+
+	def test_retention(self):
+		"""Test only partitions older than retain months are dropped"""
+		self.create()
+		assert(self.manager.expired_partitions(now=datetime(2014, 4, 15)) == ['201401'])
+		assert(self.manager.drop_partitions(date(2014, 3, 1)) == ['201401', '201402'])
+		assert(sorted(self.sdb.domains) == ['log_201403', 'log_201404'])
+		assert(LogModel.find().count() == 4)
+
+	def test_legacy_domain(self):
+		"""Test objects stored before partitioning are still found"""
+		legacy = self.sdb.create_domain('log')
+		legacy.items['old-id'] = {'__type__': 'LogModel', '__module__': LogModel.__module__,
+			'message': 'old', 'created_at': '2013-06-01T00:00:00'}
+		self.manager._domain = legacy
+		self.create()
+		assert(LogModel.get_by_id('old-id').message == 'old')
+		assert(LogModel.find().count() == 9)
+
+	def test_missing_partition(self):
+		"""Test IDs for a partition that doesn't exist just aren't found"""
+		objs = self.create()
+		assert(LogModel.get_by_id('209901_x') is None)
+		found = LogModel.get_by_id([objs[0].id, '209901_x', objs[7].id])
+		assert([o and o.message for o in found] == ['1/5', None, '4/20'])
+		assert('log_209901' not in self.sdb.domains)
+
+	def test_new_partition_seen(self):
+		"""Test a partition created by another process is found"""
+		self.create()
+		other = PartitionedSDBManager(LogModel, 'log', None, None, 'sdb.amazonaws.com', 443,
+			None, None, True, partition_by='created_at', period='month')
+		other._sdb = self.sdb
+		other._domain = self.manager._domain
+		LogModel._manager = other
+		obj = LogModel(message='5/5', created_at=datetime(2014, 5, 5, 12))
+		obj.put()
+		LogModel._manager = self.manager
+		self.manager._listed_at -= self.manager.miss_refresh + 1
+		assert(LogModel.get_by_id(obj.id).message == '5/5')
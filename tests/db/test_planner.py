@@ -0,0 +1,103 @@
+# Copyright (c) 2014 Chris Moyer http://coredumped.org/
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+from botoweb.db.coremodel import Model
+from botoweb.db.property import StringProperty, ListProperty
+from botoweb.db.planner import split_filters
+from memory_domain import MemoryDomain
+
+class PlannedModel(Model):
+	"""Simple model stored in memory"""
+	name = StringProperty()
+	tags = ListProperty(str)
+
+
+class TestQueryPlanner(object):
+	"""Test splitting selects with long OR'd value lists"""
+
+	def setup_method(self, method):
+		self.domain = MemoryDomain()
+		PlannedModel._manager._domain = self.domain
+		self.max_or_values = PlannedModel._manager.max_or_values
+		PlannedModel._manager.max_or_values = 3
+		self.names = ['N%02d' % x for x in range(10)]
+		for name in self.names:
+			PlannedModel(name=name, tags=['even' if int(name[1:]) % 2 == 0 else 'odd', name]).put()
+		self.domain.reset_calls()
+
+	def teardown_method(self, method):
+		PlannedModel._manager.max_or_values = self.max_or_values
+
+	def selects(self):
+		return [c[1] for c in self.domain.calls_to('select')]
+
+	def test_split_filters(self):
+		"""Test the longest value list is split into chunks"""
+		filters = [('name =', ['a', 'b']), ('tags =', ['a', 'b', 'c', 'c', 'd', 'e'])]
+		index, parts = split_filters(filters, 2)
+		assert(index == 1)
+		assert([p[1][1] for p in parts] == [['a', 'b'], ['c', 'd'], ['e']])
+		assert(split_filters(filters, 10) is None)
+		# Negated lists are AND'd, they can't be split
+		assert(split_filters([('name !=', ['a', 'b', 'c'])], 2) is None)
+
+	def test_short_list_not_split(self):
+		names = [o.name for o in PlannedModel.find(name=self.names[:3])]
+		assert(sorted(names) == self.names[:3])
+		assert(len(self.selects()) == 1)
+
+	def test_split_and_dedup(self):
+		"""Test a long list runs one select per chunk with no duplicates"""
+		# Every object is matched by two values in different chunks
+		values = list(reversed(self.names)) + ['even', 'odd']
+		objs = list(PlannedModel.find(tags=values))
+		assert(len(self.selects()) == 4)
+		assert(sorted(o.name for o in objs) == self.names)
+
+	def test_sorted_merge(self):
+		"""Test the parts are merged in sort order"""
+		values = list(reversed(self.names))
+		objs = list(PlannedModel.find(name=values).order('-name'))
+		assert([o.name for o in objs] == list(reversed(self.names)))
+
+	def test_merged_next_token(self):
+		"""Test paging through split results with the merged token"""
+		values = self.names + ['even', 'odd']
+		seen = []
+		token = None
+		while True:
+			q = PlannedModel.find(tags=values, limit=4, next_token=token).order('name')
+			seen.extend([o.name for o in q])
+			token = q.next_token
+			if not token:
+				break
+		assert(seen == self.names)
+
+	def test_limit_fetches_no_extra_pages(self):
+		"""Test a limited split query only selects the pages it uses"""
+		q = PlannedModel.find(name=self.names[:6], limit=2).order('name')
+		assert([o.name for o in q] == self.names[:2])
+		assert(len(self.selects()) == 2)
+		q = PlannedModel.find(name=self.names[:6], limit=2, next_token=q.next_token).order('name')
+		assert([o.name for o in q] == self.names[2:4])
+
+	def test_split_count(self):
+		assert(PlannedModel.find(name=self.names).count() == 10)
+		assert(len(self.selects()) == 4)
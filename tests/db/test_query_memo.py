@@ -0,0 +1,121 @@
+# Copyright (c) 2014 Chris Moyer http://coredumped.org/
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+from botoweb.db.coremodel import Model
+from botoweb.db.property import StringProperty
+from memory_domain import MemoryDomain
+
+class MemoModel(Model):
+	"""Simple model stored in memory"""
+	name = StringProperty()
+
+
+class TestQueryMemo(object):
+	"""Test that query results are kept between iterations"""
+
+	def setup_method(self, method):
+		self.domain = MemoryDomain()
+		MemoModel._manager._domain = self.domain
+		for x in range(5):
+			MemoModel(name='Obj %s' % x).put()
+		self.domain.reset_calls()
+
+	def test_iterate_twice(self):
+		"""Test the second iteration doesn't query again"""
+		q = MemoModel.all()
+		first = [o.id for o in q]
+		assert(len(self.domain.calls_to('select')) == 1)
+		assert([o.id for o in q] == first)
+		assert(len(q) == 5)
+		assert(q.count() == 5)
+		assert(len(self.domain.calls_to('select')) == 1)
+
+	def test_len_needs_results(self):
+		"""Test len() only answers from kept results"""
+		q = MemoModel.all()
+		try:
+			len(q)
+		except TypeError:
+			pass
+		else:
+			assert False, "len() ran the query"
+		assert(self.domain.calls_to('select') == [])
+		assert(len(list(q)) == 5)
+		assert(len(q) == 5)
+		assert(len(self.domain.calls_to('select')) == 1)
+
+	def test_refresh(self):
+		"""Test refresh() runs the query again"""
+		q = MemoModel.all()
+		assert(len(list(q)) == 5)
+		MemoModel(name='New').put()
+		assert(len(list(q)) == 5)
+		assert(len(list(q.refresh())) == 6)
+		assert(len(self.domain.calls_to('select')) == 2)
+
+	def test_changed_query_not_replayed(self):
+		"""Test adding a filter or limit forgets the old results"""
+		q = MemoModel.all()
+		list(q)
+		q.fetch(2)
+		assert(len(list(q)) == 2)
+		assert(len(self.domain.calls_to('select')) == 2)
+
+	def test_next_token_not_replayed(self):
+		"""Test a new next_token or offset forgets the old results"""
+		q = MemoModel.all(limit=2)
+		first = [o.id for o in q]
+		q.next_token = '2'
+		assert([o.id for o in q] != first)
+		q = MemoModel.all(limit=2)
+		list(q)
+		q.fetch(2, offset=2)
+		assert([o.id for o in q] != first)
+		# The offset is counted through with one more select
+		assert(len(self.domain.calls_to('select')) == 5)
+
+	def test_limited_count(self):
+		"""Test count() isn't taken from a limited page of results"""
+		q = MemoModel.all(limit=2)
+		assert(len(list(q)) == 2)
+		self.domain.reset_calls()
+		assert(q.count() == 5)
+		assert(len(self.domain.calls_to('select')) == 1)
+
+	def test_over_memo_size_streams(self):
+		"""Test big result sets aren't kept"""
+		q = MemoModel.all()
+		q.memo_size = 3
+		assert(len([o for o in q]) == 5)
+		assert(q._results is None)
+		assert(len([o for o in q]) == 5)
+		assert(len(self.domain.calls_to('select')) == 2)
+
+	def test_list_over_memo_size(self):
+		"""Test list() doesn't run a query it can't keep twice"""
+		q = MemoModel.all()
+		q.memo_size = 3
+		assert(len(list(q)) == 5)
+		assert(len(self.domain.calls_to('select')) == 1)
+
+	def test_truth_value(self):
+		"""Test an unused query is true without running it"""
+		assert(MemoModel.all())
+		assert(self.domain.calls == [])
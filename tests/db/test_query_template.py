@@ -0,0 +1,52 @@
+# Copyright (c) 2014 Chris Moyer http://coredumped.org/
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+from botoweb.db.coremodel import Model
+from botoweb.db.property import StringProperty, IntegerProperty
+
+class TemplateModel(Model):
+	"""Simple model to build queries for"""
+	name = StringProperty()
+	num = IntegerProperty()
+
+
+class TestFilterTemplate(object):
+	"""Test the where clause templates"""
+
+	def setup_method(self, method):
+		self.manager = TemplateModel._manager
+		self.manager._templates.clear()
+
+	def test_same_shape_reused(self):
+		"""Test queries differing only in values share a template"""
+		q1 = TemplateModel.find(name='a').filter('num >', 1).order('-num')
+		q2 = TemplateModel.find(name="b'c").filter('num >', 2).order('-num')
+		assert(q1.get_query() != q2.get_query())
+		assert("`name` = 'b''c'" in q2.get_query())
+		assert(len(self.manager._templates) == 1)
+		TemplateModel.find(name=['a', 'b']).get_query()
+		assert(len(self.manager._templates) == 2)
+
+	def test_new_subclass_included(self):
+		"""Test a subclass defined after the template was built is matched"""
+		TemplateModel.find(name='a').get_query()
+		class LateModel(TemplateModel):
+			pass
+		assert("`__type__` = 'LateModel'" in TemplateModel.find(name='a').get_query())
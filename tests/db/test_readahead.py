@@ -0,0 +1,87 @@
+# Copyright (c) 2014 Chris Moyer http://coredumped.org/
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+import threading
+from botoweb.db.readahead import ReadAheadResultSet
+from memory_domain import MemoryPage
+
+class PagedConnection(object):
+	"""Connection returning numbered pages of 3 items"""
+
+	def __init__(self, pages, fail_on=None):
+		self.pages = pages
+		self.fail_on = fail_on
+		self.fetched = []
+		self.fetched_event = {}
+
+	def select(self, domain, query='', next_token=None, consistent_read=False):
+		page = int(next_token or 0)
+		if page == self.fail_on:
+			raise ValueError('Page %s failed' % page)
+		self.fetched.append(page)
+		self.fetched_event.setdefault(page, threading.Event()).set()
+		next_token = None
+		if page + 1 < self.pages:
+			next_token = str(page + 1)
+		return MemoryPage(range(page * 3, page * 3 + 3), next_token)
+
+
+class PagedDomain(object):
+	def __init__(self, connection):
+		self.connection = connection
+
+
+class TestReadAhead(object):
+	"""Test fetching pages ahead of the caller"""
+
+	def test_all_results_in_order(self):
+		conn = PagedConnection(5)
+		rs = ReadAheadResultSet(PagedDomain(conn), 'select', depth=2)
+		assert(list(rs) == range(15))
+		assert(conn.fetched == [0, 1, 2, 3, 4])
+
+	def test_next_page_fetched_while_consuming(self):
+		conn = PagedConnection(3)
+		it = iter(ReadAheadResultSet(PagedDomain(conn), 'select', depth=1))
+		for x in range(3):
+			it.next()
+		# Still on the first page, the second should be on its way
+		assert(conn.fetched_event.setdefault(1, threading.Event()).wait(5))
+		assert(list(it) == range(3, 9))
+
+	def test_max_items(self):
+		conn = PagedConnection(5)
+		rs = ReadAheadResultSet(PagedDomain(conn), 'select', max_items=4, depth=2)
+		assert(list(rs) == range(4))
+		assert(conn.fetched == [0, 1])
+
+	def test_no_read_ahead(self):
+		conn = PagedConnection(3)
+		rs = ReadAheadResultSet(PagedDomain(conn), 'select', depth=0)
+		assert(list(rs) == range(9))
+
+	def test_error_raised(self):
+		conn = PagedConnection(5, fail_on=2)
+		try:
+			list(ReadAheadResultSet(PagedDomain(conn), 'select', depth=2))
+		except ValueError:
+			pass
+		else:
+			assert False, 'Expected the error from the producer'
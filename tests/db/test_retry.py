@@ -0,0 +1,188 @@
+# Copyright (c) 2014 Chris Moyer http://coredumped.org/
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+import socket
+from boto.exception import SDBResponseError, DynamoDBResponseError
+from boto.dynamodb.exceptions import DynamoDBConditionalCheckFailedError
+from botoweb.db.dynamo import _is_retryable
+from botoweb.db.retry import RetryPolicy, CircuitBreaker, CircuitOpenError
+
+class Clock(object):
+	"""Fake clock, sleeping just moves time forward"""
+
+	def __init__(self):
+		self.now = 1000.0
+
+	def __call__(self):
+		return self.now
+
+	def sleep(self, seconds):
+		self.now += seconds
+
+
+class Flaky(object):
+	"""Callable which fails a given number of times before succeeding"""
+
+	def __init__(self, failures, error=None):
+		self.failures = failures
+		self.calls = 0
+		if error is None:
+			error = socket.error('Connection reset')
+		self.error = error
+
+	def __call__(self):
+		self.calls += 1
+		if self.calls <= self.failures:
+			raise self.error
+		return 'OK'
+
+
+class TestRetryPolicy(object):
+	"""Test the shared retry policy and circuit breaker"""
+
+	def policy(self, clock, breaker=None, **kw):
+		args = dict(max_attempts=5, budget=10.0, base_delay=0.5, max_delay=4.0)
+		args.update(kw)
+		return RetryPolicy(breaker=breaker, sleep=clock.sleep, clock=clock, **args)
+
+	def test_retries_until_success(self):
+		"""Test that a transient error is retried"""
+		clock = Clock()
+		fnc = Flaky(2)
+		assert(self.policy(clock).call(fnc) == 'OK')
+		assert(fnc.calls == 3)
+
+	def test_gives_up_after_max_attempts(self):
+		"""Test that we only try max_attempts times"""
+		clock = Clock()
+		fnc = Flaky(10)
+		try:
+			self.policy(clock, max_attempts=3).call(fnc)
+		except socket.error:
+			pass
+		else:
+			assert False, 'Expected the error to be raised'
+		assert(fnc.calls == 3)
+
+	def test_time_budget(self):
+		"""Test that we never sleep past the time budget"""
+		clock = Clock()
+		start = clock()
+		fnc = Flaky(100)
+		try:
+			self.policy(clock, max_attempts=100, budget=5.0).call(fnc)
+		except socket.error:
+			pass
+		assert(clock() - start <= 5.0)
+
+	def test_backoff_is_bounded(self):
+		"""Test the jittered backoff stays under the cap"""
+		policy = self.policy(Clock())
+		for attempt in range(1, 20):
+			delay = policy.backoff(attempt)
+			assert(0 <= delay <= min(4.0, 0.5 * 2 ** (attempt - 1)))
+
+	def test_client_errors_not_retried(self):
+		"""Test that a 4xx (like a failed conditional put) is raised right away"""
+		clock = Clock()
+		fnc = Flaky(1, SDBResponseError(409, 'Conflict'))
+		try:
+			self.policy(clock).call(fnc)
+		except SDBResponseError:
+			pass
+		assert(fnc.calls == 1)
+
+	def test_server_errors_retried(self):
+		"""Test that a 503 from SDB is retried"""
+		clock = Clock()
+		fnc = Flaky(1, SDBResponseError(503, 'Service Unavailable'))
+		assert(self.policy(clock).call(fnc) == 'OK')
+		assert(fnc.calls == 2)
+
+	def test_dynamo_errors(self):
+		"""Test only throttled or failed Dynamo calls are retried, and other errors don't open the circuit"""
+		conflict = DynamoDBConditionalCheckFailedError(400, 'Bad Request',
+			{'__type': 'com.amazonaws.dynamodb.v20111205#ConditionalCheckFailedException'})
+		invalid = DynamoDBResponseError(400, 'Bad Request',
+			{'__type': 'com.amazon.coral.validate#ValidationException'})
+		throttled = DynamoDBResponseError(400, 'Bad Request',
+			{'__type': 'com.amazonaws.dynamodb.v20111205#ProvisionedThroughputExceededException'})
+		failed = DynamoDBResponseError(500, 'Internal Server Error',
+			{'__type': 'com.amazon.coral.service#InternalFailure'})
+		assert(not _is_retryable(conflict))
+		assert(not _is_retryable(invalid))
+		assert(_is_retryable(throttled))
+		assert(_is_retryable(failed))
+
+		clock = Clock()
+		breaker = CircuitBreaker('test', threshold=3, reset_timeout=30.0, clock=clock)
+		policy = self.policy(clock, breaker, retryable=_is_retryable)
+		for n in range(5):
+			fnc = Flaky(1, conflict)
+			try:
+				policy.call(fnc)
+			except DynamoDBResponseError:
+				pass
+			assert(fnc.calls == 1)
+		assert(breaker.allow())
+
+	def test_circuit_opens(self):
+		"""Test that the breaker opens and fails fast"""
+		clock = Clock()
+		breaker = CircuitBreaker('test', threshold=3, reset_timeout=30.0, clock=clock)
+		policy = self.policy(clock, breaker=breaker, max_attempts=3)
+		fnc = Flaky(100)
+		try:
+			policy.call(fnc)
+		except socket.error:
+			pass
+		assert(breaker.state == CircuitBreaker.OPEN)
+		try:
+			policy.call(fnc)
+		except CircuitOpenError:
+			pass
+		else:
+			assert False, 'Expected the circuit to be open'
+		assert(fnc.calls == 3)
+
+	def test_circuit_half_open(self):
+		"""Test that a single trial call closes the circuit again"""
+		clock = Clock()
+		breaker = CircuitBreaker('test', threshold=1, reset_timeout=30.0, clock=clock)
+		breaker.record_failure()
+		assert(not breaker.allow())
+		clock.now += 31
+		assert(breaker.state == CircuitBreaker.HALF_OPEN)
+		assert(breaker.allow())
+		# Only one trial goes through
+		assert(not breaker.allow())
+		breaker.record_success()
+		assert(breaker.state == CircuitBreaker.CLOSED)
+		assert(breaker.allow())
+
+	def test_iterate_retries_before_first_item(self):
+		"""Test iterating only retries if nothing was yielded yet"""
+		clock = Clock()
+		fnc = Flaky(2)
+		def make_iter():
+			fnc()
+			return iter([1, 2, 3])
+		assert(list(self.policy(clock).iterate(make_iter)) == [1, 2, 3])
+		assert(fnc.calls == 3)
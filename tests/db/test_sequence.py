@@ -107,3 +107,117 @@ class TestDBHandler(object):
 		s.val = "Z"
 		assert(s.val == "Z")
 		assert(s.next() == "AA")
+
+
+class TestSequenceBlocks(object):
+	"""Test reserving blocks of values, against an in-memory domain"""
+
+	def setup_method(self, method):
+		import boto
+		from memory_domain import MemoryConnection
+		self.conn = MemoryConnection()
+		self.connect_sdb = boto.connect_sdb
+		boto.connect_sdb = lambda: self.conn
+
+	def teardown_method(self, method):
+		import boto
+		boto.connect_sdb = self.connect_sdb
+
+	def domain(self):
+		return self.conn.domains.values()[0]
+
+	def test_block(self):
+		"""Test one write reserves the whole block"""
+		from botoweb.db.sequence import Sequence
+		s = Sequence(block_size=10)
+		self.domain().reset_calls()
+		assert([s.next() for n in range(12)] == range(1, 13))
+		assert(len(self.domain().calls_to('put_attributes')) == 2)
+		assert(Sequence(s.id).val == 20)
+
+	def test_blocks_dont_overlap(self):
+		from botoweb.db.sequence import Sequence
+		a = Sequence(block_size=5)
+		b = Sequence(a.id, block_size=5)
+		assert(a.next() == 1)
+		assert(b.next() == 6)
+		assert(a.next() == 2)
+		assert(b.next() == 7)
+
+	def test_fib_block(self):
+		"""Test functions which use the last value work across blocks"""
+		from botoweb.db.sequence import Sequence, fib
+		s = Sequence(fnc=fib, block_size=4)
+		assert([s.next() for n in range(11)] == [1, 2, 3, 5, 8, 13, 21, 34, 55, 89, 144])
+
+	def test_threads(self):
+		"""Test values are handed out once each across threads"""
+		import threading
+		from botoweb.db.sequence import Sequence
+		s = Sequence(block_size=7)
+		values = []
+		def take():
+			for n in range(25):
+				values.append(s.next())
+		threads = [threading.Thread(target=take) for n in range(4)]
+		for t in threads:
+			t.start()
+		for t in threads:
+			t.join()
+		assert(sorted(values) == range(1, 101))
+
+	def test_conflict_retried(self):
+		from botoweb.db.sequence import Sequence
+		a = Sequence(gap_free=True)
+		b = Sequence(a.id)
+		get = a.get
+		raced = []
+		def racing_get():
+			val = get()
+			if not raced:
+				# Another process writes between our read and write
+				raced.append(b.next())
+			return val
+		a.get = racing_get
+		assert(a.next() == 2)
+		assert(raced == [1])
+		assert(b.val == 2)
+
+	def test_conflict_without_retry(self):
+		"""Test the default mode still raises when out of sync"""
+		from botoweb.db.sequence import Sequence
+		a = Sequence()
+		b = Sequence(a.id)
+		a.next()
+		try:
+			b.set(5)
+		except ValueError:
+			pass
+		else:
+			assert False, "Stale write succeeded"
+
+	def test_gap_free(self):
+		from botoweb.db.sequence import Sequence
+		a = Sequence(gap_free=True, block_size=10)
+		b = Sequence(a.id, gap_free=True)
+		assert([a.next(), b.next(), a.next()] == [1, 2, 3])
+		assert(Sequence(a.id).val == 3)
+
+	def test_release(self):
+		"""Test unused values are given back"""
+		from botoweb.db.sequence import Sequence
+		a = Sequence(block_size=10)
+		a.next()
+		a.next()
+		assert(a.release() == 8)
+		assert(Sequence(a.id).next() == 3)
+		assert(a.release() == 0)
+
+	def test_release_after_other_reservation(self):
+		from botoweb.db.sequence import Sequence
+		a = Sequence(block_size=10)
+		b = Sequence(a.id, block_size=10)
+		a.next()
+		b.next()
+		assert(a.release() == 0)
+		assert(Sequence(a.id).val == 20)
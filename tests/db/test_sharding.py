@@ -0,0 +1,223 @@
+# Copyright (c) 2014 Chris Moyer http://coredumped.org/
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+from botoweb.db.coremodel import Model
+from botoweb.db.property import StringProperty, IntegerProperty
+from botoweb.db.batch import put_multi
+from botoweb.db.manager.shardedmanager import ShardedSDBManager, MirroredDomain, ReshardError, shard_index
+from memory_domain import MemoryDomain
+
+class ShardedModel(Model):
+	"""Model spread over several in-memory domains"""
+	name = StringProperty()
+	num = IntegerProperty()
+
+
+class TestSharding(object):
+	"""Test spreading a class over several domains"""
+
+	def setup_method(self, method):
+		self.manager = self.sharded(4)
+		ShardedModel._manager = self.manager
+
+	def sharded(self, shards, reshard_to=None):
+		manager = ShardedSDBManager(ShardedModel, 'sharded', None, None, 'sdb.amazonaws.com', 443,
+			None, None, True, shards=shards, reshard_to=reshard_to)
+		for n in set([shards, reshard_to or shards]):
+			self.memory_layout(manager, n)
+		return manager
+
+	def memory_layout(self, manager, shards):
+		manager._layouts[shards] = [MemoryDomain(manager.shard_name(x, shards)) for x in range(shards)]
+		return manager._layouts[shards]
+
+	def create(self, count=20):
+		objs = [ShardedModel(name='Obj %02d' % n, num=(n * 7) % count) for n in range(count)]
+		for obj in objs:
+			obj.put()
+		return objs
+
+	def test_names(self):
+		assert(self.manager.shard_name(3) == 'sharded_4_3')
+		assert(self.manager.shard_name(0, 1) == 'sharded')
+
+	def test_writes_spread(self):
+		"""Test each object is only stored in the shard its ID hashes to"""
+		objs = self.create()
+		domains = self.manager.layout()
+		for obj in objs:
+			n = shard_index(obj.id, 4)
+			assert([x for x, d in enumerate(domains) if obj.id in d.items] == [n])
+		assert(len([d for d in domains if d.items]) > 1)
+
+	def test_point_read(self):
+		"""Test getting an object by ID only reads its own shard"""
+		obj = self.create()[0]
+		for domain in self.manager.layout():
+			domain.reset_calls()
+		assert(ShardedModel.get_by_id(obj.id).name == obj.name)
+		reads = [d.name for d in self.manager.layout() if d.calls_to('get_attributes')]
+		assert(reads == [self.manager.shard_name(shard_index(obj.id, 4))])
+
+	def test_query_sorted(self):
+		"""Test results from every shard are merged in order"""
+		self.create()
+		nums = [obj.num for obj in ShardedModel.find().order('num')]
+		assert(nums == range(20))
+		nums = [obj.num for obj in ShardedModel.find().order('-num')]
+		assert(nums == range(19, -1, -1))
+
+	def test_query_limit(self):
+		"""Test the limit and next_token apply to the merged results"""
+		self.create()
+		nums = []
+		next_token = None
+		while True:
+			query = ShardedModel.find(limit=6).order('num')
+			query.next_token = next_token
+			page = [obj.num for obj in query]
+			assert(len(page) <= 6)
+			nums.extend(page)
+			next_token = query.next_token
+			if not next_token:
+				break
+		assert(nums == range(20))
+
+	def test_count(self):
+		self.create()
+		assert(ShardedModel.find().count() == 20)
+		assert(ShardedModel.find(name='Obj 03').count() == 1)
+
+	def test_id_query(self):
+		"""Test a query on __id__ only goes to the shards the IDs hash to"""
+		obj = self.create()[0]
+		for domain in self.manager.layout():
+			domain.reset_calls()
+		found = list(ShardedModel.find().filter('__id__ =', obj.id))
+		assert([o.id for o in found] == [obj.id])
+		selects = [d for d in self.manager.layout() if d.calls_to('select')]
+		assert(len(selects) == 1)
+
+	def test_batch_per_shard(self):
+		"""Test batch writes only hold objects of one shard"""
+		objs = [ShardedModel(name='Obj %02d' % n, num=n) for n in range(20)]
+		put_multi(objs)
+		for n, domain in enumerate(self.manager.layout()):
+			for call in domain.calls_to('batch_put_attributes'):
+				assert(set([shard_index(id, 4) for id in call[1]]) == set([n]))
+		assert(sum([len(d.items) for d in self.manager.layout()]) == 20)
+		assert([o.name for o in ShardedModel.get_by_id([obj.id for obj in objs])] == [o.name for o in objs])
+
+	def test_reshard(self):
+		"""Test copying every item to a new number of shards"""
+		objs = self.create()
+		target = self.memory_layout(self.manager, 8)
+		assert(self.manager.reshard(8) == 20)
+		for obj in objs:
+			n = shard_index(obj.id, 8)
+			assert(target[n].items[obj.id]['name'] == obj.name)
+		assert(sum([len(d.items) for d in target]) == 20)
+
+		# The items can be read once shards is changed
+		manager = self.sharded(8)
+		manager._layouts[8] = target
+		ShardedModel._manager = manager
+		assert(ShardedModel.find().count() == 20)
+		assert(ShardedModel.get_by_id(objs[0].id).name == objs[0].name)
+
+	def test_reshard_mirrors_writes(self):
+		"""Test writes are copied to the new shards while resharding"""
+		manager = self.sharded(4, reshard_to=8)
+		ShardedModel._manager = manager
+		assert(isinstance(manager.domain_for('x'), MirroredDomain))
+		obj = ShardedModel(name='A', num=1)
+		obj.put()
+		new = manager.layout(8)[shard_index(obj.id, 8)]
+		assert(new.items[obj.id]['name'] == 'A')
+		obj.name = 'B'
+		obj.put()
+		assert(new.items[obj.id]['name'] == 'B')
+		obj.delete()
+		assert(obj.id not in new.items)
+		assert(obj.id not in manager.layout(4)[shard_index(obj.id, 4)].items)
+
+	def test_reshard_from_one(self):
+		"""Test an existing unsharded domain can be split up"""
+		manager = self.sharded(1)
+		ShardedModel._manager = manager
+		objs = self.create(5)
+		assert(manager.layout()[0].name == 'sharded')
+		self.memory_layout(manager, 3)
+		assert(manager.reshard(3) == 5)
+		assert(sum([len(d.items) for d in manager.layout(3)]) == 5)
+
+	def test_reshard_concurrent_write(self):
+		"""Test a write made while a batch is being copied isn't lost"""
+		obj = self.create(1)[0]
+		target = self.memory_layout(self.manager, 8)
+		live = self.sharded(4, reshard_to=8)
+		live._layouts = self.manager._layouts
+		shard = target[shard_index(obj.id, 8)]
+		batch_put = shard.batch_put_attributes
+		raced = []
+
+		def racing_put(items, replace=True):
+			# The application writes after the copy read the item
+			if not raced:
+				raced.append(True)
+				ShardedModel._manager = live
+				obj.name = None
+				obj.num = 42
+				obj.put()
+			return batch_put(items, replace=replace)
+		shard.batch_put_attributes = racing_put
+
+		assert(self.manager.reshard(8) == 1)
+		assert(shard.items[obj.id] == self.manager.domain_for(obj.id).items[obj.id])
+		assert(ShardedModel.get_by_id(obj.id).num == 42)
+		assert('name' not in shard.items[obj.id])
+
+	def test_reshard_keeps_changing(self):
+		"""Test items that never settle are reported, not counted as copied"""
+		objs = self.create(2)
+		target = self.memory_layout(self.manager, 8)
+		live = self.sharded(4, reshard_to=8)
+		live._layouts = self.manager._layouts
+		obj = objs[0]
+		shard = target[shard_index(obj.id, 8)]
+		batch_put = shard.batch_put_attributes
+
+		def racing_put(items, replace=True):
+			if obj.id in items:
+				ShardedModel._manager = live
+				obj.num += 1
+				obj.put()
+			return batch_put(items, replace=replace)
+		shard.batch_put_attributes = racing_put
+
+		try:
+			self.manager.reshard(8)
+		except ReshardError, e:
+			assert(e.unsynced == [obj.id])
+			assert(e.count == 2)
+		else:
+			assert False, "Reshard reported success"
+		other = objs[1]
+		assert(target[shard_index(other.id, 8)].items[other.id]['name'] == other.name)
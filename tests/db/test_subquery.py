@@ -0,0 +1,148 @@
+# Copyright (c) 2014 Chris Moyer http://coredumped.org/
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+from botoweb.db.coremodel import Model
+from botoweb.db.model import query, _splitSubQueries
+from botoweb.db.planner import SubQuerySelect
+from botoweb.db.property import StringProperty, ReferenceProperty
+from botoweb.exceptions import BadRequest
+from memory_domain import MemoryDomain
+
+class SubAuthor(Model):
+	"""Model searched in sub-queries"""
+	name = StringProperty(verbose_name="Author Name")
+	group = StringProperty()
+
+
+class SubBook(Model):
+	"""Model with references to search on"""
+	title = StringProperty()
+	author = ReferenceProperty(SubAuthor, verbose_name="Written By", collection_name="sub_books")
+
+
+class TestSubQueries(object):
+	"""Test resolving [Model ...] sub-queries"""
+
+	def setup_method(self, method):
+		self.domain = MemoryDomain()
+		self.max_or_values = {}
+		for cls in (SubAuthor, SubBook):
+			cls._manager._domain = self.domain
+			self.max_or_values[cls] = cls._manager.max_or_values
+			cls._manager.max_or_values = 3
+		self.authors = []
+		for x in range(8):
+			author = SubAuthor(name='A%s' % x, group='even' if x % 2 == 0 else 'odd')
+			author.put()
+			self.authors.append(author)
+		for x, author in enumerate(self.authors):
+			SubBook(title='B%s' % x, author=author).put()
+		self.domain.reset_calls()
+
+	def teardown_method(self, method):
+		for cls, value in self.max_or_values.items():
+			cls._manager.max_or_values = value
+
+	def selects(self):
+		return [c[1] for c in self.domain.calls_to('select')]
+
+	def titles(self, q):
+		return sorted([b.title for b in q])
+
+	def test_split_sub_queries(self):
+		parts = _splitSubQueries("`a` in [X `b` in [Y `c` = ']'] ] and `d` = '['")
+		assert(parts == ["`a` in ", "X `b` in [Y `c` = ']'] ", " and `d` = '['"])
+		try:
+			_splitSubQueries("`a` in [X `b` = 'c'")
+		except BadRequest:
+			pass
+		else:
+			assert False, "Unclosed [ accepted"
+
+	def test_no_sub_query(self):
+		q = query(SubBook, "`Written By` = '%s'" % self.authors[0].id)
+		assert(q.select == "`author` = '%s'" % self.authors[0].id)
+		assert(self.titles(q) == ['B0'])
+
+	def test_inlined(self):
+		"""Test a sub-query with few results is inlined into one select"""
+		q = query(SubBook, "`Written By` in [SubAuthor `Author Name` in ('A1', 'A2')]")
+		assert(isinstance(q.select, SubQuerySelect))
+		assert(self.titles(q) == ['B1', 'B2'])
+		assert(len(self.selects()) == 2)
+
+	def test_every_result(self):
+		"""Test sub-queries aren't cut off, but split into chunks"""
+		q = query(SubBook, "`author` in [SubAuthor `group` like '%']")
+		assert(self.titles(q) == ['B%s' % x for x in range(8)])
+		# The sub-query, then one select for each chunk of 3 IDs
+		assert(len(self.selects()) == 4)
+		assert(q.count() == 8)
+
+	def test_sorted_merge(self):
+		q = query(SubBook, "`author` in [SubAuthor `group` like '%']").order('-title')
+		assert([b.title for b in q] == ['B%s' % x for x in reversed(range(8))])
+
+	def test_two_sub_queries(self):
+		"""Test independent sub-queries are combined chunk by chunk"""
+		q = query(SubBook, "`author` in [SubAuthor `group` = 'even'] or itemName() in [SubBook `title` in ('B1', 'B3', 'B5', 'B7')]")
+		assert(self.titles(q) == ['B%s' % x for x in range(8)])
+		# Two sub-queries, then 2 x 2 chunks
+		assert(len(self.selects()) == 6)
+		q = query(SubBook, "`author` in [SubAuthor `group` = 'even'] and itemName() in [SubBook `title` in ('B1', 'B3', 'B5', 'B7')]")
+		assert(self.titles(q) == [])
+
+	def test_no_duplicates(self):
+		"""Test items returned by several of the selects come back once"""
+		q = query(SubBook, "`author` in [SubAuthor `group` like '%'] or itemName() in [SubBook `title` like '%']")
+		assert(self.titles(q) == ['B%s' % x for x in range(8)])
+		assert(len(self.selects()) == 2 + 3 * 3)
+
+	def test_fields(self):
+		q = query(SubBook, "`author` in [SubAuthor `group` like '%'] or itemName() in [SubBook `title` like '%']")
+		assert(self.titles(q.select_fields('title')) == ['B%s' % x for x in range(8)])
+
+	def test_nested(self):
+		q = query(SubBook, "`author` in [SubAuthor itemName() in [SubAuthor `name` = 'A3']]")
+		assert(self.titles(q) == ['B3'])
+
+	def test_not_split_when_negated(self):
+		q = query(SubBook, "not `author` in [SubAuthor `group` like '%']")
+		try:
+			list(q)
+		except BadRequest:
+			pass
+		else:
+			assert False, "Negated sub-query split"
+
+	def test_too_many_selects(self):
+		max_subquery_selects = SubBook._manager.max_subquery_selects
+		SubBook._manager.max_subquery_selects = 2
+		try:
+			q = query(SubBook, "`author` in [SubAuthor `group` like '%']")
+			list(q)
+		except BadRequest, e:
+			# Stopped reading the sub-query once it had too many IDs to send
+			assert("more than 6 results" in e.description)
+		else:
+			assert False, "Too many selects sent"
+		finally:
+			SubBook._manager.max_subquery_selects = max_subquery_selects
+		assert(len(self.selects()) == 1)
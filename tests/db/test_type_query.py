@@ -0,0 +1,88 @@
+# Copyright (c) 2014 Chris Moyer http://coredumped.org/
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+from botoweb.db.coremodel import Model
+from botoweb.db.property import StringProperty
+from memory_domain import MemoryDomain
+
+class Animal(Model):
+	"""Base of a small class tree"""
+	name = StringProperty()
+
+class Dog(Animal):
+	pass
+
+class Puppy(Dog):
+	pass
+
+class DogHouse(Animal):
+	"""Sibling whose name starts with the name of another class"""
+	pass
+
+class Pet(Model):
+	pass
+
+class PetDog(Dog, Pet):
+	"""Subclass of Dog whose lineage doesn't start with Dog's"""
+	pass
+
+
+class TestTypeQuery(object):
+	"""Test the precomputed type clauses"""
+
+	def setup_method(self, method):
+		self.domain = MemoryDomain()
+		Animal._manager._domain = self.domain
+		Pet._manager._domain = self.domain
+		self.type_filter = Animal._manager.type_filter
+		for cls in (Animal, Dog, Puppy, DogHouse):
+			cls(name=cls.__name__).put()
+
+	def teardown_method(self, method):
+		self.set_type_filter(self.type_filter)
+
+	def set_type_filter(self, type_filter):
+		Animal._manager.type_filter = type_filter
+		Pet._manager.type_filter = type_filter
+
+	def names(self, cls):
+		return sorted(o.name for o in cls.all())
+
+	def test_type_classes(self):
+		"""Test subclasses defined later are added to their ancestors"""
+		assert(Dog._type_classes == [Dog, Puppy, PetDog])
+		assert(Puppy._type_classes == [Puppy])
+		assert(Dog._type_query == "(`__type__` = 'Dog' or `__type__` = 'Puppy' or `__type__` = 'PetDog')")
+
+	def test_type_filter(self):
+		self.set_type_filter("type")
+		assert(self.names(Dog) == ['Dog', 'Puppy'])
+		assert(self.names(Animal) == ['Animal', 'Dog', 'DogHouse', 'Puppy'])
+
+	def test_lineage_filter(self):
+		self.set_type_filter("lineage")
+		query = Dog.all().get_query()
+		assert("`__lineage__` like 'object.Model.Animal.Dog.%'" in query)
+		assert("`__type__` = 'Puppy'" not in query)
+		# PetDog's lineage goes through Pet, so it's matched by type
+		assert("`__type__` = 'PetDog'" in query)
+		assert(self.names(Dog) == ['Dog', 'Puppy'])
+		assert(self.names(Puppy) == ['Puppy'])
+		assert(self.names(Animal) == ['Animal', 'Dog', 'DogHouse', 'Puppy'])
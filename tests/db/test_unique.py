@@ -0,0 +1,105 @@
+# Copyright (c) 2014 Chris Moyer http://coredumped.org/
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+from boto.exception import SDBPersistenceError
+from botoweb.db.coremodel import Model
+from botoweb.db.property import StringProperty
+from botoweb.db.unique import UniqueIndex
+from memory_domain import MemoryDomain
+
+class UniqueModel(Model):
+	"""Model with a unique property, stored in memory"""
+	username = StringProperty(unique=True)
+	name = StringProperty()
+
+
+class TestUniqueIndex(object):
+	"""Test enforcing unique properties with the UniqueIndex"""
+
+	def setup_method(self, method):
+		self.manager = UniqueModel._manager
+		self.manager._domain = MemoryDomain()
+		self.index = UniqueIndex(self.manager, 'unique')
+		self.index._domain = MemoryDomain('unique')
+		self.manager.unique_index = self.index
+
+	def teardown_method(self, method):
+		self.manager.unique_index = None
+
+	def make(self, username):
+		obj = UniqueModel()
+		obj.username = username
+		return obj.put()
+
+	def test_duplicate_rejected(self):
+		self.make('bob')
+		try:
+			self.make('bob')
+		except SDBPersistenceError:
+			pass
+		else:
+			assert False, 'Expected a duplicate username to be rejected'
+
+	def test_duplicate_in_batch_rejected(self):
+		try:
+			UniqueModel.put_multi([UniqueModel(username='bob'), UniqueModel(username='bob')])
+		except SDBPersistenceError:
+			pass
+		else:
+			assert False, 'Expected a duplicate username to be rejected'
+
+	def test_resave_uses_cache(self):
+		"""Test saving an object again doesn't touch the index"""
+		obj = self.make('bob')
+		self.index.domain.reset_calls()
+		obj.name = 'Bob'
+		obj.username = 'bob'
+		obj.put()
+		assert(self.index.domain.calls == [])
+
+	def test_change_releases_value(self):
+		"""Test changing a unique value lets someone else have the old one"""
+		obj = UniqueModel.get_by_id(self.make('bob').id)
+		obj.username = 'robert'
+		obj.put()
+		other = self.make('bob')
+		assert(other.username == 'bob')
+
+	def test_delete_releases_value(self):
+		obj = UniqueModel.get_by_id(self.make('bob').id)
+		obj.delete()
+		self.make('bob')
+
+	def test_stale_claim_taken_over(self):
+		"""Test an old claim by an object that was never saved is taken over"""
+		ghost = UniqueModel(username='bob')
+		ghost.id = 'ghost'
+		prop = UniqueModel.find_property('username')
+		self.index.claim(ghost, prop, 'bob')
+		self.index._cache.clear()
+		# Fresh claims are left alone, the owner may still be saving
+		try:
+			self.make('bob')
+		except SDBPersistenceError:
+			pass
+		else:
+			assert False, 'Expected a recent claim to be respected'
+		self.index.stale_after = -1
+		self.make('bob')
@@ -0,0 +1,84 @@
+# Copyright (c) 2014 Chris Moyer http://coredumped.org/
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+import time
+from botoweb.db.coremodel import Model
+from botoweb.db.property import StringProperty
+from botoweb.db.writebehind import WriteBehindQueue
+from memory_domain import MemoryDomain
+
+class QueuedModel(Model):
+	"""Simple model stored in memory"""
+	name = StringProperty()
+
+
+class TestWriteBehind(object):
+	"""Test the write-behind queue"""
+
+	def setup_method(self, method):
+		self.domain = MemoryDomain()
+		QueuedModel._manager._domain = self.domain
+
+	def make(self, name):
+		obj = QueuedModel()
+		obj.name = name
+		return obj
+
+	def test_coalesce(self):
+		"""Test repeated writes to one item only write it once"""
+		queue = WriteBehindQueue(max_size=100, max_delay=60)
+		obj = self.make('First')
+		queue.put(obj)
+		obj.name = 'Second'
+		queue.put(obj)
+		queue.put(self.make('Other'))
+		assert(queue.depth == 2)
+		assert(self.domain.items == {})
+		queue.stop()
+		assert(queue.depth == 0)
+		assert(self.domain.items[obj.id]['name'] == 'Second')
+		assert(len(self.domain.calls_to('batch_put_attributes')) == 1)
+		stats = queue.stats()
+		assert(stats['written'] == 2)
+		assert(stats['coalesced'] == 1)
+		assert(stats['last_flush_latency'] is not None)
+
+	def test_flush_at_size(self):
+		"""Test the background thread flushes once max_size items are waiting"""
+		queue = WriteBehindQueue(max_size=3, max_delay=60)
+		for x in range(3):
+			queue.put(self.make('Obj %s' % x))
+		for x in range(100):
+			if len(self.domain.items) == 3:
+				break
+			time.sleep(0.05)
+		assert(len(self.domain.items) == 3)
+		queue.stop()
+
+	def test_flush_after_delay(self):
+		"""Test the background thread flushes once the oldest item is old enough"""
+		queue = WriteBehindQueue(max_size=100, max_delay=0.1)
+		queue.put(self.make('Obj'))
+		for x in range(100):
+			if self.domain.items:
+				break
+			time.sleep(0.05)
+		assert(len(self.domain.items) == 1)
+		queue.stop()
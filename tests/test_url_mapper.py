@@ -42,6 +42,20 @@ class SimpleHandler(RequestHandler):
 		return response
 
 
+class ContextHandler(RequestHandler):
+	"""
+	Handler which reports the WriteTracker and IdentityMap it runs with
+	"""
+	seen = []
+
+	def _get(self, request, response, id=None):
+		from botoweb.db.consistency import current_tracker
+		from botoweb.db.identity import current_map
+		self.seen.append((current_tracker(), current_map()))
+		response.write("<string>%s</string>" % id)
+		return response
+
+
 class TestURLMapper:
 	"""
 	Test the URL Mapper for different configs
@@ -52,7 +66,10 @@ class TestURLMapper:
 		"""
 		cls.env = Environment("example")
 		cls.url_mapper = URLMapper(cls.env)
-		cls.env.config['botoweb']['handlers'] = [ {"url": "/foo", "handler": "%s.SimpleHandler" % cls.__module__} ]
+		cls.env.config['botoweb']['handlers'] = [
+			{"url": "/foo", "handler": "%s.SimpleHandler" % cls.__module__},
+			{"url": "/context", "handler": "%s.ContextHandler" % cls.__module__},
+		]
 
 	def teardown_class(cls):
 		"""
@@ -117,3 +134,47 @@ class TestURLMapper:
 		r.method = "POST"
 		content = self.url_mapper.handle(r, Response())
 		assert(content.body == "<string>POST: my_object_id</string>")
+
+	def test_handle_batch(self):
+		"""
+		Test running several requests in one batch
+		"""
+		import json
+		self.env.config['app']['batch_url'] = "/_batch"
+		try:
+			r = Request.blank("/_batch")
+			r.method = "POST"
+			r.body = json.dumps([
+				{"method": "GET", "path": "/foo/one"},
+				{"method": "POST", "path": "/foo/two", "body": {"name": "two"}},
+				{"method": "GET", "path": "/foo/three", "params": {"bar": "biz"}},
+				{"method": "GET", "path": "/missing"},
+			])
+			content = self.url_mapper.handle(r, Response())
+			results = json.loads(content.body)
+			assert([res['status'] for res in results] == [200, 200, 200, 404])
+			assert(results[0]['body'] == "<string>GET: one</string>")
+			assert(results[1]['body'] == "<string>POST: two</string>")
+			assert(results[2]['body'] == "<string>GET: three</string>")
+		finally:
+			del(self.env.config['app']['batch_url'])
+
+	def test_batch_reads_in_context(self):
+		"""
+		Test batched reads run with the request's WriteTracker and IdentityMap
+		"""
+		import json
+		from botoweb.db.consistency import WriteTracker
+		from botoweb.db.identity import identity_map
+		self.env.config['app']['batch_url'] = "/_batch"
+		del ContextHandler.seen[:]
+		try:
+			r = Request.blank("/_batch")
+			r.method = "POST"
+			r.body = json.dumps([{"method": "GET", "path": "/context/%s" % x} for x in range(3)])
+			with WriteTracker() as tracker:
+				with identity_map() as idmap:
+					self.url_mapper.handle(r, Response())
+			assert(ContextHandler.seen == [(tracker, idmap)] * 3)
+		finally:
+			del(self.env.config['app']['batch_url'])
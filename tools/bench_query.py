@@ -0,0 +1,79 @@
+# Copyright (c) 2014 Chris Moyer http://coredumped.org/
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+# Benchmark for building SDB selects from request parameters, with and
+# without the FilterTemplate cache. Run it directly:
+#
+#	PYTHONPATH=. python tools/bench_query.py [iterations]
+import sys
+import json
+import timeit
+
+from botoweb.appserver.handlers.db import DBHandler
+from botoweb.db.coremodel import Model
+from botoweb.db.property import StringProperty, ListProperty, IntegerProperty, DateTimeProperty
+
+class BenchModel(Model):
+	"""Model with a few kinds of properties to filter on"""
+	name = StringProperty()
+	status = StringProperty()
+	tags = ListProperty(str)
+	num = IntegerProperty()
+	created = DateTimeProperty()
+
+
+QUERIES = {
+	"simple": {"name": "Name"},
+	"filters": {"query": json.dumps([["status", "=", "active"], ["num", ">", "5"], ["tags", "=", ["a", "b", "c"]], ["name", "sort", "asc"]])},
+	"or_list": {"query": json.dumps([[["name", "status"], "=", ["v%s" % x for x in range(15)]]])},
+}
+
+
+def build(handler, params):
+	query = handler.build_query(dict(params), BenchModel.all())
+	return query.get_query()
+
+
+def main(iterations=2000):
+	handler = DBHandler(None, {"db_class": "%s.BenchModel" % BenchModel.__module__})
+	manager = BenchModel._manager
+	print "%-10s %12s %12s" % ("query", "no cache", "templates")
+	for name, params in sorted(QUERIES.items()):
+		def uncached():
+			manager._templates.clear()
+			build(handler, params)
+		def cached():
+			build(handler, params)
+		# Both must give the same select
+		manager._templates.clear()
+		assert build(handler, params) == build(handler, params)
+		results = []
+		for fnc in (uncached, cached):
+			best = min(timeit.repeat(fnc, number=iterations, repeat=3))
+			results.append(best / iterations * 1000000)
+		print "%-10s %10.1fus %10.1fus" % (name, results[0], results[1])
+
+
+if __name__ == "__main__":
+	if len(sys.argv) > 1:
+		main(int(sys.argv[1]))
+	else:
+		main()